@@ -0,0 +1,83 @@
+""" Size and full-range read time of plain csv vs compressed archive for synthetic 1-min candles
+
+    python -m benchmarks.bench_archive --months 12
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.archive import CandleArchive, compact
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+
+MINUTES_PER_DAY = 14 * 60
+
+
+def generate_candles(months: int) -> Candles:
+    rng = np.random.default_rng(0)
+    day = datetime(2015, 1, 1, 7, tzinfo=TZ_UTC)
+    dts = []
+    while len(dts) < months * 21 * MINUTES_PER_DAY:
+        if day.weekday() < 5:
+            dts += [day + timedelta(minutes=i) for i in range(MINUTES_PER_DAY)]
+        day += timedelta(days=1)
+
+    closes = np.round(270 + rng.normal(0, 0.05, len(dts)).cumsum(), 2).tolist()
+    volumes = rng.integers(1, 5000, len(dts)).tolist()
+    return Candles([
+        Candle(open=c, high=round(c + 0.03, 2), low=round(c - 0.02, 2), close=c, volume=v, dt=dt, is_complete=True)
+        for c, v, dt in zip(closes, volumes, dts)
+    ])
+
+
+def get_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob('*')) if path.is_dir() else path.stat().st_size
+
+
+async def measure_read(csv: CSVCandles, from_: datetime, to: datetime, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await csv._read(from_=from_, to=to, interval=csv.interval)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+async def main(months: int, repeat: int) -> None:
+    CandleRangeCache.ENABLED = False
+    candles = generate_candles(months)
+    from_, to = candles[0].dt, candles[-1].dt
+
+    with tempfile.TemporaryDirectory() as dir_:
+        storage = type('Storage', (CSVCandles,), {'filepath': Path(dir_) / 'candles.csv'})
+        csv = storage(instrument_id='bench', interval=CandleInterval.CANDLE_INTERVAL_1_MIN)
+        await csv._prepare_new()
+        await csv._append(candles)
+
+        size_csv = get_size(csv.filepath)
+        read_csv = await measure_read(csv, from_, to, repeat)
+
+        await compact(csv.filepath)
+        size_archive = get_size(CandleArchive(csv.filepath).dir) + get_size(csv.filepath)
+        read_archive = await measure_read(csv, from_, to, repeat)
+
+    print(f'candles={len(candles)} | months={months}')
+    print(f'csv     | size={size_csv / 1024 ** 2:.2f}MB | read={read_csv:.3f}s')
+    print(f'archive | size={size_archive / 1024 ** 2:.2f}MB | read={read_archive:.3f}s | '
+          f'ratio={size_csv / size_archive:.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(months=args.months, repeat=args.repeat))
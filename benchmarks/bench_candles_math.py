@@ -0,0 +1,68 @@
+""" Sum of N 1-min series with gaps: `Candles.__add__` chain vs `combine_candles` vs `combine` on columnar candles
+
+    python -m benchmarks.bench_candles_math --series 40 --days 5
+"""
+import argparse
+import operator
+import time
+from datetime import datetime, timedelta
+from functools import reduce
+
+import numpy as np
+
+from my_tinkoff.candles_math import combine, combine_candles
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+
+MINUTES_PER_DAY = 14 * 60
+
+
+def generate_series(count: int, days: int, gaps: float) -> list[Candles]:
+    rng = np.random.default_rng(0)
+    dts = [datetime(2024, 2, 19, 7, tzinfo=TZ_UTC) + timedelta(days=d, minutes=m)
+           for d in range(days) for m in range(MINUTES_PER_DAY)]
+
+    series = []
+    for _ in range(count):
+        closes = np.round(100 + rng.normal(0, 0.1, len(dts)).cumsum(), 2).tolist()
+        is_kept = (rng.random(len(dts)) >= gaps).tolist()
+        is_kept[0] = True
+        series.append(Candles([
+            Candle(open=c, high=c + 0.05, low=c - 0.05, close=c, volume=10, dt=dt, is_complete=True)
+            for c, dt, keep in zip(closes, dts, is_kept) if keep
+        ]))
+    return series
+
+
+def measure(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(count: int, days: int, gaps: float, repeat: int) -> None:
+    series = generate_series(count, days, gaps)
+    columnar = [ColumnarCandles.from_candles(s) for s in series]
+    print(f'series={count} | candles={sum(map(len, series))} | {gaps=}')
+
+    timings = {
+        'Candles.__add__': measure(lambda: reduce(operator.add, series), repeat),
+        'combine_candles': measure(lambda: combine_candles(series), repeat),
+        'combine': measure(lambda: combine(columnar), repeat),
+    }
+    for name, seconds in timings.items():
+        print(f'{name:<16} | {seconds:.4f}s | x{timings["Candles.__add__"] / seconds:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=40)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--gaps', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(count=args.series, days=args.days, gaps=args.gaps, repeat=args.repeat)
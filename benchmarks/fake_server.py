@@ -0,0 +1,226 @@
+""" Local stand-in for MarketDataService and InstrumentsService which serves synthetic candles.
+
+    async with fake_api(FakeApiConfig(latency=0.01, exhaust_every=50)) as api:
+        candles = await get_candles(instrument_id=FAKE_UID, ...)
+"""
+import asyncio
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator
+
+import grpc
+import numpy as np
+from google.protobuf.timestamp_pb2 import Timestamp
+from tinkoff.invest.grpc import (
+    common_pb2,
+    instruments_pb2,
+    instruments_pb2_grpc,
+    marketdata_pb2,
+    marketdata_pb2_grpc,
+)
+
+from my_tinkoff.client_pool import ClientPool
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.helpers import get_candle_duration
+from my_tinkoff.instrument_cache import InstrumentCache
+from my_tinkoff.token_manager import TokenManager
+from my_tinkoff.trading_calendar import TradingCalendar
+
+FAKE_UID = 'e6123145-9665-43e0-8413-cd61b8aa9b13'
+FAKE_TICKER = 'FAKE'
+FAKE_EXCHANGE = 'MOEX_FAKE'
+SESSION_START = timedelta(hours=7)
+SESSION_END = timedelta(hours=15, minutes=40)
+NS = 10 ** 9
+
+
+@dataclass
+class FakeApiConfig:
+    latency: float = 0.
+    exhaust_every: int = 0
+    ratelimit_reset: int = 0
+    tokens: int = 1
+    first_1min_candle_date: datetime = datetime(2018, 3, 7, tzinfo=TZ_UTC)
+    first_1day_candle_date: datetime = datetime(2000, 1, 4, tzinfo=TZ_UTC)
+
+
+@dataclass
+class FakeApiStats:
+    requests: dict[str, int] = field(default_factory=dict)
+    exhausted: int = 0
+    candles: int = 0
+
+
+def generate_ts(from_ns: int, to_ns: int, step_ns: int) -> np.ndarray:
+    """ Candle timestamps of [from_, to) inside weekday sessions. Day and longer candles start at session start """
+    days = np.arange(from_ns // (86400 * NS), (to_ns - 1) // (86400 * NS) + 1)
+    days = days[(days + 3) % 7 < 5] * 86400 * NS  # 1970-01-01 is Thursday
+    if step_ns >= 86400 * NS:
+        ts = days + SESSION_START // timedelta(microseconds=1) * 1000
+    else:
+        minutes = np.arange(SESSION_START // timedelta(microseconds=1) * 1000,
+                            SESSION_END // timedelta(microseconds=1) * 1000, step_ns)
+        ts = (days[:, None] + minutes[None, :]).ravel()
+    return ts[(ts >= from_ns) & (ts < to_ns)]
+
+
+def get_price(ts: np.ndarray) -> np.ndarray:
+    """ Deterministic price, so every request returns the same candle for the same time """
+    minutes = ts // (60 * NS)
+    return np.round(100 + 10 * np.sin(minutes / 1440) + (minutes * 7919 % 101) / 100, 2)
+
+
+def price2quotation(price: float) -> common_pb2.Quotation:
+    units = int(price)
+    return common_pb2.Quotation(units=units, nano=round((price - units) * NS))
+
+
+def ns2timestamp(ns: int) -> Timestamp:
+    return Timestamp(seconds=ns // NS, nanos=ns % NS)
+
+
+class _FakeService:
+    def __init__(self, config: FakeApiConfig, stats: FakeApiStats):
+        self.config = config
+        self.stats = stats
+
+    async def _handle(self, name: str, context: grpc.aio.ServicerContext) -> None:
+        """ Count request, wait `latency` and reject every `exhaust_every` request """
+        self.stats.requests[name] = self.stats.requests.get(name, 0) + 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+
+        if self.config.exhaust_every and sum(self.stats.requests.values()) % self.config.exhaust_every == 0:
+            self.stats.exhausted += 1
+            context.set_trailing_metadata((('x-ratelimit-reset', str(self.config.ratelimit_reset)),))
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'fake rate limit')
+
+
+class FakeMarketDataService(_FakeService, marketdata_pb2_grpc.MarketDataServiceServicer):
+    async def GetCandles(self, request, context):
+        await self._handle('GetCandles', context)
+
+        step_ns = get_candle_duration(request.interval) // timedelta(microseconds=1) * 1000
+        ts = generate_ts(getattr(request, 'from').ToNanoseconds(), request.to.ToNanoseconds(), step_ns)
+        closes = get_price(ts)
+        now_ns = time.time_ns()
+        self.stats.candles += len(ts)
+
+        return marketdata_pb2.GetCandlesResponse(candles=[
+            marketdata_pb2.HistoricCandle(
+                open=price2quotation(c - 0.01),
+                high=price2quotation(c + 0.05),
+                low=price2quotation(c - 0.05),
+                close=price2quotation(c),
+                volume=int(t // (60 * NS) % 1000),
+                time=ns2timestamp(t),
+                is_complete=t + step_ns <= now_ns,
+            )
+            for t, c in zip(ts.tolist(), closes.tolist())
+        ])
+
+
+class FakeInstrumentsService(_FakeService, instruments_pb2_grpc.InstrumentsServiceServicer):
+    """ The only instrument is a share, `InstrumentCache` loads it with Shares and Futures """
+    async def GetInstrumentBy(self, request, context):
+        await self._handle('GetInstrumentBy', context)
+        return instruments_pb2.InstrumentResponse(instrument=instruments_pb2.Instrument(
+            instrument_type='share', **self._instrument_fields()
+        ))
+
+    async def Shares(self, request, context):
+        await self._handle('Shares', context)
+        return instruments_pb2.SharesResponse(instruments=[instruments_pb2.Share(**self._instrument_fields())])
+
+    async def Futures(self, request, context):
+        await self._handle('Futures', context)
+        return instruments_pb2.FuturesResponse(instruments=[])
+
+    async def FindInstrument(self, request, context):
+        await self._handle('FindInstrument', context)
+        instruments = []
+        if request.query.upper() in (FAKE_TICKER, FAKE_UID.upper()):
+            instruments.append(instruments_pb2.InstrumentShort(
+                uid=FAKE_UID, figi=FAKE_UID, ticker=FAKE_TICKER, class_code='TQBR', instrument_type='share'
+            ))
+        return instruments_pb2.FindInstrumentResponse(instruments=instruments)
+
+    def _instrument_fields(self) -> dict:
+        return dict(
+            uid=FAKE_UID,
+            figi=FAKE_UID,
+            ticker=FAKE_TICKER,
+            class_code='TQBR',
+            exchange=FAKE_EXCHANGE,
+            first_1min_candle_date=ns2timestamp(int(self.config.first_1min_candle_date.timestamp()) * NS),
+            first_1day_candle_date=ns2timestamp(int(self.config.first_1day_candle_date.timestamp()) * NS),
+        )
+
+    async def TradingSchedules(self, request, context):
+        await self._handle('TradingSchedules', context)
+
+        from_ = datetime.fromtimestamp(getattr(request, 'from').seconds, tz=TZ_UTC).date()
+        to = datetime.fromtimestamp(request.to.seconds, tz=TZ_UTC).date()
+        days = [self._trading_day(from_ + timedelta(days=i)) for i in range((to - from_).days + 1)]
+        return instruments_pb2.TradingSchedulesResponse(exchanges=[
+            instruments_pb2.TradingSchedule(exchange=request.exchange or FAKE_EXCHANGE, days=days)
+        ])
+
+    @staticmethod
+    def _trading_day(day: date) -> instruments_pb2.TradingDay:
+        midnight = int(datetime.combine(day, datetime.min.time(), tzinfo=TZ_UTC).timestamp()) * NS
+        if day.weekday() >= 5:
+            return instruments_pb2.TradingDay(date=ns2timestamp(midnight), is_trading_day=False)
+
+        return instruments_pb2.TradingDay(
+            date=ns2timestamp(midnight),
+            is_trading_day=True,
+            start_time=ns2timestamp(midnight + SESSION_START // timedelta(microseconds=1) * 1000),
+            end_time=ns2timestamp(midnight + SESSION_END // timedelta(microseconds=1) * 1000),
+        )
+
+
+@dataclass
+class FakeApi:
+    port: int
+    config: FakeApiConfig
+    stats: FakeApiStats
+
+
+@asynccontextmanager
+async def fake_api(config: FakeApiConfig | None = None) -> AsyncIterator[FakeApi]:
+    """ Serve fake services on a free local port and point `ClientPool` and `TokenManager` to them. Instruments and
+    trading calendar are cached in a temp dir meanwhile, so fake ones never get into real caches
+    """
+    config = config or FakeApiConfig()
+    stats = FakeApiStats()
+
+    server = grpc.aio.server()
+    marketdata_pb2_grpc.add_MarketDataServiceServicer_to_server(FakeMarketDataService(config, stats), server)
+    instruments_pb2_grpc.add_InstrumentsServiceServicer_to_server(FakeInstrumentsService(config, stats), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    await server.start()
+
+    target, insecure, tokens = ClientPool.TARGET, ClientPool.INSECURE, TokenManager._tokens
+    filepath_calendar, calendars = TradingCalendar.FILEPATH, TradingCalendar._calendars
+    filepath_instruments = InstrumentCache.FILEPATH
+    await ClientPool.close()
+    ClientPool.TARGET, ClientPool.INSECURE = f'127.0.0.1:{port}', True
+    TokenManager._tokens = [f'fake-token-{i}' for i in range(config.tokens)]
+    with tempfile.TemporaryDirectory() as dir_:
+        TradingCalendar.FILEPATH, TradingCalendar._calendars = Path(dir_) / 'trading_calendar.pickle', None
+        InstrumentCache.FILEPATH = Path(dir_) / 'instruments.pickle'
+        InstrumentCache._index([], updated=None)
+        try:
+            yield FakeApi(port=port, config=config, stats=stats)
+        finally:
+            await ClientPool.close()
+            ClientPool.TARGET, ClientPool.INSECURE, TokenManager._tokens = target, insecure, tokens
+            TradingCalendar.FILEPATH, TradingCalendar._calendars = filepath_calendar, calendars
+            InstrumentCache.FILEPATH = filepath_instruments
+            InstrumentCache._index([], updated=None)
+            await server.stop(None)
@@ -0,0 +1,178 @@
+""" Candle pipeline benchmarks against the local fake API. Results are written to a json file, one per run,
+so runs on the same machine can be compared over time.
+
+    python -m benchmarks.run --days 20 --latency 0.005 --exhaust-every 100
+"""
+import argparse
+import asyncio
+import json
+import platform
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from tinkoff.invest import CandleInterval, HistoricCandle, InstrumentIdType, Quotation
+
+from benchmarks.fake_server import FAKE_UID, FakeApiConfig, fake_api, generate_ts, get_price
+from my_tinkoff.api_calls.instruments import get_instrument_by
+from my_tinkoff.api_calls.market_data import get_candles
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.helpers import convert_candle, convert_candles
+
+DIR_RESULTS = Path(__file__).parent / 'results'
+INTERVAL = CandleInterval.CANDLE_INTERVAL_1_MIN
+TO = datetime(2024, 6, 1, tzinfo=TZ_UTC)
+
+
+@dataclass
+class Result:
+    name: str
+    seconds: float
+    count: int
+
+    @property
+    def per_second(self) -> float:
+        return self.count / self.seconds if self.seconds else 0.
+
+    def to_dict(self) -> dict:
+        return asdict(self) | {'per_second': self.per_second}
+
+
+async def measure(name: str, f: Callable[[], Awaitable[int]], repeat: int = 1) -> Result:
+    """ Best of `repeat` runs. `f` returns count of processed items """
+    timings, count = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = await f()
+        timings.append(time.perf_counter() - start)
+    result = Result(name=name, seconds=min(timings), count=count)
+    print(f'{name:<32} | {result.seconds:8.3f}s | count={count} | {result.per_second:,.0f}/s')
+    return result
+
+
+def get_storage(filepath: Path) -> type[CSVCandles]:
+    return type('Storage', (CSVCandles,), {'filepath': filepath})
+
+
+async def bench_get_candles(from_: datetime, to: datetime, max_in_flight: int) -> list[Result]:
+    async def _get(n: int) -> int:
+        return len(await get_candles(instrument_id=FAKE_UID, from_=from_, to=to, interval=INTERVAL, max_in_flight=n))
+
+    return [
+        await measure('get_candles.sequential', lambda: _get(1)),
+        await measure(f'get_candles.concurrent_{max_in_flight}', lambda: _get(max_in_flight)),
+    ]
+
+
+async def bench_download_or_read(dir_: Path, from_: datetime, to: datetime) -> list[Result]:
+    instrument = await get_instrument_by(id=FAKE_UID, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+    middle = from_ + (to - from_) / 2
+    results = []
+
+    async def _read(storage: type[CSVCandles], from_temp: datetime = from_, to_temp: datetime = to) -> int:
+        return len(await storage.download_or_read(instrument=instrument, from_=from_temp, to=to_temp,
+                                                  interval=INTERVAL))
+
+    CandleRangeCache.ENABLED = False
+    storage = get_storage(dir_ / 'cold.csv')
+    results.append(await measure('download_or_read.cold', lambda: _read(storage)))
+    results.append(await measure('download_or_read.warm', lambda: _read(storage), repeat=3))
+
+    CandleRangeCache.ENABLED = True
+    CandleRangeCache.clear()
+    await _read(storage)
+    results.append(await measure('download_or_read.warm_cached', lambda: _read(storage), repeat=3))
+    CandleRangeCache.ENABLED = False
+
+    storage = get_storage(dir_ / 'append.csv')
+    await _read(storage, to_temp=middle)
+    results.append(await measure('download_or_read.append', lambda: _read(storage)))
+
+    storage = get_storage(dir_ / 'insert.csv')
+    await _read(storage, from_temp=middle)
+    results.append(await measure('download_or_read.insert', lambda: _read(storage)))
+    return results
+
+
+async def bench_csv(dir_: Path, from_: datetime, to: datetime) -> list[Result]:
+    storage = get_storage(dir_ / 'cold.csv')
+    candles = await storage(instrument_id=FAKE_UID, interval=INTERVAL)._read(from_=from_, to=to, interval=INTERVAL)
+    lines = [CSVCandles.candle2line(c) for c in candles]
+
+    async def _write() -> int:
+        return len([CSVCandles.candle2line(c) for c in candles])
+
+    async def _parse() -> int:
+        return len([CSVCandles.line2candle(line) for line in lines])
+
+    return [
+        await measure('csv.write', _write, repeat=3),
+        await measure('csv.parse', _parse, repeat=3),
+    ]
+
+
+async def bench_convert(from_: datetime, to: datetime) -> list[Result]:
+    ts = generate_ts(int(from_.timestamp()) * 10 ** 9, int(to.timestamp()) * 10 ** 9, 60 * 10 ** 9)
+    candles = []
+    for t, price in zip(ts.tolist(), get_price(ts).tolist()):
+        quotation = Quotation(units=int(price), nano=round((price - int(price)) * 10 ** 9))
+        candles.append(HistoricCandle(open=quotation, high=quotation, low=quotation, close=quotation, volume=1,
+                                      time=datetime.fromtimestamp(t / 10 ** 9, tz=TZ_UTC), is_complete=True))
+
+    async def _convert_candle() -> int:
+        return len([convert_candle(c) for c in candles])
+
+    async def _convert_candles() -> int:
+        return len(convert_candles(candles))
+
+    return [
+        await measure('convert_candle', _convert_candle, repeat=3),
+        await measure('convert_candles', _convert_candles, repeat=3),
+    ]
+
+
+async def main(args: argparse.Namespace) -> Path:
+    config = FakeApiConfig(latency=args.latency, exhaust_every=args.exhaust_every, tokens=args.tokens)
+    from_, to = TO - timedelta(days=args.days), TO
+    results = []
+
+    with tempfile.TemporaryDirectory() as dir_:
+        dir_ = Path(dir_)
+        async with fake_api(config) as api:
+            results += await bench_get_candles(from_, to, max_in_flight=args.max_in_flight)
+            results += await bench_download_or_read(dir_, from_, to)
+            results += await bench_csv(dir_, from_, to)
+            results += await bench_convert(from_, to)
+
+    output = args.output or DIR_RESULTS / f'{datetime.now(tz=TZ_UTC):%Y%m%dT%H%M%SZ}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        'created': datetime.now(tz=TZ_UTC).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'days': args.days,
+        'config': asdict(config) | {
+            'first_1min_candle_date': config.first_1min_candle_date.isoformat(),
+            'first_1day_candle_date': config.first_1day_candle_date.isoformat(),
+        },
+        'server': asdict(api.stats),
+        'results': [r.to_dict() for r in results],
+    }, indent=2))
+    print(f'Saved to {output}')
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds of every fake API response')
+    parser.add_argument('--exhaust-every', type=int, default=0, help='n-th requests fail with RESOURCE_EXHAUSTED')
+    parser.add_argument('--tokens', type=int, default=1)
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    parser.add_argument('--output', type=Path, default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -11,20 +11,52 @@ from tinkoff.invest import (
     InstrumentShort,
     InstrumentStatus,
     Future,
+    Share,
 )
 from tinkoff.invest.exceptions import AioRequestError
 
 from my_tinkoff.token_manager import token_controller
+from my_tinkoff.single_flight import coalesced
+from my_tinkoff.enums import Service
+from my_tinkoff.instrument_cache import InstrumentCache
 from my_tinkoff.schemas import Shares
 
 
-@token_controller()
-async def get_shares(client: AsyncServices = None) -> Shares:
+async def get_shares() -> Shares:
+    """ Shares of `InstrumentCache`, API is requested only when cache is stale """
+    return Shares(await InstrumentCache.get_all(Share))
+
+
+async def get_instrument_by(id: str, id_type: InstrumentIdType, class_code: str = '') -> Instrument:
+    """ Instrument of `InstrumentCache`. API is requested only for instruments which are not cached yet """
+    return await InstrumentCache.get(id=id, id_type=id_type, class_code=class_code)
+
+
+async def find_instrument(
+        query: str,
+        instrument_kind: InstrumentType | None = None,
+        api_trade_available_flag: bool | None = None,
+) -> list[InstrumentShort]:
+    """ Search results are cached by `InstrumentCache` until its next refresh """
+    return await InstrumentCache.find(query=query, instrument_kind=instrument_kind,
+                                      api_trade_available_flag=api_trade_available_flag)
+
+
+async def get_futures(instrument_status: InstrumentStatus = InstrumentStatus(0)) -> list[Future]:
+    """ Futures of `InstrumentCache`, other statuses than the default one are requested from API """
+    if instrument_status != InstrumentStatus(0):
+        return await fetch_futures(instrument_status=instrument_status)
+    return await InstrumentCache.get_all(Future)
+
+
+@token_controller(service=Service.INSTRUMENTS)
+async def fetch_shares(client: AsyncServices = None) -> Shares:
     return Shares((await client.instruments.shares()).instruments)
 
 
-@token_controller(single_response=True)
-async def get_instrument_by(
+@coalesced
+@token_controller(single_response=True, service=Service.INSTRUMENTS)
+async def fetch_instrument_by(
         id: str,
         id_type: InstrumentIdType,
         class_code: str = '',
@@ -37,13 +69,14 @@ async def get_instrument_by(
         raise ex
 
 
-@token_controller()
+@token_controller(service=Service.INSTRUMENTS)
 async def get_dividends(instrument_id: str, from_: datetime,
                         to: datetime, client: AsyncServices = None) -> list[Dividend]:
     return (await client.instruments.get_dividends(instrument_id=instrument_id, from_=from_, to=to)).dividends
 
 
-@token_controller(single_response=True)
+@coalesced
+@token_controller(single_response=True, service=Service.INSTRUMENTS)
 async def get_trading_schedules(
         exchange: str = '',
         from_: datetime | None = None,
@@ -53,8 +86,8 @@ async def get_trading_schedules(
     return (await client.instruments.trading_schedules(exchange=exchange, from_=from_, to=to)).exchanges
 
 
-@token_controller(single_response=True)
-async def find_instrument(
+@token_controller(single_response=True, service=Service.INSTRUMENTS)
+async def fetch_find_instrument(
         query: str,
         instrument_kind: InstrumentType | None = None,
         api_trade_available_flag: bool | None = None,
@@ -64,7 +97,8 @@ async def find_instrument(
                                                      api_trade_available_flag=api_trade_available_flag)).instruments
 
 
-@token_controller(single_response=True)
+@coalesced
+@token_controller(single_response=True, service=Service.INSTRUMENTS)
 async def get_future_by(
         id: str,
         id_type: InstrumentIdType | None = None,
@@ -74,8 +108,8 @@ async def get_future_by(
     return (await client.instruments.future_by(id=id, id_type=id_type, class_code=class_code)).instrument
 
 
-@token_controller(single_response=True)
-async def get_futures(
+@token_controller(single_response=True, service=Service.INSTRUMENTS)
+async def fetch_futures(
         instrument_status: InstrumentStatus = InstrumentStatus(0),
         client: AsyncServices = None
 ) -> list[Future]:
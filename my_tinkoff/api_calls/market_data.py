@@ -1,5 +1,7 @@
+import asyncio
 import logging
 from datetime import datetime, timedelta
+from typing import AsyncIterator
 
 from tinkoff.invest.async_services import AsyncServices
 from tinkoff.invest.exceptions import AioRequestError
@@ -9,46 +11,82 @@ from tinkoff.invest import (
 )
 from grpc import StatusCode
 
-from my_tinkoff.token_manager import token_controller
-from my_tinkoff.helpers import convert_candle, get_delta_by_interval
-from my_tinkoff.exceptions import ResourceExhausted
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.token_manager import token_controller, get_ratelimit_reset
+from my_tinkoff.helpers import convert_candles, get_delta_by_interval, split_datetime_range
+from my_tinkoff.instrumentation import SIZE_BUCKETS, Instrumentation
+from my_tinkoff.exceptions import ResourceExhausted, Unavailable
 from my_tinkoff.schemas import Candles
+from my_tinkoff.single_flight import SingleFlight, coalesced
 
 
-@token_controller()
 async def get_candles(
+        instrument_id: str,
+        from_: datetime,
+        to: datetime,
+        interval: CandleInterval,
+        delta: timedelta = None,
+        max_in_flight: int = 1,
+        columnar: bool = False,
+) -> Candles | ColumnarCandles:
+    """ `max_in_flight` > 1 splits range into `delta` windows up front and fetches up to `max_in_flight` of them
+    concurrently. Window which hit `ResourceExhausted` is retried alone with another token.
+
+    With `SingleFlight.CANDLE_WINDOWS` windows are fetched one by one the same way even if `max_in_flight` is 1, so parts
+    of the range which other tasks are already fetching for the same instrument are not requested again.
+
+    Chunks stay columnar until the end and are converted to `Candles` once, unless `columnar` is set.
+    """
+    with Instrumentation.span('get_candles', interval=interval.name):
+        if max_in_flight > 1 or SingleFlight.CANDLE_WINDOWS:
+            candles = await _get_candles_concurrently(instrument_id=instrument_id, from_=from_, to=to,
+                                                      interval=interval, delta=delta, max_in_flight=max_in_flight)
+        else:
+            candles = await _get_candles_sequentially(instrument_id=instrument_id, from_=from_, to=to,
+                                                      interval=interval, delta=delta)
+
+    if Instrumentation.ENABLED:
+        Instrumentation.observe('get_candles_candles', len(candles), buckets=SIZE_BUCKETS, interval=interval.name)
+    return candles if columnar else candles.to_candles()
+
+
+@token_controller()
+async def _get_candles_sequentially(
         instrument_id: str,
         from_: datetime,
         to: datetime,
         interval: CandleInterval,
         delta: timedelta = None,
         client: AsyncServices = None
-) -> Candles:
+) -> ColumnarCandles:
     if delta is None:
         delta = get_delta_by_interval(interval)
 
-    candles = Candles()
+    chunks = []
     while True:
         to_temp = from_ + delta
         if to_temp > to:
             to_temp = to
 
-        logging.debug(f'{len(candles)=} | from_={from_} | to_temp={to_temp} | to={to}')
+        logging.debug(f'{len(chunks)=} | from_={from_} | to_temp={to_temp} | to={to}')
 
         try:
             r = await client.market_data.get_candles(
                 instrument_id=instrument_id, interval=interval,
                 from_=from_, to=to_temp
             )
-            if candles and r.candles and r.candles[0].time == candles[-1].dt:
-                r.candles = r.candles[1:]
-            candles += [convert_candle(candle) for candle in r.candles if candle.time <= to_temp]
+            if Instrumentation.ENABLED:
+                Instrumentation.observe('response_candles', len(r.candles), buckets=SIZE_BUCKETS)
+            chunk = convert_candles(r.candles).until(to_temp)
+            if chunks:
+                chunk = chunk[chunk.ts > chunks[-1].ts[-1]]
+            if len(chunk):
+                chunks.append(chunk)
         except AioRequestError as ex:
             if ex.code == StatusCode.RESOURCE_EXHAUSTED:
-                raise ResourceExhausted(candles)
+                raise ResourceExhausted(ColumnarCandles.concat(chunks), reset=get_ratelimit_reset(ex))
             elif ex.code == StatusCode.UNAVAILABLE:
-                logging.warning(ex, exc_info=True)
-                continue
+                raise Unavailable(ColumnarCandles.concat(chunks))
             else:
                 raise ex
         except Exception as ex:
@@ -56,9 +94,79 @@ async def get_candles(
 
         from_ = to_temp
         if from_ >= to:
-            return candles
+            return ColumnarCandles.concat(chunks)
+
+
+async def _get_candles_concurrently(
+        instrument_id: str,
+        from_: datetime,
+        to: datetime,
+        interval: CandleInterval,
+        delta: timedelta | None,
+        max_in_flight: int,
+) -> ColumnarCandles:
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def _get_window(from_temp: datetime, to_temp: datetime) -> Candles:
+        async with semaphore:
+            return await SingleFlight.get_candles(instrument_id=instrument_id, from_=from_temp, to=to_temp,
+                                                  interval=interval, fetch=_get_candles_window)
+
+    windows = split_datetime_range(from_=from_, to=to, delta=delta or get_delta_by_interval(interval))
+    logging.debug(f'{len(windows)=} | {max_in_flight=} | from_={from_} | to={to}')
+
+    chunks = []
+    for chunk in await asyncio.gather(*[_get_window(*w) for w in windows]):
+        if chunks:
+            chunk = chunk[chunk.ts > chunks[-1].ts[-1]]
+        if len(chunk):
+            chunks.append(chunk)
+    return ColumnarCandles.concat(chunks)
+
+
+async def iter_candles(
+        instrument_id: str,
+        from_: datetime,
+        to: datetime,
+        interval: CandleInterval,
+        delta: timedelta = None,
+        columnar: bool = False,
+) -> AsyncIterator[Candles | ColumnarCandles]:
+    """ Same candles as `get_candles`, yielded window by window as they are received """
+    ts_last = None
+    for from_temp, to_temp in split_datetime_range(from_=from_, to=to, delta=delta or get_delta_by_interval(interval)):
+        chunk = await SingleFlight.get_candles(instrument_id=instrument_id, from_=from_temp, to=to_temp,
+                                               interval=interval, fetch=_get_candles_window)
+        if ts_last is not None:
+            chunk = chunk[chunk.ts > ts_last]
+        if not len(chunk):
+            continue
+
+        ts_last = chunk.ts[-1]
+        yield chunk if columnar else chunk.to_candles()
+
+
+@token_controller(single_response=True)
+async def _get_candles_window(
+        instrument_id: str,
+        from_: datetime,
+        to: datetime,
+        interval: CandleInterval,
+        client: AsyncServices = None
+) -> ColumnarCandles:
+    try:
+        r = await client.market_data.get_candles(instrument_id=instrument_id, interval=interval, from_=from_, to=to)
+    except AioRequestError as ex:
+        if ex.code == StatusCode.RESOURCE_EXHAUSTED:
+            raise ResourceExhausted(reset=get_ratelimit_reset(ex))
+        raise ex
+
+    if Instrumentation.ENABLED:
+        Instrumentation.observe('response_candles', len(r.candles), buckets=SIZE_BUCKETS)
+    return convert_candles(r.candles).until(to)
 
 
+@coalesced
 @token_controller(single_response=True)
 async def get_trading_status(instrument_id: str, client: AsyncServices = None) -> GetTradingStatusResponse:
     return await client.market_data.get_trading_status(instrument_id=instrument_id)
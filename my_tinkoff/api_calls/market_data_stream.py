@@ -1,68 +1,460 @@
 import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator
 
 from tinkoff.invest import (
+    CandleInterval,
     CandleInstrument,
+    OrderBookInstrument,
+    TradeInstrument,
+    LastPriceInstrument,
 
     MarketDataRequest,
+    MarketDataResponse,
     SubscriptionAction,
     SubscriptionInterval,
+    SubscriptionStatus,
+    TradeDirection,
 
     SubscribeCandlesRequest,
     SubscribeOrderBookRequest,
     SubscribeTradesRequest,
-    SubscribeInfoRequest,
     SubscribeLastPriceRequest,
-    GetMySubscriptions,
 )
-from tinkoff.invest.async_services import AsyncServices
-
-from my_tinkoff.token_manager import token_controller
-
-
-async def _request_iterator(
-        subscribe_candles_request: SubscribeCandlesRequest = None,
-        subscribe_order_book_request: SubscribeOrderBookRequest = None,
-        subscribe_trades_request: SubscribeTradesRequest = None,
-        subscribe_info_request: SubscribeInfoRequest = None,
-        subscribe_last_price_request: SubscribeLastPriceRequest = None,
-        get_my_subscriptions: GetMySubscriptions = None
-):
-    yield MarketDataRequest(
-        subscribe_candles_request=subscribe_candles_request,
-        subscribe_order_book_request=subscribe_order_book_request,
-        subscribe_trades_request=subscribe_trades_request,
-        subscribe_info_request=subscribe_info_request,
-        subscribe_last_price_request=subscribe_last_price_request,
-        get_my_subscriptions=get_my_subscriptions
-    )
+from tinkoff.invest import Candle as TinkoffCandle
+
+from my_tinkoff.api_calls.market_data import get_candles
+from my_tinkoff.client_pool import ClientPool
+from my_tinkoff.date_utils import DateTimeFactory
+from my_tinkoff.enums import StreamKind, Overflow
+from my_tinkoff.helpers import quotation2decimal
+from my_tinkoff.schemas import Candle
+from my_tinkoff.token_manager import TokenManager
+
+MAX_SUBSCRIPTIONS_PER_STREAM = 300
+MAX_STREAMS_PER_TOKEN = 16
+RECONNECT_BACKOFF_BASE = 1.
+RECONNECT_BACKOFF_MAX = 60.
+
+SUBSCRIPTION_INTERVAL_TO_CANDLE_INTERVAL = {
+    SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE: CandleInterval.CANDLE_INTERVAL_1_MIN,
+    SubscriptionInterval.SUBSCRIPTION_INTERVAL_FIVE_MINUTES: CandleInterval.CANDLE_INTERVAL_5_MIN,
+    SubscriptionInterval.SUBSCRIPTION_INTERVAL_FIFTEEN_MINUTES: CandleInterval.CANDLE_INTERVAL_15_MIN,
+    SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_HOUR: CandleInterval.CANDLE_INTERVAL_HOUR,
+    SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_DAY: CandleInterval.CANDLE_INTERVAL_DAY,
+}
+
+
+@dataclass
+class StreamMetrics:
+    disconnects: int = 0
+    reconnects: int = 0
+    reconnect_latency_last: float = 0.
+    reconnect_latency_max: float = 0.
+    reconnect_latency_total: float = 0.
+    backfilled_candles: int = 0
+
+
+@dataclass(frozen=True)
+class Subscription:
+    kind: StreamKind
+    instrument_uid: str
+    interval: SubscriptionInterval | None = None
+    depth: int | None = None
+
+
+@dataclass(frozen=True)
+class StreamCandle:
+    instrument_uid: str
+    interval: SubscriptionInterval
+    candle: Candle
+
 
-    while True:
-        await asyncio.sleep(1)
+@dataclass(frozen=True)
+class StreamTrade:
+    instrument_uid: str
+    direction: TradeDirection
+    price: float
+    quantity: int
+    dt: datetime
 
 
-@token_controller
-async def trade_instrument(request_iterator, client: AsyncServices = None):
-    async for marketdata in client.market_data_stream.market_data_stream(
-            request_iterator
+@dataclass(frozen=True)
+class StreamOrderBook:
+    instrument_uid: str
+    depth: int
+    is_consistent: bool
+    bids: list[tuple[float, int]]
+    asks: list[tuple[float, int]]
+    dt: datetime
+
+
+@dataclass(frozen=True)
+class StreamLastPrice:
+    instrument_uid: str
+    price: float
+    dt: datetime
+
+
+StreamEvent = StreamCandle | StreamTrade | StreamOrderBook | StreamLastPrice
+
+
+class StreamConsumer:
+    """ Bounded queue of events. `Overflow.BLOCK` stops reading of the stream until consumer catches up,
+    `DROP_OLDEST`/`DROP_NEWEST` keep the stream going and count dropped events.
+    """
+
+    def __init__(
+            self,
+            maxsize: int,
+            overflow: Overflow,
+            kinds: set[StreamKind] | None = None,
+            instrument_uids: set[str] | None = None
     ):
-        print(marketdata)
-
-
-async def test():
-    await trade_instrument(
-        _request_iterator(
-            subscribe_candles_request=SubscribeCandlesRequest(
-                subscription_action=SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE,
-                instruments=[
-                    CandleInstrument(
-                        figi='BBG004730N88',
-                        interval=SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE,
-                    )
-                ]
-            )
-        )
+        self.queue: asyncio.Queue[StreamEvent] = asyncio.Queue(maxsize=maxsize)
+        self.overflow = overflow
+        self.kinds = kinds
+        self.instrument_uids = instrument_uids
+        self.dropped = 0
+
+    def accepts(self, kind: StreamKind, event: StreamEvent) -> bool:
+        return ((self.kinds is None or kind in self.kinds) and
+                (self.instrument_uids is None or event.instrument_uid in self.instrument_uids))
+
+    async def put(self, event: StreamEvent) -> None:
+        if self.overflow == Overflow.BLOCK:
+            await self.queue.put(event)
+            return
+
+        if self.queue.full():
+            self.dropped += 1
+            if self.overflow == Overflow.DROP_NEWEST:
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self) -> StreamEvent:
+        return await self.queue.get()
+
+    def __aiter__(self) -> AsyncIterator[StreamEvent]:
+        return self
+
+    async def __anext__(self) -> StreamEvent:
+        return await self.get()
+
+
+class _Stream:
+    def __init__(self, manager: 'MarketDataStreamManager', token: str):
+        self.manager = manager
+        self.token = token
+        self.subscriptions: set[Subscription] = set()
+        self.requests: asyncio.Queue[MarketDataRequest] = asyncio.Queue()
+        self.backfills: set[asyncio.Task] = set()
+        self.task = asyncio.create_task(self.run())
+
+    @property
+    def capacity(self) -> int:
+        return MAX_SUBSCRIPTIONS_PER_STREAM - len(self.subscriptions)
+
+    def send(self, action: SubscriptionAction, subscriptions: list[Subscription]) -> None:
+        if action == SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE:
+            self.subscriptions.update(subscriptions)
+        else:
+            self.subscriptions.difference_update(subscriptions)
+
+        for request in build_requests(action, subscriptions):
+            self.requests.put_nowait(request)
+
+    async def run(self) -> None:
+        """ Reconnects with jittered exponential backoff, resubscribes and backfills candles missed while offline.
+        Only this stream is reconnected: it is reopened over the same channel, which is replaced only if it is broken
+        """
+        metrics = self.manager.metrics
+        attempt, disconnected_at, client = 0, None, None
+
+        while True:
+            try:
+                if client is None or not ClientPool.is_current(self.token, client):
+                    client = await ClientPool.get(self.token)
+                if disconnected_at is not None:
+                    self.requests = asyncio.Queue()
+                    self.send(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, list(self.subscriptions))
+
+                async for response in client.market_data_stream.market_data_stream(
+                        self._iterate_requests(self.requests)):
+                    if disconnected_at is not None:
+                        latency = time.monotonic() - disconnected_at
+                        metrics.reconnects += 1
+                        metrics.reconnect_latency_last = latency
+                        metrics.reconnect_latency_max = max(metrics.reconnect_latency_max, latency)
+                        metrics.reconnect_latency_total += latency
+                        logging.info(f'Stream reconnected | {latency=:.3f}s | subscriptions={len(self.subscriptions)}')
+
+                        attempt, disconnected_at = 0, None
+                        self._start_backfill()
+
+                    await self.manager.dispatch(response)
+
+                logging.warning(f'Stream closed by server | subscriptions={len(self.subscriptions)}')
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.warning(f'Stream disconnected | {attempt=} | {ex!r}')
+
+            if disconnected_at is None:
+                disconnected_at = time.monotonic()
+                metrics.disconnects += 1
+
+            if client is not None and await ClientPool.reconnect(self.token, client):
+                client = None
+            await asyncio.sleep(min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_BASE * 2 ** attempt) *
+                                random.uniform(0.5, 1.5))
+            attempt += 1
+
+    async def close(self) -> None:
+        for task in [self.task, *self.backfills]:
+            task.cancel()
+        for task in [self.task, *self.backfills]:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _start_backfill(self) -> None:
+        """ Range of every candle subscription is fixed now, candles are fetched while the stream goes on """
+        to = DateTimeFactory.now()
+        ranges = [
+            (s, self.manager.last_candle_dt[(s.instrument_uid, s.interval)], to) for s in self.subscriptions
+            if s.kind == StreamKind.CANDLE and (s.instrument_uid, s.interval) in self.manager.last_candle_dt
+        ]
+        if ranges:
+            task = asyncio.create_task(self._backfill(ranges))
+            self.backfills.add(task)
+            task.add_done_callback(self.backfills.discard)
+
+    async def _backfill(self, ranges: list[tuple[Subscription, datetime, datetime]]) -> None:
+        for s, from_, to in ranges:
+            interval = SUBSCRIPTION_INTERVAL_TO_CANDLE_INTERVAL.get(s.interval)
+            if interval is None:
+                continue
+
+            try:
+                candles = await get_candles(instrument_id=s.instrument_uid, from_=from_, to=to, interval=interval)
+            except Exception as ex:
+                logging.error(f'Backfill failed | uid={s.instrument_uid} | {from_=} | {to=} | {ex!r}')
+                continue
+
+            for candle in candles:
+                await self.manager.dispatch_candle(
+                    StreamCandle(instrument_uid=s.instrument_uid, interval=s.interval, candle=candle), backfill=True
+                )
+            self.manager.metrics.backfilled_candles += len(candles)
+            logging.debug(f'Backfilled {len(candles)} candles | uid={s.instrument_uid} | {from_=} | {to=}')
+
+    @staticmethod
+    async def _iterate_requests(requests: asyncio.Queue[MarketDataRequest]) -> AsyncIterator[MarketDataRequest]:
+        while True:
+            yield await requests.get()
+
+
+class MarketDataStreamManager:
+    """ Candles, order books, trades and last prices of any count of instruments over as few streams as possible.
+    Subscriptions are spread over streams by `MAX_SUBSCRIPTIONS_PER_STREAM` and over tokens by `MAX_STREAMS_PER_TOKEN`.
+    """
+
+    def __init__(self):
+        self._streams: list[_Stream] = []
+        self._consumers: list[StreamConsumer] = []
+        self.last_candle_dt: dict[tuple[str, SubscriptionInterval], datetime] = {}
+        self.metrics = StreamMetrics()
+
+    def consumer(
+            self,
+            maxsize: int = 10_000,
+            overflow: Overflow = Overflow.BLOCK,
+            kinds: set[StreamKind] | None = None,
+            instrument_uids: set[str] | None = None,
+    ) -> StreamConsumer:
+        consumer = StreamConsumer(maxsize=maxsize, overflow=overflow, kinds=kinds, instrument_uids=instrument_uids)
+        self._consumers.append(consumer)
+        return consumer
+
+    def remove_consumer(self, consumer: StreamConsumer) -> None:
+        self._consumers.remove(consumer)
+
+    def subscribe_candles(
+            self,
+            instrument_uids: list[str],
+            interval: SubscriptionInterval = SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE
+    ) -> None:
+        self.subscribe([Subscription(StreamKind.CANDLE, uid, interval=interval) for uid in instrument_uids])
+
+    def subscribe_order_book(self, instrument_uids: list[str], depth: int = 10) -> None:
+        self.subscribe([Subscription(StreamKind.ORDER_BOOK, uid, depth=depth) for uid in instrument_uids])
+
+    def subscribe_trades(self, instrument_uids: list[str]) -> None:
+        self.subscribe([Subscription(StreamKind.TRADE, uid) for uid in instrument_uids])
+
+    def subscribe_last_price(self, instrument_uids: list[str]) -> None:
+        self.subscribe([Subscription(StreamKind.LAST_PRICE, uid) for uid in instrument_uids])
+
+    def subscribe(self, subscriptions: list[Subscription]) -> None:
+        subscriptions = [s for s in dict.fromkeys(subscriptions) if not self._find_stream(s)]
+
+        for stream in self._streams:
+            if subscriptions and stream.capacity > 0:
+                part, subscriptions = subscriptions[:stream.capacity], subscriptions[stream.capacity:]
+                stream.send(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, part)
+
+        while subscriptions:
+            stream = self._open_stream()
+            part, subscriptions = subscriptions[:stream.capacity], subscriptions[stream.capacity:]
+            stream.send(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, part)
+
+    def unsubscribe(self, subscriptions: list[Subscription]) -> None:
+        by_stream = defaultdict(list)
+        for subscription in subscriptions:
+            if stream := self._find_stream(subscription):
+                by_stream[stream].append(subscription)
+
+        for stream, part in by_stream.items():
+            stream.send(SubscriptionAction.SUBSCRIPTION_ACTION_UNSUBSCRIBE, part)
+
+    @property
+    def subscriptions(self) -> set[Subscription]:
+        return set().union(*[s.subscriptions for s in self._streams])
+
+    async def close(self) -> None:
+        for stream in self._streams:
+            await stream.close()
+        self._streams.clear()
+
+    async def dispatch(self, response: MarketDataResponse) -> None:
+        converted = convert_response(response)
+        if converted is None:
+            log_subscription_errors(response)
+            return
+
+        kind, event = converted
+        if kind == StreamKind.CANDLE:
+            await self.dispatch_candle(event)
+        else:
+            await self._put(kind, event)
+
+    async def dispatch_candle(self, event: StreamCandle, backfill: bool = False) -> None:
+        """ Candles older than the last one delivered for the same instrument and interval are dropped. Backfilled
+        ones are missed candles, they are delivered even after newer candles which the stream sent since reconnect
+        """
+        key = (event.instrument_uid, event.interval)
+        if key in self.last_candle_dt and event.candle.dt < self.last_candle_dt[key]:
+            if backfill:
+                await self._put(StreamKind.CANDLE, event)
+            return
+        self.last_candle_dt[key] = event.candle.dt
+        await self._put(StreamKind.CANDLE, event)
+
+    async def _put(self, kind: StreamKind, event: StreamEvent) -> None:
+        for consumer in self._consumers:
+            if consumer.accepts(kind, event):
+                await consumer.put(event)
+
+    def _find_stream(self, subscription: Subscription) -> _Stream | None:
+        for stream in self._streams:
+            if subscription in stream.subscriptions:
+                return stream
+
+    def _open_stream(self) -> _Stream:
+        streams_by_token = {t: 0 for t in TokenManager.list_all()}
+        for stream in self._streams:
+            streams_by_token[stream.token] += 1
+
+        token, count = min(streams_by_token.items(), key=lambda x: x[1])
+        if count >= MAX_STREAMS_PER_TOKEN:
+            raise RuntimeError(f'All tokens have {MAX_STREAMS_PER_TOKEN} streams opened')
+
+        stream = _Stream(manager=self, token=token)
+        self._streams.append(stream)
+        logging.debug(f'Stream opened | streams={len(self._streams)}')
+        return stream
+
+
+def build_requests(action: SubscriptionAction, subscriptions: list[Subscription]) -> list[MarketDataRequest]:
+    by_kind = defaultdict(list)
+    for s in subscriptions:
+        by_kind[s.kind].append(s)
+
+    requests = []
+    if candles := by_kind[StreamKind.CANDLE]:
+        requests.append(MarketDataRequest(subscribe_candles_request=SubscribeCandlesRequest(
+            subscription_action=action,
+            instruments=[CandleInstrument(instrument_id=s.instrument_uid, interval=s.interval) for s in candles],
+        )))
+    if order_books := by_kind[StreamKind.ORDER_BOOK]:
+        requests.append(MarketDataRequest(subscribe_order_book_request=SubscribeOrderBookRequest(
+            subscription_action=action,
+            instruments=[OrderBookInstrument(instrument_id=s.instrument_uid, depth=s.depth) for s in order_books],
+        )))
+    if trades := by_kind[StreamKind.TRADE]:
+        requests.append(MarketDataRequest(subscribe_trades_request=SubscribeTradesRequest(
+            subscription_action=action,
+            instruments=[TradeInstrument(instrument_id=s.instrument_uid) for s in trades],
+        )))
+    if last_prices := by_kind[StreamKind.LAST_PRICE]:
+        requests.append(MarketDataRequest(subscribe_last_price_request=SubscribeLastPriceRequest(
+            subscription_action=action,
+            instruments=[LastPriceInstrument(instrument_id=s.instrument_uid) for s in last_prices],
+        )))
+    return requests
+
+
+def convert_stream_candle(candle: TinkoffCandle) -> Candle:
+    return Candle(
+        open=quotation2decimal(candle.open),
+        high=quotation2decimal(candle.high),
+        low=quotation2decimal(candle.low),
+        close=quotation2decimal(candle.close),
+        volume=candle.volume,
+        dt=candle.time,
+        is_complete=False
     )
-    # await get_my_subscriptions()
 
-if __name__ == '__main__':
-    asyncio.run(test())
+
+def convert_response(response: MarketDataResponse) -> tuple[StreamKind, StreamEvent] | None:
+    if c := response.candle:
+        return StreamKind.CANDLE, StreamCandle(
+            instrument_uid=c.instrument_uid, interval=c.interval, candle=convert_stream_candle(c)
+        )
+    if t := response.trade:
+        return StreamKind.TRADE, StreamTrade(
+            instrument_uid=t.instrument_uid, direction=t.direction, price=quotation2decimal(t.price),
+            quantity=t.quantity, dt=t.time
+        )
+    if ob := response.orderbook:
+        return StreamKind.ORDER_BOOK, StreamOrderBook(
+            instrument_uid=ob.instrument_uid, depth=ob.depth, is_consistent=ob.is_consistent,
+            bids=[(quotation2decimal(o.price), o.quantity) for o in ob.bids],
+            asks=[(quotation2decimal(o.price), o.quantity) for o in ob.asks],
+            dt=ob.time
+        )
+    if lp := response.last_price:
+        return StreamKind.LAST_PRICE, StreamLastPrice(
+            instrument_uid=lp.instrument_uid, price=quotation2decimal(lp.price), dt=lp.time
+        )
+
+
+def log_subscription_errors(response: MarketDataResponse) -> None:
+    for name, field in (
+            ('subscribe_candles_response', 'candles_subscriptions'),
+            ('subscribe_order_book_response', 'order_book_subscriptions'),
+            ('subscribe_trades_response', 'trade_subscriptions'),
+            ('subscribe_last_price_response', 'last_price_subscriptions'),
+    ):
+        if r := getattr(response, name):
+            for s in getattr(r, field):
+                if s.subscription_status != SubscriptionStatus.SUBSCRIPTION_STATUS_SUCCESS:
+                    logging.warning(f'{name} | {s}')
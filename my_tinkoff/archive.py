@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import struct
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import aiofiles
+import numpy as np
+
+from my_tinkoff.columnar import ColumnarCandles, dt2ns, ns2dt
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.schemas import Candle
+
+MAGIC = b'MTCA'
+VERSION = 1
+HEADER = struct.Struct('<4sHBxIqq')
+MAX_DECIMALS = 9
+PRICES = ('open', 'high', 'low', 'close')
+
+
+def get_decimals(prices: np.ndarray) -> int:
+    """ Least count of decimals which keeps every price exact """
+    for decimals in range(MAX_DECIMALS + 1):
+        scaled = prices * 10 ** decimals
+        if np.all(np.abs(scaled - np.round(scaled)) < 1e-6):
+            return decimals
+    return MAX_DECIMALS
+
+
+def encode_block(candles: ColumnarCandles) -> bytes:
+    """ Prices as fixed-point integers, timestamps and prices delta-encoded, all columns zlib compressed together """
+    decimals = get_decimals(np.concatenate([getattr(candles, f) for f in PRICES]))
+    scale = 10 ** decimals
+    columns = [np.diff(candles.ts, prepend=0)]
+    columns += [np.diff(np.round(getattr(candles, f) * scale).astype(np.int64), prepend=0) for f in PRICES]
+    columns.append(candles.volume)
+
+    header = HEADER.pack(MAGIC, VERSION, decimals, len(candles), int(candles.ts[0]), int(candles.ts[-1]))
+    return header + zlib.compress(np.stack(columns).astype('<i8').tobytes())
+
+
+def decode_block(data: bytes) -> ColumnarCandles:
+    magic, version, decimals, count, _, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Unexpected block header | {magic=} | {version=}')
+
+    columns = np.frombuffer(zlib.decompress(data[HEADER.size:]), dtype='<i8').reshape(6, count)
+    ts, open_, high, low, close = columns[:5].cumsum(axis=1)
+    scale = 10 ** decimals
+    return ColumnarCandles(
+        ts=ts,
+        open=open_ / scale,
+        high=high / scale,
+        low=low / scale,
+        close=close / scale,
+        volume=columns[5],
+        is_complete=np.ones(count, dtype=np.bool_),
+    )
+
+
+class CandleArchive:
+    """ Cold history of one candles file: a directory next to it with one compressed block per closed month.
+    Blocks hold only complete candles older than the first row of the file.
+    """
+    SUFFIX = '.archive'
+    BLOCK_SUFFIX = '.blk'
+
+    def __init__(self, filepath: Path):
+        self.dir = filepath.with_suffix(self.SUFFIX)
+
+    def exists(self) -> bool:
+        return self.dir.exists() and any(self.dir.glob(f'*{self.BLOCK_SUFFIX}'))
+
+    def months(self) -> list[str]:
+        return sorted(p.stem for p in self.dir.glob(f'*{self.BLOCK_SUFFIX}'))
+
+    def get_filepath(self, month: str) -> Path:
+        return self.dir / f'{month}{self.BLOCK_SUFFIX}'
+
+    def first_candle(self) -> Candle | None:
+        months = self.months()
+        return self.read_month(months[0])[0] if months else None
+
+    def read(self, from_: datetime, to: datetime) -> ColumnarCandles:
+        """ Candles with `from_ <= dt <= to`. Only blocks which intersect the range are decompressed """
+        ts_from, ts_to = dt2ns(from_), dt2ns(to)
+        parts = []
+        for month in self.months():
+            with open(self.get_filepath(month), 'rb') as f:
+                _, _, _, _, first_ts, last_ts = HEADER.unpack(f.read(HEADER.size))
+            if last_ts >= ts_from and first_ts <= ts_to:
+                parts.append(self.read_month(month).slice_by_dt(from_, to))
+        return ColumnarCandles.concat(parts)
+
+    def read_month(self, month: str) -> ColumnarCandles:
+        with open(self.get_filepath(month), 'rb') as f:
+            return decode_block(f.read())
+
+    def days(self) -> np.ndarray:
+        """ Sorted UTC days which have candles as `datetime64[D]` """
+        candles = ColumnarCandles.concat([self.read_month(m) for m in self.months()])
+        return np.unique(candles.ts.view('datetime64[ns]').astype('datetime64[D]'))
+
+    async def merge(self, candles: ColumnarCandles) -> None:
+        """ Write candles into blocks of their months, merging with blocks which already exist """
+        if not len(candles):
+            return
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        months = candles.ts.view('datetime64[ns]').astype('datetime64[M]')
+        for month in np.unique(months):
+            part = candles[months == month]
+            month = str(month)
+            if self.get_filepath(month).exists():
+                part = ColumnarCandles.concat([part, self.read_month(month)])
+                part = part[np.unique(part.ts, return_index=True)[1]]
+            await self._write_atomic(self.get_filepath(month), encode_block(part))
+
+    @staticmethod
+    async def _write_atomic(filepath: Path, data: bytes) -> None:
+        filepath_temp = filepath.with_suffix(filepath.suffix + '.tmp')
+        async with aiofiles.open(filepath_temp, 'wb') as f:
+            await f.write(data)
+        os.replace(filepath_temp, filepath)
+
+
+async def compact(filepath_csv: Path, keep_months: int = 1) -> int:
+    """ Move every month before the last `keep_months` months of csv file into its archive. Returns moved rows """
+    from my_tinkoff.csv_candles import CSVCandles
+
+    async with FileLock.write(filepath_csv):
+        async with aiofiles.open(filepath_csv) as f:
+            header = await f.readline()
+            lines = [line for line in await f.readlines() if line.strip()]
+        if not lines:
+            return 0
+
+        candles = ColumnarCandles.from_candles(map(CSVCandles.line2candle, lines))
+        months = candles.ts.view('datetime64[ns]').astype('datetime64[M]')
+        count = int(np.searchsorted(months, months[-1] - np.timedelta64(keep_months - 1, 'M'), side='left'))
+        if count == 0:
+            return 0
+
+        # archive is written first, so an interrupted compaction leaves duplicates which reads skip, not a hole
+        await CandleArchive(filepath_csv).merge(candles[:count])
+        await CSVCandles._write_atomic(filepath_csv, (header + ''.join(lines[count:])).encode())
+    logging.debug(f'Compacted {count} candles | {filepath_csv} | first_kept={ns2dt(candles.ts[count])}')
+    return count
+
+
+async def compact_all(dir_: Path | None = None, keep_months: int = 1) -> int:
+    from my_tinkoff.csv_candles import CSVCandles
+    return sum([await compact(p, keep_months=keep_months) for p in sorted((dir_ or CSVCandles.DIR_API).rglob('*.csv'))])
+
+
+if __name__ == '__main__':
+    asyncio.run(compact_all())
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import struct
+from pathlib import Path
+from datetime import datetime
+
+import aiofiles
+import numpy as np
+from trading_helpers.csv_candles import Interval
+
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.columnar import ColumnarCandles, dt2ns
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.schemas import Candle, Candles
+
+MAGIC = b'MTCB'
+VERSION = 1
+HEADER = struct.Struct('<4sHH8x')
+RECORD = np.dtype([
+    ('ts', '<i8'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<i8'),
+    ('is_complete', 'u1'),
+    ('_pad', 'V7'),
+])
+
+
+class BinaryCandles(CSVCandles):
+    """ Fixed-width little-endian records sorted by `ts` after a 16 bytes header. Same contract as `CSVCandles`,
+    but reads are `np.memmap` + binary search instead of text parsing.
+    """
+    SUFFIX = '.bin'
+    SEGMENT_ON_INSERT = False
+
+    @property
+    def filepath(self) -> Path:
+        return super().filepath.with_suffix(self.SUFFIX)
+
+    def read_columnar(self, from_: datetime, to: datetime) -> ColumnarCandles:
+        """ Zero-copy view on candles with `from_ <= dt <= to` """
+        records = self._memmap()
+        ts = records['ts']
+        start = np.searchsorted(ts, dt2ns(from_), side='left')
+        end = np.searchsorted(ts, dt2ns(to), side='right')
+        return self.records2columnar(records[start:end])
+
+    async def _read(self, from_: datetime, to: datetime, interval: Interval) -> Candles:
+        async with FileLock.read(self.filepath):
+            records = self._memmap()
+            if not len(records):
+                return self.CANDLES()
+            candles = self.read_columnar(from_=from_, to=to).to_candles()
+            first_candle, last_candle = self.records2columnar(records[[0, -1]])
+        self._check_range(from_=from_, to=to, first_candle=first_candle, last_candle=last_candle, candles=candles)
+        return candles
+
+    async def _prepare_new(self) -> None:
+        async with FileLock.write(self.filepath):
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            async with aiofiles.open(self.filepath, 'wb') as f:
+                await f.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize))
+
+    async def _append(self, candles: Candles) -> None:
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            async with aiofiles.open(self.filepath, 'ab') as f:
+                await f.write(self.candles2records(candles).tobytes())
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+
+    async def _insert(self, candles: Candles) -> None:
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            async with aiofiles.open(self.filepath, 'rb') as f:
+                data = await f.read()
+            await self._write_atomic(
+                self.filepath, data[:HEADER.size] + self.candles2records(candles).tobytes() + data[HEADER.size:]
+            )
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+
+    async def _merge(self, candles: Candles) -> None:
+        if not candles:
+            return
+
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            records = np.concatenate([self._memmap(), self.candles2records(candles)])
+            records = records[np.unique(records['ts'], return_index=True)[1]]
+            await self._write_atomic(self.filepath, HEADER.pack(MAGIC, VERSION, RECORD.itemsize) + records.tobytes())
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+
+    async def _days(self) -> np.ndarray:
+        async with FileLock.read(self.filepath):
+            return np.unique(self._memmap()['ts'].view('datetime64[ns]').astype('datetime64[D]'))
+
+    async def _first_candle(self) -> Candle | None:
+        async with FileLock.read(self.filepath):
+            records = self._memmap()
+            return self.records2columnar(records[:1])[0] if len(records) else None
+
+    async def _last_candle(self) -> Candle | None:
+        async with FileLock.read(self.filepath):
+            records = self._memmap()
+            return self.records2columnar(records[-1:])[0] if len(records) else None
+
+    def _repair_tail(self) -> None:
+        """ Cut a partial last record left by interrupted append. Only writers call it, readers skip the record """
+        size = self.filepath.stat().st_size
+        extra = (size - HEADER.size) % RECORD.itemsize if size > HEADER.size else 0
+        if extra:
+            os.truncate(self.filepath, size - extra)
+            logging.warning(f'Partial last record was cut | {self.filepath}')
+
+    def _is_empty(self) -> bool:
+        return self.filepath.stat().st_size < HEADER.size + RECORD.itemsize
+
+    def _memmap(self) -> np.ndarray:
+        count = (self.filepath.stat().st_size - HEADER.size) // RECORD.itemsize
+        if count <= 0:
+            return np.empty(0, dtype=RECORD)
+
+        with open(self.filepath, 'rb') as f:
+            magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.itemsize:
+            raise ValueError(f'Unexpected header | {self.filepath} | {magic=} | {version=} | {record_size=}')
+
+        return np.memmap(self.filepath, dtype=RECORD, mode='r', offset=HEADER.size, shape=(count,))
+
+    @classmethod
+    def records2columnar(cls, records: np.ndarray) -> ColumnarCandles:
+        return ColumnarCandles(
+            open=records['open'],
+            high=records['high'],
+            low=records['low'],
+            close=records['close'],
+            volume=records['volume'],
+            ts=records['ts'],
+            is_complete=records['is_complete'].view(np.bool_),
+        )
+
+    @classmethod
+    def candles2records(cls, candles: Candles | ColumnarCandles) -> np.ndarray:
+        if not isinstance(candles, ColumnarCandles):
+            candles = ColumnarCandles.from_candles(candles)
+
+        records = np.zeros(len(candles), dtype=RECORD)
+        for field in ColumnarCandles.__slots__:
+            records[field] = getattr(candles, field)
+        return records
+
+    @classmethod
+    async def from_csv(cls, filepath_csv: Path) -> Path:
+        """ Convert `CSVCandles` file to sibling binary file """
+        async with FileLock.read(filepath_csv):
+            async with aiofiles.open(filepath_csv) as f:
+                lines = (await f.readlines())[1:]
+        records = cls.candles2records([cls.line2candle(line) for line in lines if line.endswith('\n')])
+
+        filepath = filepath_csv.with_suffix(cls.SUFFIX)
+        await cls._write_atomic(filepath, HEADER.pack(MAGIC, VERSION, RECORD.itemsize) + records.tobytes())
+        logging.debug(f'Converted {len(records)} candles | {filepath_csv} -> {filepath}')
+        return filepath
+
+    @classmethod
+    async def migrate(cls, dir_: Path | None = None) -> list[Path]:
+        """ Convert every csv file under `DIR_API` which has no binary copy yet """
+        return [
+            await cls.from_csv(p) for p in sorted((dir_ or cls.DIR_API).rglob('*.csv'))
+            if not p.with_suffix(cls.SUFFIX).exists()
+        ]
+
+
+if __name__ == '__main__':
+    asyncio.run(BinaryCandles.migrate())
@@ -0,0 +1,147 @@
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.date_utils import DateTimeFactory
+from my_tinkoff.schemas import Candles
+
+if TYPE_CHECKING:
+    from my_tinkoff.csv_candles import CSVCandles
+
+
+@dataclass
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    ranges: int
+    nbytes: int
+    max_bytes: int
+
+
+@dataclass
+class _Range:
+    from_: datetime
+    to: datetime
+    candles: ColumnarCandles
+
+
+@dataclass
+class _Entry:
+    stamp: tuple[int, int]
+    ranges: list[_Range]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(r.candles.nbytes for r in self.ranges)
+
+
+class CandleRangeCache:
+    """ Process-wide LRU of decoded candle ranges keyed by (instrument uid, interval). Overlapping ranges are merged,
+    least recently used entries are evicted over `MAX_BYTES`. Entry is dropped on `invalidate` and when size or
+    mtime of storage file differs from the one it was read from.
+    """
+    MAX_BYTES = 256 * 1024 ** 2
+    ENABLED = True
+
+    _entries: OrderedDict[tuple[str, object], _Entry] = OrderedDict()
+    _nbytes = 0
+    _hits = 0
+    _misses = 0
+    _evictions = 0
+
+    @classmethod
+    def get(cls, storage: 'CSVCandles', from_: datetime, to: datetime) -> Candles | None:
+        """ Candles with `from_ <= dt <= to` if some cached range covers whole [from_, to] """
+        if not cls.ENABLED:
+            return None
+
+        key = (storage.instrument_id, storage.interval)
+        entry = cls._entries.get(key)
+        if entry is not None and entry.stamp != cls._stamp(storage):
+            cls._drop(key)
+            entry = None
+
+        for r in entry.ranges if entry is not None else ():
+            if r.from_ <= from_ and to <= r.to:
+                cls._entries.move_to_end(key)
+                cls._hits += 1
+                return r.candles.slice_by_dt(from_, to).to_candles()
+
+        cls._misses += 1
+
+    @classmethod
+    def put(cls, storage: 'CSVCandles', from_: datetime, to: datetime, candles: Candles) -> None:
+        """ Remember result of full read of [from_, to]. Range is cut at the last candle which can't change anymore """
+        to = min(to, DateTimeFactory.now() - storage.candle_duration)
+        if not cls.ENABLED or to < from_:
+            return
+
+        key = (storage.instrument_id, storage.interval)
+        stamp = cls._stamp(storage)
+        entry = cls._entries.get(key)
+        if entry is None or entry.stamp != stamp:
+            cls._drop(key)
+            entry = cls._entries[key] = _Entry(stamp=stamp, ranges=[])
+
+        new = _Range(from_=from_, to=to, candles=ColumnarCandles.from_candles(candles).slice_by_dt(from_, to))
+        ranges = []
+        for r in entry.ranges:
+            if r.from_ <= new.to and new.from_ <= r.to:
+                new = cls._merge(new, r)
+            else:
+                ranges.append(r)
+        entry.ranges = sorted(ranges + [new], key=lambda r: r.from_)
+
+        cls._nbytes = sum(e.nbytes for e in cls._entries.values())
+        cls._entries.move_to_end(key)
+        cls._evict()
+
+    @classmethod
+    def invalidate(cls, instrument_id: str, interval: object) -> None:
+        cls._drop((instrument_id, interval))
+
+    @classmethod
+    def clear(cls) -> None:
+        cls._entries.clear()
+        cls._nbytes = cls._hits = cls._misses = cls._evictions = 0
+
+    @classmethod
+    def stats(cls) -> CacheStats:
+        return CacheStats(hits=cls._hits, misses=cls._misses, evictions=cls._evictions, entries=len(cls._entries),
+                          ranges=sum(len(e.ranges) for e in cls._entries.values()), nbytes=cls._nbytes,
+                          max_bytes=cls.MAX_BYTES)
+
+    @classmethod
+    def _evict(cls) -> None:
+        while cls._nbytes > cls.MAX_BYTES and cls._entries:
+            key = next(iter(cls._entries))
+            cls._drop(key)
+            cls._evictions += 1
+            logging.debug(f'Candles evicted from cache | {key=} | nbytes={cls._nbytes}')
+
+    @classmethod
+    def _drop(cls, key: tuple[str, object]) -> None:
+        entry = cls._entries.pop(key, None)
+        if entry is not None:
+            cls._nbytes -= entry.nbytes
+
+    @staticmethod
+    def _merge(a: _Range, b: _Range) -> _Range:
+        candles = ColumnarCandles.concat([a.candles, b.candles])
+        candles = candles[np.unique(candles.ts, return_index=True)[1]]
+        return _Range(from_=min(a.from_, b.from_), to=max(a.to, b.to), candles=candles)
+
+    @staticmethod
+    def _stamp(storage: 'CSVCandles') -> tuple[int, int]:
+        try:
+            stat = storage.filepath.stat()
+        except FileNotFoundError:
+            return 0, 0
+        return stat.st_size, stat.st_mtime_ns
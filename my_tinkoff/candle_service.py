@@ -0,0 +1,375 @@
+""" One local process owns tokens, candle files and stream subscriptions, strategy processes talk to it over a Unix
+socket instead of calling API and reading files themselves.
+
+    python -m my_tinkoff.candle_service  # daemon
+
+    async with CandleServiceClient() as client:
+        candles = await client.get_candles(instrument_uid, from_, to, CandleInterval.CANDLE_INTERVAL_1_MIN)
+        async for event in client.subscribe_candles([instrument_uid]):
+            ...
+
+Frame is `FRAME` header (kind, request id, payload size) and payload. Requests are small json objects, candles are
+sent as `binary_candles.RECORD` bytes, so client decodes them with `np.frombuffer` without per-candle parsing.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import tempfile
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from enum import IntEnum
+from pathlib import Path
+from typing import AsyncIterator
+
+import numpy as np
+from tinkoff.invest import CandleInterval, Instrument, SubscriptionInterval
+
+from my_tinkoff.api_calls.market_data_stream import (
+    MarketDataStreamManager,
+    StreamCandle,
+    StreamConsumer,
+    Subscription,
+)
+from my_tinkoff.binary_candles import RECORD, BinaryCandles
+from my_tinkoff.columnar import ColumnarCandles, dt2ns, ns2dt
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.enums import Overflow, StreamKind
+from my_tinkoff.instrument_cache import InstrumentCache
+from my_tinkoff.schemas import Candles
+
+SOCKET_PATH = Path(tempfile.gettempdir()) / 'my_tinkoff_candles.sock'
+FRAME = struct.Struct('<BII')
+UID = struct.Struct('<HI')
+
+
+class FrameKind(IntEnum):
+    REQUEST = 1
+    CANDLES = 2
+    OK = 3
+    ERROR = 4
+    EVENT = 5
+
+
+class CandleServiceError(Exception):
+    pass
+
+
+@dataclass
+class ServiceStats:
+    requests: int = 0
+    deduplicated: int = 0
+    candles_sent: int = 0
+    events_sent: int = 0
+    events_dropped: int = 0  # oldest events of clients which don't read them fast enough
+    clients: int = 0  # connected now
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[FrameKind, int, bytes]:
+    kind, request_id, size = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return FrameKind(kind), request_id, await reader.readexactly(size)
+
+
+def pack_frame(kind: FrameKind, request_id: int, payload: bytes) -> bytes:
+    return FRAME.pack(kind, request_id, len(payload)) + payload
+
+
+def encode_candles(candles: ColumnarCandles) -> bytes:
+    return BinaryCandles.candles2records(candles).tobytes()
+
+
+def decode_candles(payload: bytes) -> ColumnarCandles:
+    return BinaryCandles.records2columnar(np.frombuffer(payload, dtype=RECORD))
+
+
+def encode_event(event: StreamCandle) -> bytes:
+    uid = event.instrument_uid.encode()
+    return UID.pack(len(uid), int(event.interval)) + uid + encode_candles(ColumnarCandles.from_candles([event.candle]))
+
+
+def decode_event(payload: bytes) -> StreamCandle:
+    size, interval = UID.unpack_from(payload)
+    uid = payload[UID.size:UID.size + size].decode()
+    candle = decode_candles(payload[UID.size + size:])[0]
+    return StreamCandle(instrument_uid=uid, interval=SubscriptionInterval(interval), candle=candle)
+
+
+class _Connection:
+    EVENTS_MAXSIZE = 10_000
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions: set[tuple[str, SubscriptionInterval]] = set()
+        self.events: asyncio.Queue[bytes] = asyncio.Queue(maxsize=self.EVENTS_MAXSIZE)
+        self._lock = asyncio.Lock()
+
+    def put_event(self, payload: bytes) -> bool:
+        """ Queue event for the writer task of this connection. Returns False if the oldest one was dropped """
+        dropped = self.events.full()
+        if dropped:
+            self.events.get_nowait()
+        self.events.put_nowait(payload)
+        return not dropped
+
+    async def send(self, kind: FrameKind, request_id: int, payload: bytes) -> None:
+        async with self._lock:
+            self.writer.write(pack_frame(kind, request_id, payload))
+            await self.writer.drain()
+
+
+class CandleService:
+    """ Serves `storage.download_or_read` ranges and live candles of one `MarketDataStreamManager` to clients.
+    Identical ranges requested while the first one is still running share its result, ranges of the same file are
+    read one at a time. Every client gets live candles through its own queue, so a slow one doesn't delay others,
+    and stream subscriptions are released when the last client which needs them disconnects.
+    """
+
+    def __init__(
+            self,
+            path: Path = SOCKET_PATH,
+            storage: type[CSVCandles] = CSVCandles,
+            stream_manager: MarketDataStreamManager | None = None,
+    ):
+        self.path = path
+        self.storage = storage
+        self.stream_manager = stream_manager or MarketDataStreamManager()
+        self.stats = ServiceStats()
+
+        self._server: asyncio.AbstractServer | None = None
+        self._connections: set[_Connection] = set()
+        self._in_flight: dict[tuple[str, CandleInterval, int, int], asyncio.Task[bytes]] = {}
+        self._file_locks: dict[tuple[str, CandleInterval], asyncio.Lock] = {}
+        self._subscribers: dict[tuple[str, SubscriptionInterval], int] = {}
+        self._events_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        if self.path.exists():
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=str(self.path))
+        consumer = self.stream_manager.consumer(overflow=Overflow.DROP_OLDEST, kinds={StreamKind.CANDLE})
+        self._events_task = asyncio.create_task(self._broadcast(consumer))
+        logging.info(f'Candle service started | {self.path}')
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        if self._events_task:
+            self._events_task.cancel()
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for connection in list(self._connections):
+            connection.writer.close()
+        await self.stream_manager.close()
+        if self.path.exists():
+            os.unlink(self.path)
+
+    async def get_candles(self, instrument_uid: str, from_: datetime, to: datetime, interval: CandleInterval) -> bytes:
+        key = (instrument_uid, interval, dt2ns(from_), dt2ns(to))
+        if key in self._in_flight:
+            self.stats.deduplicated += 1
+        else:
+            self._in_flight[key] = asyncio.create_task(self._read(instrument_uid, from_, to, interval))
+            self._in_flight[key].add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(self._in_flight[key])
+
+    async def get_instrument(self, instrument_uid: str) -> Instrument:
+        return await InstrumentCache.get_by_uid(instrument_uid)
+
+    def subscribe_candles(self, instrument_uids: list[str], interval: SubscriptionInterval) -> None:
+        self.stream_manager.subscribe_candles(instrument_uids, interval=interval)
+
+    def unsubscribe_candles(self, instrument_uids: list[str], interval: SubscriptionInterval) -> None:
+        self.stream_manager.unsubscribe([Subscription(StreamKind.CANDLE, uid, interval=interval)
+                                         for uid in instrument_uids])
+
+    async def _read(self, instrument_uid: str, from_: datetime, to: datetime, interval: CandleInterval) -> bytes:
+        instrument = await self.get_instrument(instrument_uid)
+        async with self._file_locks.setdefault((instrument_uid, interval), asyncio.Lock()):
+            candles = await self.storage.download_or_read(instrument=instrument, from_=from_, to=to,
+                                                          interval=interval, columnar=True)
+        return encode_candles(candles)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = _Connection(reader, writer)
+        self._connections.add(connection)
+        self.stats.clients += 1
+        tasks = {asyncio.create_task(self._send_events(connection))}
+        try:
+            while True:
+                kind, request_id, payload = await read_frame(reader)
+                task = asyncio.create_task(self._respond(connection, request_id, json.loads(payload)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._connections.discard(connection)
+            self._release(connection.subscriptions)
+            self.stats.clients -= 1
+            writer.close()
+
+    async def _respond(self, connection: _Connection, request_id: int, request: dict) -> None:
+        self.stats.requests += 1
+        try:
+            match request['method']:
+                case 'get_candles':
+                    kind, payload = FrameKind.CANDLES, await self.get_candles(
+                        instrument_uid=request['instrument_uid'],
+                        from_=ns2dt(request['from']),
+                        to=ns2dt(request['to']),
+                        interval=CandleInterval(request['interval']),
+                    )
+                case 'subscribe_candles':
+                    interval = SubscriptionInterval(request['interval'])
+                    keys = {(uid, interval) for uid in request['instrument_uids']} - connection.subscriptions
+                    connection.subscriptions |= keys
+                    for key in keys:
+                        self._subscribers[key] = self._subscribers.get(key, 0) + 1
+                    self.subscribe_candles(request['instrument_uids'], interval=interval)
+                    kind, payload = FrameKind.OK, b''
+                case method:
+                    raise CandleServiceError(f'Unknown {method=}')
+        except Exception as ex:
+            logging.error(f'{request=} | {ex!r}', exc_info=not isinstance(ex, CandleServiceError))
+            kind, payload = FrameKind.ERROR, repr(ex).encode()
+
+        try:
+            await connection.send(kind, request_id, payload)
+        except ConnectionError as ex:  # BrokenPipeError and ConnectionResetError included
+            logging.debug(f'Client disconnected before response | {request_id=} | {kind=} | {ex!r}')
+            return
+        if kind == FrameKind.CANDLES:
+            self.stats.candles_sent += len(payload) // RECORD.itemsize
+
+    async def _broadcast(self, consumer: StreamConsumer) -> None:
+        async for event in consumer:
+            key = (event.instrument_uid, event.interval)
+            payload = encode_event(event)
+            for connection in self._connections:
+                if key in connection.subscriptions and not connection.put_event(payload):
+                    self.stats.events_dropped += 1
+
+    async def _send_events(self, connection: _Connection) -> None:
+        while True:
+            payload = await connection.events.get()
+            try:
+                await connection.send(FrameKind.EVENT, 0, payload)
+            except ConnectionError:
+                return
+            self.stats.events_sent += 1
+
+    def _release(self, subscriptions: set[tuple[str, SubscriptionInterval]]) -> None:
+        """ Unsubscribe stream from candles which no connected client needs anymore """
+        unused = defaultdict(list)
+        for uid, interval in subscriptions:
+            self._subscribers[(uid, interval)] -= 1
+            if not self._subscribers[(uid, interval)]:
+                del self._subscribers[(uid, interval)]
+                unused[interval].append(uid)
+        for interval, uids in unused.items():
+            self.unsubscribe_candles(uids, interval=interval)
+
+
+class CandleServiceClient:
+    """ Connection to `CandleService`. Requests of one client can run concurrently over the same socket """
+    EVENTS_MAXSIZE = 10_000
+
+    def __init__(self, path: Path = SOCKET_PATH):
+        self.path = path
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._read_task: asyncio.Task | None = None
+        self._responses: dict[int, asyncio.Future[tuple[FrameKind, bytes]]] = {}
+        self._events: asyncio.Queue[StreamCandle] = asyncio.Queue(maxsize=self.EVENTS_MAXSIZE)
+        self._request_id = 0
+
+    async def __aenter__(self) -> 'CandleServiceClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(str(self.path))
+        self._read_task = asyncio.create_task(self._read_responses())
+
+    async def close(self) -> None:
+        if self._read_task:
+            self._read_task.cancel()
+        if self._writer:
+            self._writer.close()
+        self._fail_responses('Client closed')
+
+    async def get_candles(
+            self,
+            instrument_uid: str,
+            from_: datetime,
+            to: datetime,
+            interval: CandleInterval,
+            columnar: bool = False,
+    ) -> Candles | ColumnarCandles:
+        payload = await self._request({'method': 'get_candles', 'instrument_uid': instrument_uid,
+                                       'from': dt2ns(from_), 'to': dt2ns(to), 'interval': int(interval)})
+        candles = decode_candles(payload)
+        return candles if columnar else candles.to_candles()
+
+    async def subscribe_candles(
+            self,
+            instrument_uids: list[str],
+            interval: SubscriptionInterval = SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE,
+    ) -> AsyncIterator[StreamCandle]:
+        """ Live candles of every subscription of this client """
+        await self._request({'method': 'subscribe_candles', 'instrument_uids': instrument_uids,
+                             'interval': int(interval)})
+        while True:
+            yield await self._events.get()
+
+    async def _request(self, request: dict) -> bytes:
+        self._request_id += 1
+        request_id = self._request_id
+        self._responses[request_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(pack_frame(FrameKind.REQUEST, request_id, json.dumps(request).encode()))
+        await self._writer.drain()
+
+        kind, payload = await self._responses[request_id]
+        if kind == FrameKind.ERROR:
+            raise CandleServiceError(payload.decode())
+        return payload
+
+    async def _read_responses(self) -> None:
+        try:
+            while True:
+                kind, request_id, payload = await read_frame(self._reader)
+                if kind == FrameKind.EVENT:
+                    if self._events.full():
+                        self._events.get_nowait()
+                    self._events.put_nowait(decode_event(payload))
+                elif future := self._responses.pop(request_id, None):
+                    future.set_result((kind, payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as ex:
+            self._fail_responses(f'Connection closed | {ex!r}')
+
+    def _fail_responses(self, reason: str) -> None:
+        """ Requests waiting for responses which will never come raise `CandleServiceError` """
+        for future in self._responses.values():
+            if not future.done():
+                future.set_exception(CandleServiceError(reason))
+        self._responses.clear()
+
+
+if __name__ == '__main__':
+    asyncio.run(CandleService().serve_forever())
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from dataclasses import replace
+from datetime import datetime, timedelta
+
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.api_calls.market_data import get_candles
+from my_tinkoff.api_calls.market_data_stream import (
+    SUBSCRIPTION_INTERVAL_TO_CANDLE_INTERVAL,
+    StreamCandle,
+    StreamConsumer,
+)
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import DateTimeFactory
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.helpers import get_candle_duration
+from my_tinkoff.schemas import Candle, Candles
+
+
+class StreamCandleWriter:
+    """ Writes completed stream candles to the same files `CSVCandles.download_or_read` reads. Candle is completed
+    when a newer one of the same instrument arrives or its interval ended `COMPLETE_DELAY` ago. Completed candles
+    are buffered per instrument and appended once `FLUSH_SIZE` are buffered or `FLUSH_INTERVAL` passed.
+    """
+    FLUSH_SIZE = 100
+    FLUSH_INTERVAL = timedelta(seconds=10)
+    COMPLETE_DELAY = timedelta(seconds=5)
+
+    def __init__(
+            self,
+            interval: CandleInterval = CandleInterval.CANDLE_INTERVAL_1_MIN,
+            storage: type[CSVCandles] = CSVCandles
+    ):
+        self.interval = interval
+        self.storage = storage
+        self.candle_duration = get_candle_duration(interval)
+        self.written = 0
+
+        self._forming: dict[str, Candle] = {}
+        self._last_dt: dict[str, datetime] = {}
+        self._buffers: dict[str, list[Candle]] = defaultdict(list)
+        self._flushed_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def run(self, consumer: StreamConsumer) -> None:
+        try:
+            while True:
+                try:
+                    self.add(await asyncio.wait_for(consumer.get(), timeout=self.FLUSH_INTERVAL.total_seconds()))
+                except asyncio.TimeoutError:
+                    pass
+
+                self.complete_expired()
+                if self._should_flush():
+                    await self.flush()
+        finally:
+            self.complete_expired()
+            await self.flush()
+
+    def add(self, event: StreamCandle) -> None:
+        if not isinstance(event, StreamCandle) or \
+                SUBSCRIPTION_INTERVAL_TO_CANDLE_INTERVAL.get(event.interval) != self.interval:
+            return
+
+        uid, candle = event.instrument_uid, event.candle
+        if uid in self._last_dt and candle.dt <= self._last_dt[uid]:
+            return
+
+        forming = self._forming.get(uid)
+        if forming is not None and candle.dt > forming.dt:
+            self._complete(uid, forming)
+        if forming is None or candle.dt >= forming.dt:
+            self._forming[uid] = candle
+
+    def complete_expired(self) -> None:
+        now = DateTimeFactory.now()
+        for uid, candle in list(self._forming.items()):
+            if candle.dt + self.candle_duration + self.COMPLETE_DELAY <= now:
+                self._complete(uid, candle)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            buffers, self._buffers = self._buffers, defaultdict(list)
+            self._flushed_at = time.monotonic()
+            for uid, candles in buffers.items():
+                try:
+                    await self._write(uid, candles)
+                except Exception as ex:
+                    logging.error(f'Candles are not written | {uid=} | count={len(candles)} | {ex!r}', exc_info=True)
+
+    def _complete(self, uid: str, candle: Candle) -> None:
+        self._forming.pop(uid, None)
+        self._last_dt[uid] = candle.dt
+        self._buffers[uid].append(replace(candle, is_complete=True))
+
+    def _should_flush(self) -> bool:
+        return (any(len(b) >= self.FLUSH_SIZE for b in self._buffers.values()) or
+                time.monotonic() - self._flushed_at >= self.FLUSH_INTERVAL.total_seconds())
+
+    async def _write(self, uid: str, candles: list[Candle]) -> None:
+        """ Only candles after the last one in file are appended. Candles missed between file and stream are
+        downloaded first, without holding the file lock, so file stays continuous for `_check_range`
+        """
+        storage = self.storage.open(instrument_id=uid, interval=self.interval)
+        last_candle = await self._last_candle(storage)
+        if last_candle is not None:
+            candles = [c for c in candles if c.dt > last_candle.dt]
+        if not candles:
+            return
+
+        if last_candle is not None and candles[0].dt > last_candle.dt + self.candle_duration:
+            missed = await get_candles(instrument_id=uid, from_=last_candle.dt, to=candles[0].dt,
+                                       interval=self.interval)
+            candles = [c for c in missed if last_candle.dt < c.dt < candles[0].dt and c.is_complete] + candles
+
+        async with FileLock.write(storage.filepath):
+            if storage.current() is not storage:
+                # an insert split the file into segments while missed candles were fetched
+                return await self._write(uid, candles)
+            if not storage.filepath.exists():
+                await storage._prepare_new()
+
+            # rows appended by another writer while this one fetched are not appended twice
+            last_candle = await self._last_candle(storage)
+            if last_candle is not None:
+                candles = [c for c in candles if c.dt > last_candle.dt]
+            if not candles:
+                return
+
+            await storage._append(Candles(candles))
+        self.written += len(candles)
+        logging.debug(f'Stream candles appended | {uid=} | count={len(candles)} | {storage.filepath}')
+
+    @staticmethod
+    async def _last_candle(storage: CSVCandles) -> Candle | None:
+        if not storage.filepath.exists() or storage._is_empty():
+            return None
+        return await storage._last_candle()
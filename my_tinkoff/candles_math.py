@@ -0,0 +1,89 @@
+from functools import reduce
+from typing import Callable, Literal, Sequence
+
+import numpy as np
+
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.schemas import Candle, Candles
+
+Join = Literal['outer', 'inner']
+PRICES = ('open', 'high', 'low', 'close')
+
+
+def align(series: Sequence[ColumnarCandles], how: Join = 'outer') -> tuple[np.ndarray, list[np.ndarray]]:
+    """ Common timestamps of sorted series and index of candle of every series at each of them.
+
+    Outer join takes union of timestamps and forward-fills series which have no candle at timestamp with its
+    previous candle. Rows before every series has started are dropped. Inner join takes only common timestamps.
+    """
+    if how == 'outer':
+        ts = np.unique(np.concatenate([s.ts for s in series]))
+    elif how == 'inner':
+        ts = reduce(np.intersect1d, [s.ts for s in series])
+    else:
+        raise ValueError(f'Unexpected join {how=}')
+
+    positions = [np.searchsorted(s.ts, ts, side='right') - 1 for s in series]
+    is_started = np.logical_and.reduce([p >= 0 for p in positions])
+    return ts[is_started], [p[is_started] for p in positions]
+
+
+def combine(
+        series: Sequence[ColumnarCandles],
+        op: Callable[[np.ndarray, np.ndarray], np.ndarray] = np.add,
+        weights: Sequence[float] | None = None,
+        how: Join = 'outer',
+) -> ColumnarCandles:
+    """ Apply `op` to open, high, low and close of aligned series left to right, the same way as `Candle`
+    operators do. Volumes are always summed, prices are multiplied by `weights` first
+    """
+    ts, positions = align(series, how=how)
+    weights = weights or [1.] * len(series)
+
+    def _prices(field: str) -> np.ndarray:
+        return reduce(op, [getattr(s, field)[p] * w for s, p, w in zip(series, positions, weights)])
+
+    return ColumnarCandles(
+        **{f: _prices(f) for f in PRICES},
+        volume=np.add.reduce([s.volume[p] for s, p in zip(series, positions)]),
+        ts=ts,
+        is_complete=np.logical_and.reduce([s.is_complete[p] for s, p in zip(series, positions)]),
+    )
+
+
+def weighted_sum(series: Sequence[ColumnarCandles], weights: Sequence[float], how: Join = 'outer') -> ColumnarCandles:
+    return combine(series, op=np.add, weights=weights, how=how)
+
+
+def ratio(numerator: ColumnarCandles, denominator: ColumnarCandles, how: Join = 'outer') -> ColumnarCandles:
+    return combine([numerator, denominator], op=np.divide, how=how)
+
+
+def combine_candles(
+        series: Sequence[Candles],
+        op: Callable[[np.ndarray, np.ndarray], np.ndarray] = np.add,
+        weights: Sequence[float] | None = None,
+        how: Join = 'outer',
+) -> Candles:
+    """ `combine` for `Candles`. `dt` of result candle is the `dt` object of the first series which has a candle
+    at that timestamp, so naive and aware datetimes are kept as they were. `is_complete` is left unset like
+    `Candle` operators do
+    """
+    columnar = [ColumnarCandles.from_candles(s) for s in series]
+    result = combine(columnar, op=op, weights=weights, how=how)
+    _, positions = align(columnar, how=how)
+
+    dts = np.empty(len(result), dtype=object)
+    is_found = np.zeros(len(result), dtype=np.bool_)
+    for s, c, p in zip(series, columnar, positions):
+        is_exact = ~is_found & (c.ts[p] == result.ts)
+        dts[is_exact] = [s[i].dt for i in p[is_exact].tolist()]
+        is_found |= is_exact
+
+    return Candles([
+        Candle(open=o, high=h, low=l, close=c, volume=v, dt=dt)
+        for o, h, l, c, v, dt in zip(
+            result.open.tolist(), result.high.tolist(), result.low.tolist(), result.close.tolist(),
+            result.volume.tolist(), dts.tolist()
+        )
+    ])
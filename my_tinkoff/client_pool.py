@@ -0,0 +1,104 @@
+import logging
+from dataclasses import dataclass
+
+import grpc
+from tinkoff.invest.async_services import AsyncServices
+from tinkoff.invest.channels import create_channel
+from tinkoff.invest.constants import INVEST_GRPC_API
+
+
+@dataclass
+class PoolStats:
+    size: int
+    created: int
+    reused: int
+    reconnects: int
+
+
+@dataclass
+class _PooledClient:
+    channel: grpc.aio.Channel
+    services: AsyncServices
+    uses: int = 0
+
+
+class ClientPool:
+    """ One long-lived channel per token shared by every `token_controller` call. Call `close` on shutdown """
+    TARGET: str = INVEST_GRPC_API
+    CHANNEL_OPTIONS: list[tuple[str, object]] | None = None
+    INSECURE: bool = False
+
+    _clients: dict[str, _PooledClient] = {}
+    _created: int = 0
+    _reused: int = 0
+    _reconnects: int = 0
+
+    @classmethod
+    async def get(cls, token: str) -> AsyncServices:
+        client = cls._clients.get(token)
+        if client is not None:
+            await cls.reconnect(token, client.services)
+            client = cls._clients.get(token)
+
+        if client is None:
+            client = cls._clients[token] = cls._connect(token)
+            cls._created += 1
+        else:
+            cls._reused += 1
+
+        client.uses += 1
+        return client.services
+
+    @classmethod
+    async def reconnect(cls, token: str, services: AsyncServices) -> bool:
+        """ Close channel of token if it is broken. `services` are the ones the failed call used: channel which was
+        replaced since then is not closed again, so many calls failed on one channel reconnect it once. gRPC
+        channel which is still healthy reconnects by itself and is kept, other calls and streams keep using it
+        """
+        client = cls._clients.get(token)
+        if client is None or client.services is not services or cls._is_healthy(client):
+            return False
+
+        logging.warning(f'Channel is not healthy | state={client.channel.get_state()} | reconnecting')
+        del cls._clients[token]
+        cls._reconnects += 1
+        await cls._close_client(client)
+        return True
+
+    @classmethod
+    def is_current(cls, token: str, services: AsyncServices) -> bool:
+        """ Whether `services` still use the pooled channel of token """
+        client = cls._clients.get(token)
+        return client is not None and client.services is services
+
+    @classmethod
+    async def close(cls) -> None:
+        for token in list(cls._clients):
+            await cls._close_client(cls._clients.pop(token))
+
+    @classmethod
+    def stats(cls) -> PoolStats:
+        return PoolStats(size=len(cls._clients), created=cls._created, reused=cls._reused,
+                         reconnects=cls._reconnects)
+
+    @classmethod
+    def _connect(cls, token: str) -> _PooledClient:
+        if cls.INSECURE:
+            channel = grpc.aio.insecure_channel(cls.TARGET, options=cls.CHANNEL_OPTIONS)
+        else:
+            channel = create_channel(target=cls.TARGET, options=cls.CHANNEL_OPTIONS, force_async=True)
+        return _PooledClient(channel=channel, services=AsyncServices(channel, token=token))
+
+    @staticmethod
+    def _is_healthy(client: _PooledClient) -> bool:
+        return client.channel.get_state() not in (
+            grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+            grpc.ChannelConnectivity.SHUTDOWN,
+        )
+
+    @staticmethod
+    async def _close_client(client: _PooledClient) -> None:
+        try:
+            await client.services.cancel_all_stream()
+        finally:
+            await client.channel.close()
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Self
+
+import numpy as np
+
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+
+EPOCH = datetime(1970, 1, 1, tzinfo=TZ_UTC)
+
+
+def dt2ns(dt: datetime) -> int:
+    """ Naive datetimes are treated as UTC """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=TZ_UTC)
+    return (dt - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def ns2dt(ns: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(ns) // 1000)
+
+
+class ColumnarCandles:
+    """ Struct-of-arrays candles storage. Slices and `slice_by_dt` results are views on the same buffers.
+
+    `Candle.is_complete=None` is stored as complete, the same way `CSVCandles.row2candle` treats rows from file.
+    """
+    __slots__ = ('open', 'high', 'low', 'close', 'volume', 'ts', 'is_complete')
+
+    def __init__(
+            self,
+            open: np.ndarray,
+            high: np.ndarray,
+            low: np.ndarray,
+            close: np.ndarray,
+            volume: np.ndarray,
+            ts: np.ndarray,
+            is_complete: np.ndarray,
+    ):
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.int64)
+        self.ts = np.asarray(ts, dtype=np.int64)
+        self.is_complete = np.asarray(is_complete, dtype=np.bool_)
+
+    @classmethod
+    def empty(cls) -> Self:
+        return cls(*[np.empty(0, dtype=t) for t in (np.float64,) * 4 + (np.int64, np.int64, np.bool_)])
+
+    @classmethod
+    def from_candles(cls, candles: Iterable[Candle]) -> Self:
+        candles = list(candles)
+        count = len(candles)
+        return cls(
+            open=np.fromiter((c.open for c in candles), dtype=np.float64, count=count),
+            high=np.fromiter((c.high for c in candles), dtype=np.float64, count=count),
+            low=np.fromiter((c.low for c in candles), dtype=np.float64, count=count),
+            close=np.fromiter((c.close for c in candles), dtype=np.float64, count=count),
+            volume=np.fromiter((c.volume for c in candles), dtype=np.int64, count=count),
+            ts=np.fromiter((dt2ns(c.dt) for c in candles), dtype=np.int64, count=count),
+            is_complete=np.fromiter((c.is_complete is not False for c in candles), dtype=np.bool_, count=count),
+        )
+
+    @classmethod
+    def concat(cls, parts: Iterable[Self]) -> Self:
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls.empty()
+        if len(parts) == 1:
+            return parts[0]
+        return cls(*[np.concatenate([getattr(p, f) for p in parts]) for f in cls.__slots__])
+
+    def to_candles(self) -> Candles:
+        return Candles([
+            Candle(open=o, high=h, low=l, close=c, volume=v, dt=dt, is_complete=ic)
+            for o, h, l, c, v, dt, ic in zip(
+                self.open.tolist(), self.high.tolist(), self.low.tolist(), self.close.tolist(),
+                self.volume.tolist(), self.dt, self.is_complete.tolist()
+            )
+        ])
+
+    def slice_by_dt(self, from_: datetime, to: datetime) -> Self:
+        """ Candles with `from_ <= dt <= to`. `ts` must be sorted """
+        start = np.searchsorted(self.ts, dt2ns(from_), side='left')
+        end = np.searchsorted(self.ts, dt2ns(to), side='right')
+        return self[start:end]
+
+    def until(self, to: datetime) -> Self:
+        """ Candles with `dt <= to`. `ts` must be sorted """
+        return self[:np.searchsorted(self.ts, dt2ns(to), side='right')]
+
+    @property
+    def dt(self) -> list[datetime]:
+        dts = self.ts.view('datetime64[ns]').astype('datetime64[us]').tolist()
+        return [dt.replace(tzinfo=TZ_UTC) for dt in dts]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, f).nbytes for f in self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def __iter__(self) -> Iterator[Candle]:
+        return iter(self.to_candles())
+
+    def __getitem__(self, item: int | slice | np.ndarray) -> Candle | Self:
+        """ Slice gives views, array of indices or bool mask gives copies """
+        if isinstance(item, (slice, np.ndarray)):
+            return self.__class__(*[getattr(self, f)[item] for f in self.__slots__])
+
+        return Candle(
+            open=float(self.open[item]),
+            high=float(self.high[item]),
+            low=float(self.low[item]),
+            close=float(self.close[item]),
+            volume=int(self.volume[item]),
+            dt=ns2dt(self.ts[item]),
+            is_complete=bool(self.is_complete[item])
+        )
+
+    def __repr__(self) -> str:
+        if not len(self):
+            return f'{self.__class__.__name__}(len=0)'
+        return f'{self.__class__.__name__}(len={len(self)} | from={ns2dt(self.ts[0])} | to={ns2dt(self.ts[-1])})'
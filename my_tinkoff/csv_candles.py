@@ -1,6 +1,13 @@
+import functools
 import logging
+import os
+import shutil
 from pathlib import Path
 from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+import aiofiles
+import numpy as np
 
 from tinkoff.invest import (
     Instrument,
@@ -12,8 +19,16 @@ from config import DIR_CANDLES # noqa
 from trading_helpers.schemas import AnyCandle, CandleInterval
 
 from my_tinkoff.schemas import Candle, Candles
-from my_tinkoff.helpers import configure_datetime_from
+from my_tinkoff.archive import CandleArchive
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.csv_index import CSVIndex
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.trading_calendar import TradingCalendar
+from my_tinkoff.helpers import configure_datetime_from, get_candle_duration, split_datetime_range
+from my_tinkoff.instrumentation import Instrumentation
 from my_tinkoff.date_utils import dt_form_sys
+from my_tinkoff.exceptions import TradingCalendarMissing
 from my_tinkoff.api_calls.market_data import get_candles
 
 from trading_helpers.csv_candles import _CSVCandles, Interval
@@ -25,6 +40,21 @@ from trading_helpers.exceptions import (
 )
 
 
+def _follows_segments(method):
+    """ Method of storage which file got segmented by another instance is run by the segmented storage """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if (storage := self.current()) is self:
+            try:
+                return await method(self, *args, **kwargs)
+            except FileNotFoundError:
+                # file was segmented while this call waited for its lock
+                if (storage := self.current()) is self:
+                    raise
+        return await getattr(storage, method.__name__)(*args, **kwargs)
+    return wrapper
+
+
 class CSVCandles(_CSVCandles):
     CANDLE = Candle
     CANDLES = Candles
@@ -39,6 +69,59 @@ class CSVCandles(_CSVCandles):
 
     DIR_API = DIR_CANDLES / 'tinkoff'
     DIR_API.mkdir(exist_ok=True)
+    MAX_LINE_SIZE = 1024
+    ITER_WINDOW_CANDLES = 50_000
+    SEGMENT_ON_INSERT = True  # the first insert splits the file into `SegmentedCSVCandles` monthly segments
+    _segmented_types: dict[type, type] = {}
+
+    def __init__(self, instrument_id: str, interval: Interval):
+        super().__init__(instrument_id=instrument_id, interval=interval)
+        self.candle_duration = get_candle_duration(interval)
+        self.exchange: str | None = None
+        self.calendar_defaults = False
+
+    @classmethod
+    def open(cls, instrument_id: str, interval: Interval) -> 'CSVCandles':
+        """ Storage of instrument and interval in the layout its file has now """
+        return cls(instrument_id=instrument_id, interval=interval).current()
+
+    def current(self) -> 'CSVCandles':
+        """ This storage or its `segmented` one, if the file was already split into segments """
+        if self.SEGMENT_ON_INSERT and (storage := self.segmented()).filepath.exists():
+            return storage
+        return self
+
+    def segmented(self) -> 'CSVCandles':
+        """ `SegmentedCSVCandles` of the same instrument and interval. Both layouts share one archive """
+        from my_tinkoff.segmented_candles import SegmentedCSVCandles
+
+        cls = type(self)
+        if cls not in self._segmented_types:
+            self._segmented_types[cls] = type(f'Segmented{cls.__name__}', (SegmentedCSVCandles, cls), {})
+        storage = self._segmented_types[cls](instrument_id=self.instrument_id, interval=self.interval)
+        storage.exchange, storage.calendar_defaults = self.exchange, self.calendar_defaults
+        return storage
+
+    async def _segment(self) -> 'CSVCandles':
+        """ Split the file into segments, which are built in a temp directory and replace the file at once """
+        storage = self.segmented()
+        async with FileLock.write(self.filepath):
+            if storage.filepath.exists():
+                return storage
+
+            filepath_temp = storage.filepath.with_suffix(storage.filepath.suffix + '.tmp')
+            shutil.rmtree(filepath_temp, ignore_errors=True)
+            storage_temp = type('Temp', (type(storage),), {'filepath': filepath_temp})
+            await storage_temp(instrument_id=self.instrument_id, interval=self.interval).from_csv(
+                self.filepath, merge_archive=False
+            )
+            os.replace(filepath_temp, storage.filepath)
+            FileLock.get_filepath(filepath_temp).unlink(missing_ok=True)
+            self.filepath.unlink()
+            CSVIndex.remove(self.filepath)
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+        logging.debug(f'Segmented on insert | {self.filepath} -> {storage.filepath}')
+        return storage
 
     @classmethod
     async def download_or_read(
@@ -47,33 +130,97 @@ class CSVCandles(_CSVCandles):
             from_: datetime,
             to: datetime,
             interval: CandleInterval,
+            columnar: bool = False,
+    ) -> Candles | ColumnarCandles:
+        candles = await cls._download_or_read(instrument=instrument, from_=from_, to=to, interval=interval)
+        return ColumnarCandles.from_candles(candles) if columnar else candles
+
+    @classmethod
+    async def iter_candles(
+            cls,
+            instrument: Instrument,
+            from_: datetime,
+            to: datetime,
+            interval: CandleInterval,
+            window: timedelta | None = None,
+            columnar: bool = False,
+    ) -> AsyncIterator[Candles | ColumnarCandles]:
+        """ Same candles as `download_or_read`, read (downloading missing ones) and yielded window by window, so
+        memory doesn't depend on range length. Windows are not put to `CandleRangeCache`
+        """
+        window = window or get_candle_duration(interval) * cls.ITER_WINDOW_CANDLES
+        from_ = configure_datetime_from(from_=from_, instrument=instrument, interval=interval)
+
+        dt_last = None
+        for from_temp, to_temp in split_datetime_range(from_=from_, to=to, delta=window):
+            candles = await cls._download_or_read(instrument=instrument, from_=from_temp, to=to_temp,
+                                                  interval=interval, use_cache=False, max_fetch=window)
+            if dt_last is not None:
+                candles = [c for c in candles if c.dt > dt_last]
+            if not candles:
+                continue
+
+            dt_last = candles[-1].dt
+            yield ColumnarCandles.from_candles(candles) if columnar else cls.CANDLES(candles)
+
+    @classmethod
+    async def _download_or_read(
+            cls,
+            instrument: Instrument,
+            from_: datetime,
+            to: datetime,
+            interval: CandleInterval,
+            use_cache: bool = True,
+            max_fetch: timedelta | None = None,
     ) -> Candles:
+        """ Missing candles are fetched and written by ranges not longer than `max_fetch` """
         candles = None
         from_ = configure_datetime_from(from_=from_, instrument=instrument, interval=interval)
-        csv = cls(instrument_id=instrument.uid, interval=interval)
+        csv = cls.open(instrument_id=instrument.uid, interval=interval)
+        csv.exchange = instrument.exchange
+
+        if csv.filepath.exists():
+            if use_cache and (candles := CandleRangeCache.get(csv, from_=from_, to=to)) is not None:
+                return candles
 
-        if not csv.filepath.exists():
-            logging.debug(f'File not exists | ticker={instrument.ticker} | uid={instrument.uid}')
-            await csv._prepare_new()
-            candles = await get_candles(instrument_id=instrument.uid, from_=from_, to=to, interval=interval)
-            await csv._append(candles)
-            return candles
+        if not csv.filepath.exists() or csv._is_empty():
+            async with FileLock.write(csv.filepath):
+                # another task or process could fill the file while this one waited for the lock
+                if not csv.filepath.exists() or csv._is_empty():
+                    logging.debug(f'File not exists | ticker={instrument.ticker} | uid={instrument.uid}')
+                    await csv._prepare_new()
+                    with Instrumentation.span('download_or_read', phase='append_fetch'):
+                        candles = await get_candles(instrument_id=instrument.uid, from_=from_, to=to,
+                                                    interval=interval)
+                    with Instrumentation.span('download_or_read', phase='write'):
+                        await csv._append(candles)
+                    return candles
 
         for retry in range(1, 4):
+            csv = csv.current()  # the previous insert could split the file into segments
             try:
-                return await csv._read(from_=from_, to=to, interval=csv.interval)
+                with Instrumentation.span('download_or_read', phase='read'):
+                    candles = await csv._read_range(from_=from_, to=to)
+                if use_cache:
+                    CandleRangeCache.put(csv, from_=from_, to=to, candles=candles)
+                return candles
             except CSVCandlesNeedAppend as ex:
                 logging.debug(f'Need append | {retry=} | ticker={instrument.ticker} | uid={instrument.uid} | from_temp='
                               f'{dt_form_sys.datetime_strf(ex.from_temp)} | to={dt_form_sys.datetime_strf(to)}')
-                # 1st candle in response is last candle in file
-                candles = (await get_candles(instrument_id=instrument.uid, from_=ex.from_temp, to=to, interval=interval))[1:]
+                fetched = 0
+                for from_fetch, to_fetch in split_datetime_range(from_=ex.from_temp, to=to,
+                                                                 delta=max_fetch or to - ex.from_temp):
+                    with Instrumentation.span('download_or_read', phase='append_fetch'):
+                        candles = await get_candles(instrument_id=instrument.uid, from_=from_fetch, to=to_fetch,
+                                                    interval=interval)
+                    # 1st candle in response is last candle in file
+                    candles = cls.CANDLES([c for c in candles if c.dt > ex.from_temp])
+                    candles = candles if not candles or candles[-1].is_complete else candles[:-1]
+                    fetched += len(candles)
+                    await csv._append_fetched(candles)
 
-                if not candles or (len(candles) == 1 and candles[0].is_complete is False):
+                if not fetched:
                     to = ex.candles[-1].dt if to > ex.candles[-1].dt else to
-
-                if candles:
-                    candles = candles if candles[-1].is_complete else candles[:-1]
-                    await csv._append(candles)
             except CSVCandlesNeedInsert as ex:
                 logging.debug(f'Need insert | {retry=} | ticker={instrument.ticker} | uid={instrument.uid} |'
                               f' from={dt_form_sys.datetime_strf(from_)} | '
@@ -81,13 +228,19 @@ class CSVCandles(_CSVCandles):
                 if retry == 3:
                     raise IncorrectFirstCandle(f'{candles[0].dt=} | {from_=}')
 
-                candles = await get_candles(instrument_id=instrument.uid, from_=from_, to=ex.to_temp, interval=interval)
-                # 1st candle in file is last candle in get_candles response
-                candles = candles[:-1]
+                # newer ranges first, every one is inserted right before the first candle in file
+                fetched = 0
+                for from_fetch, to_fetch in reversed(split_datetime_range(from_=from_, to=ex.to_temp,
+                                                                          delta=max_fetch or ex.to_temp - from_)):
+                    with Instrumentation.span('download_or_read', phase='insert_fetch'):
+                        candles = await get_candles(instrument_id=instrument.uid, from_=from_fetch, to=to_fetch,
+                                                    interval=interval)
+                    # 1st candle in file is last candle in get_candles response
+                    candles = cls.CANDLES([c for c in candles if c.dt < to_fetch])
+                    fetched += len(candles)
+                    await csv._insert_fetched(candles)
 
-                if candles:
-                    await csv._insert(candles[:-1])
-                else:
+                if not fetched:
                     logging.debug(f'Nothing between from_={dt_form_sys.datetime_strf(from_)} and to_temp='
                                   f'{dt_form_sys.datetime_strf(ex.to_temp)}')
                     from_ = ex.to_temp
@@ -95,11 +248,246 @@ class CSVCandles(_CSVCandles):
                 logging.error(f'{retry=} | {csv.filepath} | {instrument.ticker=}\n{ex}', exc_info=True)
                 raise ex
 
+    async def _append_fetched(self, candles: Candles) -> None:
+        """ Append candles fetched without lock. Rows appended by another writer meanwhile are not appended twice """
+        if not candles:
+            return
+        async with FileLock.write(self.filepath):
+            last_candle = await self._last_candle()
+            candles = self.CANDLES([c for c in candles if c.dt > last_candle.dt])
+            if candles:
+                with Instrumentation.span('download_or_read', phase='write'):
+                    await self._append(candles)
+
+    async def _insert_fetched(self, candles: Candles) -> None:
+        """ Insert candles fetched without lock. Rows inserted by another writer meanwhile are not inserted twice """
+        if not candles:
+            return
+        async with FileLock.write(self.filepath):
+            first_candle = await self._first_candle()
+            candles = self.CANDLES([c for c in candles if c.dt < first_candle.dt])
+            if candles:
+                with Instrumentation.span('download_or_read', phase='write'):
+                    await self._insert(candles)
+
+    async def _read_range(self, from_: datetime, to: datetime) -> Candles:
+        """ `_read` which loads trading sessions only when `_check_range` needs ones which are not loaded yet """
+        while True:
+            try:
+                return await self._read(from_=from_, to=to, interval=self.interval)
+            except TradingCalendarMissing as ex:
+                await TradingCalendar.update(self.exchange, from_=ex.from_.date(), to=ex.to.date())
+                if not TradingCalendar.is_loaded(self.exchange, from_=ex.from_.date(), to=ex.to.date()):
+                    logging.warning(f'Default trading sessions are used | exchange={self.exchange}')
+                    self.calendar_defaults = True
+
+    async def _prepare_new(self) -> None:
+        async with FileLock.write(self.filepath):
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            async with aiofiles.open(self.filepath, 'w') as f:
+                await f.write(self._header())
+            await CSVIndex.load(self.filepath)
+
+    @_follows_segments
+    async def _read(self, from_: datetime, to: datetime, interval: Interval) -> Candles:
+        async with FileLock.read(self.filepath):
+            index = await CSVIndex.load(self.filepath)
+            offset_from, offset_to = index.offset_from(from_), index.offset_to(to)
+
+            async with aiofiles.open(self.filepath, 'rb') as f:
+                await f.seek(offset_from)
+                data = await f.read(offset_to - offset_from)
+
+            first_candle = self.line2candle(index.first_line)
+            archive = CandleArchive(self.filepath)
+            if from_ < first_candle.dt and archive.exists():
+                archived = archive.read(from_=from_, to=min(to, first_candle.dt - timedelta(microseconds=1)))
+                first_candle = archive.first_candle()
+            else:
+                archived = None
+
+        if Instrumentation.ENABLED:
+            Instrumentation.inc('csv_read_bytes', len(data))
+        lines = [line for line in data.decode().splitlines(keepends=True) if line.endswith('\n')]
+        candles = self.CANDLES([c for c in map(self.line2candle, lines) if from_ <= c.dt <= to])
+        if archived is not None:
+            candles = self.CANDLES([*archived.to_candles(), *candles])
+
+        self._check_range(from_=from_, to=to, first_candle=first_candle,
+                          last_candle=self.line2candle(index.last_line), candles=candles)
+        return candles
+
+    @_follows_segments
+    async def _append(self, candles: Candles) -> None:
+        lines = [self.candle2line(c) for c in candles]
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            index = await CSVIndex.load(self.filepath)
+
+            async with aiofiles.open(self.filepath, 'a') as f:
+                await f.write(''.join(lines))
+
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+            index.add_lines(lines, offset=index.size)
+            index.stamp(self.filepath)
+            await index.save(self.filepath)
+
+    @_follows_segments
+    async def _insert(self, candles: Candles) -> None:
+        """ Rows are prepended to a temp copy which replaces the file, so readers see either old or new file.
+        With archive only candles older than the first row go there, the rest is prepended to file.
+        With `SEGMENT_ON_INSERT` the file is split into monthly segments first and candles are inserted there
+        """
+        if self.SEGMENT_ON_INSERT:
+            await (await self._segment())._insert(candles)
+            return
+
+        lines = [self.candle2line(c) for c in candles]
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            index = await CSVIndex.load(self.filepath)
+            if (archive := CandleArchive(self.filepath)).exists():
+                first_dt = self.line2candle(index.first_line).dt if index.first_line else None
+                await archive.merge(ColumnarCandles.from_candles(
+                    [c for c in candles if first_dt is None or c.dt < first_dt]
+                ))
+                lines = [line for c, line in zip(candles, lines) if first_dt is not None and c.dt >= first_dt]
+                CandleRangeCache.invalidate(self.instrument_id, self.interval)
+                if not lines:
+                    return
+
+            async with aiofiles.open(self.filepath) as f:
+                header = await f.readline()
+                rows = await f.read()
+            await self._write_atomic(self.filepath, (header + ''.join(lines) + rows).encode())
+
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+            index.prepend_lines(lines)
+            index.stamp(self.filepath)
+            await index.save(self.filepath)
+
+    @_follows_segments
+    async def _merge(self, candles: Candles) -> None:
+        """ Put candles between existing rows, e.g. into internal gaps. Existing rows win over candles of the same dt,
+        file is replaced atomically
+        """
+        if not candles:
+            return
+
+        lines = [self.candle2line(c) for c in candles]
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            index = await CSVIndex.load(self.filepath)
+            if (archive := CandleArchive(self.filepath)).exists() and index.first_line:
+                first_candle = self.line2candle(index.first_line)
+                await archive.merge(ColumnarCandles.from_candles([c for c in candles if c.dt < first_candle.dt]))
+                lines = [line for c, line in zip(candles, lines) if c.dt >= first_candle.dt]
+
+            async with aiofiles.open(self.filepath) as f:
+                header = await f.readline()
+                rows = await f.readlines()
+            await self._write_atomic(self.filepath, (header + ''.join(self._merge_lines(rows, lines))).encode())
+
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+            await CSVIndex.load(self.filepath)
+
+    @_follows_segments
+    async def _days(self) -> np.ndarray:
+        """ Sorted UTC days which have candles as `datetime64[D]`, archive included """
+        async with FileLock.read(self.filepath):
+            days = np.array((await CSVIndex.load(self.filepath)).days, dtype='datetime64[D]')
+            if (archive := CandleArchive(self.filepath)).exists():
+                days = np.union1d(archive.days(), days)
+        return days
+
+    @_follows_segments
+    async def _first_candle(self) -> AnyCandle | None:
+        async with FileLock.read(self.filepath):
+            if (archive := CandleArchive(self.filepath)).exists():
+                return archive.first_candle()
+            index = await CSVIndex.load(self.filepath)
+            return self.line2candle(index.first_line) if index.first_line else None
+
+    @_follows_segments
+    async def _last_candle(self) -> AnyCandle | None:
+        async with FileLock.read(self.filepath):
+            index = await CSVIndex.load(self.filepath)
+            return self.line2candle(index.last_line) if index.last_line else None
+
+    def _repair_tail(self) -> None:
+        """ Cut a partial last row left by interrupted append. Only writers call it, readers skip the row """
+        self._cut_partial_row(self.filepath)
+
+    @classmethod
+    def _cut_partial_row(cls, filepath: Path) -> None:
+        with open(filepath, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - cls.MAX_LINE_SIZE))
+            tail = f.read()
+            if not tail or tail.endswith(b'\n'):
+                return
+            f.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+        logging.warning(f'Partial last row was cut | {filepath}')
+
+    @staticmethod
+    def _merge_lines(rows: list[str], lines: list[str]) -> list[str]:
+        """ Rows and lines sorted by dt, rows win over lines of the same dt. Rows are written in UTC, so dt strings
+        sort the same way as datetimes
+        """
+        merged = {line.rsplit(';', 1)[1]: line for line in lines}
+        merged.update((row.rsplit(';', 1)[1], row) for row in rows if row.strip())
+        return [merged[dt] for dt in sorted(merged)]
+
+    def _header(self) -> str:
+        return ';'.join(self.COLUMNS) + '\n'
+
+    def _is_empty(self) -> bool:
+        return self.filepath.stat().st_size <= len(self._header())
+
+    def _check_range(
+            self,
+            from_: datetime,
+            to: datetime,
+            first_candle: AnyCandle,
+            last_candle: AnyCandle,
+            candles: Candles
+    ) -> None:
+        if from_ < first_candle.dt and self._has_trading_time(from_, first_candle.dt):
+            raise CSVCandlesNeedInsert(to_temp=first_candle.dt)
+        dt_next = last_candle.dt + self.candle_duration
+        if to > dt_next and self._has_trading_time(dt_next, to):
+            raise CSVCandlesNeedAppend(from_temp=last_candle.dt, candles=candles or self.CANDLES([last_candle]))
+
+    def _has_trading_time(self, from_: datetime, to: datetime) -> bool:
+        if self.exchange is None:
+            return True
+
+        # the first trading day ends the search, so only the beginning of a long range has to be loaded
+        to_loaded = min(to, from_ + timedelta(days=TradingCalendar.MAX_SCHEDULES_DAYS - 1))
+        if not self.calendar_defaults and not TradingCalendar.is_loaded(self.exchange, from_.date(), to_loaded.date()):
+            raise TradingCalendarMissing(from_=from_, to=to_loaded)
+        return TradingCalendar.has_trading_time(self.exchange, from_=from_, to=to)
+
     @classmethod
     def row2candle(cls, row: list[float | int | datetime]) -> AnyCandle:
         row.append(True)  # is_complete=True
         return cls.CANDLE(*row)
 
+    @classmethod
+    def line2candle(cls, line: str) -> AnyCandle:
+        return cls.row2candle([f(v) for f, v in zip(cls.COLUMNS.values(), line.rstrip('\n').split(';'))])
+
+    @classmethod
+    def candle2line(cls, candle: AnyCandle) -> str:
+        return ';'.join(str(getattr(candle, column)) for column in cls.COLUMNS) + '\n'
+
+    @staticmethod
+    async def _write_atomic(filepath: Path, data: bytes) -> None:
+        filepath_temp = filepath.with_suffix(filepath.suffix + '.tmp')
+        async with aiofiles.open(filepath_temp, 'wb') as f:
+            await f.write(data)
+        os.replace(filepath_temp, filepath)
+
     @classmethod
     def convert_candle_interval(cls, interval: Interval) -> CandleInterval:
         match interval:
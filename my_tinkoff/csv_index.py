@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+from bisect import bisect_left
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Self
+
+import aiofiles
+
+from my_tinkoff.date_utils import TZ_UTC
+
+
+def line2day(line: str) -> str:
+    """ '17.24;17.3;17.24;17.3;38;2024-02-19 07:00:00+00:00' -> '2024-02-19' """
+    return line.rsplit(';', 1)[1][:10]
+
+
+def dt2day(dt: datetime) -> str:
+    return dt.astimezone(TZ_UTC).date().isoformat()
+
+
+@dataclass
+class CSVIndex:
+    """ Sidecar of candles csv file. Maps every day to byte offset of its first row and keeps first/last rows,
+    so range reads seek straight to the requested days.
+    """
+    size: int
+    mtime_ns: int
+    header_size: int
+    first_line: str | None
+    last_line: str | None
+    days: list[str]
+    offsets: list[int]
+
+    _cache = {}
+
+    @staticmethod
+    def get_filepath(filepath_csv: Path) -> Path:
+        return filepath_csv.with_suffix('.idx')
+
+    @classmethod
+    async def load(cls, filepath_csv: Path) -> Self:
+        """ Index from memory or disk. Rebuilt if csv file was changed not through index """
+        stat = filepath_csv.stat()
+
+        index = cls._cache.get(filepath_csv)
+        if index is None and cls.get_filepath(filepath_csv).exists():
+            async with aiofiles.open(cls.get_filepath(filepath_csv)) as f:
+                index = cls(**json.loads(await f.read()))
+
+        if index is None or index.size != stat.st_size or index.mtime_ns != stat.st_mtime_ns:
+            index = await cls.build(filepath_csv)
+            await index.save(filepath_csv)
+
+        cls._cache[filepath_csv] = index
+        return index
+
+    @classmethod
+    async def build(cls, filepath_csv: Path) -> Self:
+        async with aiofiles.open(filepath_csv, 'rb') as f:
+            data = await f.read()
+
+        header_size = data.find(b'\n') + 1
+        index = cls(size=0, mtime_ns=0, header_size=header_size, first_line=None, last_line=None, days=[], offsets=[])
+        lines = data[header_size:].decode().splitlines(keepends=True)
+        if lines and not lines[-1].endswith('\n'):
+            lines.pop()  # partial row of interrupted append, cut by the next writer
+        index.add_lines(lines, offset=header_size)
+        index.stamp(filepath_csv)
+        return index
+
+    async def save(self, filepath_csv: Path) -> None:
+        """ Readers save stale index too, every one through its own temp file """
+        filepath = self.get_filepath(filepath_csv)
+        fd, filepath_temp = tempfile.mkstemp(dir=filepath.parent, prefix=filepath.name, suffix='.tmp')
+        os.close(fd)
+        try:
+            async with aiofiles.open(filepath_temp, 'w') as f:
+                await f.write(json.dumps(asdict(self)))
+            os.replace(filepath_temp, filepath)
+        except BaseException:
+            os.unlink(filepath_temp)
+            raise
+        self._cache[filepath_csv] = self
+
+    @classmethod
+    def remove(cls, filepath_csv: Path) -> None:
+        cls._cache.pop(filepath_csv, None)
+        cls.get_filepath(filepath_csv).unlink(missing_ok=True)
+
+    def stamp(self, filepath_csv: Path) -> None:
+        stat = filepath_csv.stat()
+        self.size, self.mtime_ns = stat.st_size, stat.st_mtime_ns
+
+    def add_lines(self, lines: list[str], offset: int) -> None:
+        """ Register rows appended at `offset` """
+        for line in lines:
+            day = line2day(line)
+            if not self.days or day > self.days[-1]:
+                self.days.append(day)
+                self.offsets.append(offset)
+            offset += len(line.encode())
+
+        if lines:
+            self.first_line = self.first_line or lines[0]
+            self.last_line = lines[-1]
+
+    def prepend_lines(self, lines: list[str]) -> None:
+        """ Register rows inserted right after header """
+        index = self.__class__(size=0, mtime_ns=0, header_size=self.header_size, first_line=None, last_line=None,
+                               days=[], offsets=[])
+        index.add_lines(lines, offset=self.header_size)
+        shift = sum(len(line.encode()) for line in lines)
+
+        days, offsets = self.days, [o + shift for o in self.offsets]
+        if index.days and days and index.days[-1] == days[0]:
+            days, offsets = days[1:], offsets[1:]
+
+        self.days = index.days + days
+        self.offsets = index.offsets + offsets
+        self.first_line = index.first_line or self.first_line
+        self.last_line = self.last_line or index.last_line
+
+    def offset_from(self, dt: datetime) -> int:
+        """ Offset of the first row with day >= `dt` day """
+        i = bisect_left(self.days, dt2day(dt))
+        return self.offsets[i] if i < len(self.offsets) else self.size
+
+    def offset_to(self, dt: datetime) -> int:
+        """ Offset right after the last row with day <= `dt` day """
+        i = bisect_left(self.days, (dt.astimezone(TZ_UTC).date() + timedelta(days=1)).isoformat())
+        return self.offsets[i] if i < len(self.offsets) else self.size
@@ -3,3 +3,27 @@ from enum import StrEnum
 
 class ClassCode(StrEnum):
     TQBR: str = 'TQBR'
+
+
+class Service(StrEnum):
+    INSTRUMENTS: str = 'InstrumentsService'
+    MARKET_DATA: str = 'MarketDataService'
+    MARKET_DATA_STREAM: str = 'MarketDataStreamService'
+    OPERATIONS: str = 'OperationsService'
+    ORDERS: str = 'OrdersService'
+    STOP_ORDERS: str = 'StopOrdersService'
+    USERS: str = 'UsersService'
+    SANDBOX: str = 'SandboxService'
+
+
+class StreamKind(StrEnum):
+    CANDLE: str = 'candle'
+    ORDER_BOOK: str = 'order_book'
+    TRADE: str = 'trade'
+    LAST_PRICE: str = 'last_price'
+
+
+class Overflow(StrEnum):
+    BLOCK: str = 'block'
+    DROP_OLDEST: str = 'drop_oldest'
+    DROP_NEWEST: str = 'drop_newest'
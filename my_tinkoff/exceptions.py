@@ -16,11 +16,29 @@ class RequestedCandleOutOfRange(Exception):
 class ResourceExhausted(TinkoffAPIError):
     """ Token hit limit  """
 
+    def __init__(self, data: Candles = None, reset: int | None = None):
+        self.data = data
+        self.reset = reset
+        super().__init__()
+
+
+class Unavailable(TinkoffAPIError):
+    """ Channel failed in the middle of request, `data` is what was received before """
+
     def __init__(self, data: Candles = None):
         self.data = data
         super().__init__()
 
 
+class TradingCalendarMissing(Exception):
+    """ Range check needs trading sessions which are not loaded yet """
+
+    def __init__(self, from_: datetime, to: datetime):
+        self.from_ = from_
+        self.to = to
+        super().__init__()
+
+
 class UnexpectedInstrumentType(Exception):
     pass
 
@@ -0,0 +1,119 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator
+
+try:
+    import fcntl
+except ImportError:  # Windows, only in-process locking
+    fcntl = None
+
+
+class _State:
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.readers = 0
+        self.writer: asyncio.Task | None = None
+        self.users = 0  # tasks holding or waiting for the lock, idle state is dropped
+
+
+class FileLock:
+    """ Readers-writer lock of one storage file. Inside a process it is an asyncio lock per file, across processes
+    an advisory `flock` of sibling `<file>.lock`. Any count of readers or one writer hold it at the same time, files
+    don't block each other. Writer lock is reentrant for the task which holds it and lets that task read.
+    """
+    SUFFIX = '.lock'
+
+    _states: dict[Path, _State] = {}  # only files which are locked or waited for
+
+    @classmethod
+    def get_filepath(cls, filepath: Path) -> Path:
+        return filepath.with_suffix(filepath.suffix + cls.SUFFIX)
+
+    @classmethod
+    @asynccontextmanager
+    async def read(cls, filepath: Path) -> AsyncIterator[None]:
+        state = cls._states.get(filepath)
+        if state is not None and state.writer is not None and state.writer is asyncio.current_task():
+            yield
+            return
+
+        async with cls._use(filepath) as state:
+            async with state.condition:
+                await state.condition.wait_for(lambda: state.writer is None)
+                state.readers += 1
+            try:
+                async with cls._flock(filepath, exclusive=False):
+                    yield
+            finally:
+                async with state.condition:
+                    state.readers -= 1
+                    state.condition.notify_all()
+
+    @classmethod
+    @asynccontextmanager
+    async def write(cls, filepath: Path) -> AsyncIterator[None]:
+        state = cls._states.get(filepath)
+        task = asyncio.current_task()
+        if state is not None and state.writer is task:
+            yield
+            return
+
+        async with cls._use(filepath) as state:
+            async with state.condition:
+                await state.condition.wait_for(lambda: state.writer is None and state.readers == 0)
+                state.writer = task
+            try:
+                async with cls._flock(filepath, exclusive=True):
+                    yield
+            finally:
+                async with state.condition:
+                    state.writer = None
+                    state.condition.notify_all()
+
+    @classmethod
+    @asynccontextmanager
+    async def _flock(cls, filepath: Path, exclusive: bool) -> AsyncIterator[None]:
+        if fcntl is None:
+            yield
+            return
+
+        filepath = cls.get_filepath(filepath)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(filepath, os.O_RDWR | os.O_CREAT)
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            flock = asyncio.ensure_future(asyncio.to_thread(fcntl.flock, fd, operation))
+            try:
+                await asyncio.shield(flock)
+            except asyncio.CancelledError:
+                # thread still waits on `fd`, it is closed with the lock when `flock` returns, not reused under it
+                flock.add_done_callback(lambda _: os.close(fd))
+                raise
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            os.close(fd)
+            raise
+
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    @classmethod
+    @asynccontextmanager
+    async def _use(cls, filepath: Path) -> AsyncIterator[_State]:
+        """ State of file shared by tasks which hold or wait for its lock """
+        state = cls._states.setdefault(filepath, _State())
+        state.users += 1
+        try:
+            yield state
+        finally:
+            state.users -= 1
+            if not state.users:
+                del cls._states[filepath]
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Iterable
+
+import numpy as np
+from tinkoff.invest import CandleInterval, Instrument
+
+from my_tinkoff.api_calls.market_data import get_candles
+from my_tinkoff.columnar import ns2dt
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.helpers import get_candle_duration
+from my_tinkoff.schemas import Candles
+from my_tinkoff.sync import REQUESTS_IN_FLIGHT_PER_TOKEN
+from my_tinkoff.token_manager import TokenManager
+from my_tinkoff.trading_calendar import TradingCalendar
+
+
+@dataclass
+class Gap:
+    from_: datetime
+    to: datetime
+    days: int
+    candles: int | None = None  # fetched by repair, 0 means instrument didn't trade these days
+    error: BaseException | None = None  # repair failed, gap is left as is
+
+
+@dataclass
+class CoverageReport:
+    instrument: Instrument
+    interval: CandleInterval
+    days_expected: int = 0
+    days_present: int = 0
+    gaps: list[Gap] = field(default_factory=list)
+    error: BaseException | None = None
+    calendar_defaults: bool = False  # sessions are not loaded, gaps are found by weekdays and holidays
+
+    @property
+    def coverage(self) -> float:
+        return self.days_present / self.days_expected if self.days_expected else 1.
+
+    @property
+    def days_missing(self) -> int:
+        return sum(g.days for g in self.gaps)
+
+    @property
+    def repaired(self) -> int:
+        """ Candles fetched into gaps """
+        return sum(g.candles or 0 for g in self.gaps)
+
+    @property
+    def unfillable(self) -> list[Gap]:
+        return [g for g in self.gaps if g.candles == 0]
+
+    @property
+    def failed(self) -> list[Gap]:
+        return [g for g in self.gaps if g.error is not None]
+
+    def __str__(self) -> str:
+        return (f'ticker={self.instrument.ticker} | coverage={self.coverage:.2%} | gaps={len(self.gaps)} | '
+                f'days_missing={self.days_missing} | repaired={self.repaired} | unfillable={len(self.unfillable)} | '
+                f'failed={len(self.failed)} | calendar_defaults={self.calendar_defaults}')
+
+
+def day2dt(day: np.datetime64) -> datetime:
+    return ns2dt(day.astype('datetime64[ns]').astype(np.int64))
+
+
+def find_gaps(days: np.ndarray, exchange: str | None) -> tuple[list[Gap], int]:
+    """ Runs of trading days without candles between the first and the last of sorted `datetime64[D]` days.
+    Non-trading days inside a run belong to it, so every gap is fetched with one range. Returns gaps and count of
+    trading days in the range
+    """
+    if not len(days):
+        return [], 0
+
+    calendar = np.arange(days[0], days[-1] + np.timedelta64(1, 'D'))
+    trading = calendar[TradingCalendar.trading_days(exchange, calendar)]
+    missing = trading[~np.isin(trading, days)]
+    if not len(missing):
+        return [], len(trading)
+
+    positions = np.searchsorted(trading, missing)
+    starts = np.flatnonzero(np.diff(positions, prepend=-2) != 1)
+    ends = np.append(starts[1:], len(missing)) - 1
+    gaps = [Gap(from_=day2dt(missing[s]), to=day2dt(missing[e] + np.timedelta64(1, 'D')), days=int(e - s + 1))
+            for s, e in zip(starts, ends)]
+    return gaps, len(trading)
+
+
+async def scan_gaps(
+        instrument: Instrument,
+        interval: CandleInterval,
+        storage: type[CSVCandles] = CSVCandles,
+) -> CoverageReport:
+    """ Trading days without candles inside the stored range. Intervals longer than a day are not checked """
+    report = CoverageReport(instrument=instrument, interval=interval)
+    csv = storage.open(instrument_id=instrument.uid, interval=interval)
+    if get_candle_duration(interval) > timedelta(days=1) or not csv.filepath.exists() or csv._is_empty():
+        return report
+
+    days = await csv._days()
+    from_, to = days[0].item(), days[-1].item()
+    try:
+        await TradingCalendar.update(instrument.exchange, from_=from_, to=to)
+    except Exception as ex:
+        logging.warning(f'Trading calendar is not updated | ticker={instrument.ticker} | {ex!r}')
+    if not TradingCalendar.is_loaded(instrument.exchange, from_=from_, to=to):
+        logging.warning(f'Default trading sessions are used | ticker={instrument.ticker} | '
+                        f'exchange={instrument.exchange}')
+        report.calendar_defaults = True
+    report.gaps, report.days_expected = find_gaps(days, exchange=instrument.exchange)
+    report.days_present = report.days_expected - report.days_missing
+    return report
+
+
+async def repair_gaps(
+        instruments: Iterable[Instrument],
+        interval: CandleInterval,
+        storage: type[CSVCandles] = CSVCandles,
+        max_in_flight: int | None = None,
+        dry_run: bool = False,
+        on_report: Callable[[CoverageReport], None] | None = None,
+) -> dict[str, CoverageReport]:
+    """ Scan stored candles of many instruments and fetch their gaps concurrently.
+
+    Gaps of all instruments share one limit of requests in flight, scaled by count of tokens in `TokenManager` the
+    same way as `sync_candles`. Fetched candles of one instrument are merged into its file at once.
+    """
+    max_in_flight = max_in_flight or len(TokenManager.list_all()) * REQUESTS_IN_FLIGHT_PER_TOKEN
+    semaphore = asyncio.Semaphore(max_in_flight)
+    instruments = list(instruments)
+
+    started = time.monotonic()
+    reports = await asyncio.gather(*[
+        _repair_instrument(instrument=i, interval=interval, storage=storage, semaphore=semaphore, dry_run=dry_run,
+                           on_report=on_report)
+        for i in instruments
+    ])
+
+    reports = {r.instrument.uid: r for r in reports}
+    gaps = sum(len(r.gaps) for r in reports.values())
+    repaired = sum(r.repaired for r in reports.values())
+    failed = [r.instrument.ticker for r in reports.values() if r.error or r.failed]
+    logging.info(f'Checked {len(reports)} instruments | {gaps=} | {repaired=} | {dry_run=} | '
+                 f'elapsed={time.monotonic() - started:.1f}s | {failed=}')
+    return reports
+
+
+async def _repair_instrument(
+        instrument: Instrument,
+        interval: CandleInterval,
+        storage: type[CSVCandles],
+        semaphore: asyncio.Semaphore,
+        dry_run: bool,
+        on_report: Callable[[CoverageReport], None] | None,
+) -> CoverageReport:
+    report = CoverageReport(instrument=instrument, interval=interval)
+    try:
+        report = await scan_gaps(instrument=instrument, interval=interval, storage=storage)
+        if report.gaps and not dry_run:
+            parts = await asyncio.gather(*[_fetch_gap(instrument, interval, gap, semaphore) for gap in report.gaps],
+                                         return_exceptions=True)
+            # gaps fetched before another one failed are merged anyway
+            for gap, part in zip(report.gaps, parts):
+                if isinstance(part, BaseException):
+                    logging.warning(f'Gap is not repaired | ticker={instrument.ticker} | from_={gap.from_} | '
+                                    f'to={gap.to} | {part!r}')
+                    gap.error = part
+            candles = storage.CANDLES([
+                c for part in parts if not isinstance(part, BaseException) for c in part if c.is_complete is not False
+            ])
+            await storage.open(instrument_id=instrument.uid, interval=interval)._merge(candles)
+        logging.debug(str(report))
+    except Exception as ex:
+        logging.error(f'{report} | {ex}', exc_info=True)
+        report.error = ex
+
+    if on_report:
+        on_report(report)
+    return report
+
+
+async def _fetch_gap(
+        instrument: Instrument,
+        interval: CandleInterval,
+        gap: Gap,
+        semaphore: asyncio.Semaphore,
+) -> Candles:
+    async with semaphore:
+        candles = await get_candles(instrument_id=instrument.uid, from_=gap.from_, to=gap.to, interval=interval)
+    gap.candles = len(candles)
+    return candles
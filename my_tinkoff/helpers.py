@@ -1,6 +1,9 @@
 
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
+from typing import Sequence
+
+import numpy as np
 
 from tinkoff.invest import (
     CandleInterval,
@@ -14,8 +17,20 @@ from trading_helpers.exceptions import UnexpectedCandleInterval
 
 from my_tinkoff.date_utils import DateTimeFactory, dt_form_sys
 from my_tinkoff.schemas import Candle
+from my_tinkoff.columnar import ColumnarCandles, dt2ns
 from my_tinkoff.exceptions import RequestedCandleOutOfRange
 
+NANO = 10 ** 9
+HISTORIC_CANDLE = np.dtype([
+    ('open_units', np.int64), ('open_nano', np.int64),
+    ('high_units', np.int64), ('high_nano', np.int64),
+    ('low_units', np.int64), ('low_nano', np.int64),
+    ('close_units', np.int64), ('close_nano', np.int64),
+    ('volume', np.int64),
+    ('ts', np.int64),
+    ('is_complete', np.bool_),
+])
+
 
 async def configure_datetime_range(
         instrument: Instrument,
@@ -23,9 +38,9 @@ async def configure_datetime_range(
         to: datetime,
         interval: CandleInterval
 ) -> tuple[datetime, datetime]:
-    from my_tinkoff.api_calls.market_data import get_candles
+    from my_tinkoff.trading_calendar import TradingCalendar
 
-    is_from_defined, is_to_defined = False, False
+    is_from_defined = False
     delta = timedelta(days=15)
 
     if interval == CandleInterval.CANDLE_INTERVAL_1_MIN:
@@ -46,75 +61,28 @@ async def configure_datetime_range(
         logging.warning(f'to can\'t be later than datetime now...')
         to = DateTimeFactory.now()
 
-    # check if from_ was trading day OR find the closest early day before
-    from_temp = from_ - delta
-    to_temp = from_ + delta
-    closest_day_early = None
-
-    while not is_from_defined:
-        candles = await get_candles(
-            instrument_id=instrument.uid,
-            from_=from_temp, to=to_temp,
-            delta=delta * 2,
-            interval=CandleInterval.CANDLE_INTERVAL_DAY,
-        )
-
-        if not candles:
-            # Share IPO was after `to_temp`, that's why list of candles is empty
-            break
-
-        for candle in candles:
-            if candle.dt.date() == from_.date():
-                is_from_defined = True
-                break
-            if candle.dt.date() < from_.date():
-                closest_day_early = candle.dt
-        else:
-            if closest_day_early:
-                from_ = closest_day_early.replace(hour=from_.hour, minute=from_.minute,
-                                                  second=from_.second, microsecond=from_.microsecond)
-                is_from_defined = True
+    exchange = instrument.exchange
+    await TradingCalendar.update(exchange, from_=from_.date() - delta, to=from_.date())
+    await TradingCalendar.update(exchange, from_=to.date() - delta, to=to.date() + delta)
 
-            from_temp -= delta * 2
-            to_temp -= delta * 2
+    # check if from_ was trading day OR find the closest early day before
+    if not is_from_defined and not TradingCalendar.is_trading_day(exchange, from_.date()):
+        closest_day_early = TradingCalendar.previous_trading_day(exchange, from_.date())
+        if closest_day_early:
+            from_ = from_.replace(year=closest_day_early.year, month=closest_day_early.month,
+                                  day=closest_day_early.day)
 
     # check if "to" is trading day OR find the closest later day after OR
     # if to is today and last trading day was yesterday, the closest earlier day
-    from_temp = to - delta
-    to_temp = to + delta
-    closest_day_later = None
-    closest_day_early = None
-
-    while not is_to_defined:
-        candles = await get_candles(
-            instrument_id=instrument.uid,
-            from_=from_temp, to=to_temp,
-            delta=delta * 2,
-            interval=CandleInterval.CANDLE_INTERVAL_DAY,
-        )
-
-        if not candles or not candles[-1].is_complete:
-            break
-
-        for candle in candles:
-            if candle.dt.date() == to.date():
-                is_to_defined = True
-                break
-            elif candle.dt.date() > to.date() and not closest_day_later:
-                closest_day_later = candle.dt
-            elif candle.dt.date() < to.date():
-                closest_day_early = candle.dt
-        else:
-            if closest_day_later:
-                to = closest_day_later.replace(hour=to.hour, minute=to.minute,
-                                               second=to.second, microsecond=to.microsecond)
-                is_to_defined = True
-            elif closest_day_early:
-                to = closest_day_early.replace(hour=23, minute=59, second=59, microsecond=999999)
-                is_to_defined = True
+    if not TradingCalendar.is_trading_day(exchange, to.date()):
+        today = DateTimeFactory.now().date()
+        closest_day_later = TradingCalendar.next_trading_day(exchange, to.date())
+        closest_day_early = TradingCalendar.previous_trading_day(exchange, to.date())
 
-            from_temp += delta * 2
-            to_temp += delta * 2
+        if closest_day_later and closest_day_later < today:
+            to = to.replace(year=closest_day_later.year, month=closest_day_later.month, day=closest_day_later.day)
+        elif (not closest_day_later or closest_day_later > today) and closest_day_early:
+            to = datetime.combine(closest_day_early, time.max, tzinfo=to.tzinfo)
 
     return from_, to
 
@@ -133,27 +101,25 @@ def configure_datetime_from(from_: datetime, instrument: Instrument, interval: C
         logging.warning(f'ticker={instrument.ticker} from_={dt_form_sys.datetime_strf(from_)} < first_candle='
                         f'{dt_form_sys.datetime_strf(ex.dt_first_available_candle)}')
 
-        if interval == CandleInterval.CANDLE_INTERVAL_DAY:
+        if get_candle_duration(interval) >= timedelta(days=1):
             return DateTimeFactory.replace_time(ex.dt_first_available_candle)
         else:
             return ex.dt_first_available_candle
 
 
 def check_first_candle_availability(instrument: Instrument, dt: datetime, interval: CandleInterval) -> datetime:
-    if interval == CandleInterval.CANDLE_INTERVAL_1_MIN:
+    """ Intraday intervals are built from 1-min history, day and longer ones from 1-day history """
+    if get_candle_duration(interval) < timedelta(days=1):
         if dt < instrument.first_1min_candle_date:
             raise RequestedCandleOutOfRange(dt_first_available_candle=instrument.first_1min_candle_date)
-    elif interval == CandleInterval.CANDLE_INTERVAL_DAY:
-        if dt < DateTimeFactory.replace_time(instrument.first_1day_candle_date):
-            raise RequestedCandleOutOfRange(dt_first_available_candle=instrument.first_1day_candle_date)
-    else:
-        raise UnexpectedCandleInterval(repr(interval))
+    elif dt < DateTimeFactory.replace_time(instrument.first_1day_candle_date):
+        raise RequestedCandleOutOfRange(dt_first_available_candle=instrument.first_1day_candle_date)
 
     return dt
 
 
 def quotation2decimal(value: Quotation) -> float:
-    return value.units + value.nano * 10 ** -9
+    return (value.units * NANO + value.nano) / NANO
 
 
 def decimal2quotation(value: float) -> Quotation:
@@ -177,11 +143,87 @@ def convert_candle(candle: HistoricCandle) -> Candle:
     )
 
 
+def convert_candles(candles: Sequence[HistoricCandle]) -> ColumnarCandles:
+    """ Batch `convert_candle`. Prices are summed as integer nanos and divided once, same as `quotation2decimal` """
+    raw = np.fromiter(
+        ((c.open.units, c.open.nano, c.high.units, c.high.nano, c.low.units, c.low.nano, c.close.units, c.close.nano,
+          c.volume, dt2ns(c.time), c.is_complete) for c in candles),
+        dtype=HISTORIC_CANDLE,
+        count=len(candles)
+    )
+
+    def _prices(name: str) -> np.ndarray:
+        return (raw[f'{name}_units'] * NANO + raw[f'{name}_nano']) / NANO
+
+    return ColumnarCandles(
+        open=_prices('open'),
+        high=_prices('high'),
+        low=_prices('low'),
+        close=_prices('close'),
+        volume=raw['volume'],
+        ts=raw['ts'],
+        is_complete=raw['is_complete'],
+    )
+
+
 def get_delta_by_interval(interval: CandleInterval) -> timedelta:
+    """ Max range of one `get_candles` request """
     match interval:
+        case (CandleInterval.CANDLE_INTERVAL_1_MIN | CandleInterval.CANDLE_INTERVAL_2_MIN |
+              CandleInterval.CANDLE_INTERVAL_3_MIN | CandleInterval.CANDLE_INTERVAL_5_MIN |
+              CandleInterval.CANDLE_INTERVAL_10_MIN | CandleInterval.CANDLE_INTERVAL_15_MIN):
+            return timedelta(days=1)
+        case CandleInterval.CANDLE_INTERVAL_30_MIN:
+            return timedelta(days=2)
+        case CandleInterval.CANDLE_INTERVAL_HOUR:
+            return timedelta(weeks=1)
+        case CandleInterval.CANDLE_INTERVAL_2_HOUR | CandleInterval.CANDLE_INTERVAL_4_HOUR:
+            return timedelta(days=30)
         case CandleInterval.CANDLE_INTERVAL_DAY:
             return timedelta(days=365)
+        case CandleInterval.CANDLE_INTERVAL_WEEK:
+            return timedelta(days=365 * 2)
+        case CandleInterval.CANDLE_INTERVAL_MONTH:
+            return timedelta(days=365 * 10)
+        case _:
+            raise UnexpectedCandleInterval(interval)
+
+
+def get_candle_duration(interval: CandleInterval) -> timedelta:
+    match interval:
         case CandleInterval.CANDLE_INTERVAL_1_MIN:
+            return timedelta(minutes=1)
+        case CandleInterval.CANDLE_INTERVAL_2_MIN:
+            return timedelta(minutes=2)
+        case CandleInterval.CANDLE_INTERVAL_3_MIN:
+            return timedelta(minutes=3)
+        case CandleInterval.CANDLE_INTERVAL_5_MIN:
+            return timedelta(minutes=5)
+        case CandleInterval.CANDLE_INTERVAL_10_MIN:
+            return timedelta(minutes=10)
+        case CandleInterval.CANDLE_INTERVAL_15_MIN:
+            return timedelta(minutes=15)
+        case CandleInterval.CANDLE_INTERVAL_30_MIN:
+            return timedelta(minutes=30)
+        case CandleInterval.CANDLE_INTERVAL_HOUR:
+            return timedelta(hours=1)
+        case CandleInterval.CANDLE_INTERVAL_2_HOUR:
+            return timedelta(hours=2)
+        case CandleInterval.CANDLE_INTERVAL_4_HOUR:
+            return timedelta(hours=4)
+        case CandleInterval.CANDLE_INTERVAL_DAY:
             return timedelta(days=1)
+        case CandleInterval.CANDLE_INTERVAL_WEEK:
+            return timedelta(weeks=1)
+        case CandleInterval.CANDLE_INTERVAL_MONTH:
+            return timedelta(days=31)
         case _:
             raise UnexpectedCandleInterval(interval)
+
+
+def split_datetime_range(from_: datetime, to: datetime, delta: timedelta) -> list[tuple[datetime, datetime]]:
+    windows = []
+    while from_ < to:
+        windows.append((from_, min(from_ + delta, to)))
+        from_ = windows[-1][1]
+    return windows
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import pickle
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from tinkoff.invest import Instrument, Share, Future, InstrumentIdType, InstrumentShort, InstrumentType
+
+from config import DIR_CANDLES  # noqa
+from my_tinkoff.date_utils import DateTimeFactory, dt_form_sys
+
+AnyInstrument = Instrument | Share | Future
+
+
+class InstrumentCache:
+    """ In-memory shares and futures indexed by uid, figi, (ticker, class_code) and board, and `Instrument` results
+    of `get_instrument_by`. Persisted to `FILEPATH` and refreshed from API once it is older than `TTL`.
+    """
+    FILEPATH = DIR_CANDLES / 'tinkoff' / 'instruments.pickle'
+    TTL = timedelta(days=1)
+
+    _by_uid: dict[str, AnyInstrument] = {}
+    _by_figi: dict[str, AnyInstrument] = {}
+    _by_ticker: dict[tuple[str, str], AnyInstrument] = {}
+    _by_board: dict[str, list[AnyInstrument]] = defaultdict(list)
+    _found: dict[tuple, list[InstrumentShort]] = {}
+    _instruments: dict[tuple[InstrumentIdType, str, str], Instrument] = {}
+    _updated: datetime | None = None
+    _lock: asyncio.Lock | None = None
+    _lock_loop: asyncio.AbstractEventLoop | None = None
+
+    @classmethod
+    async def get(cls, id: str, id_type: InstrumentIdType, class_code: str = '') -> Instrument:
+        """ `get_instrument_by` result, requested once per instrument until the next refresh """
+        from my_tinkoff.api_calls.instruments import fetch_instrument_by
+
+        await cls.load()
+        key = (id_type, id, class_code)
+        if key not in cls._instruments:
+            instrument = await fetch_instrument_by(id=id, id_type=id_type, class_code=class_code)
+            cls._add_instrument(instrument, key)
+            cls._save()
+        return cls._instruments[key]
+
+    @classmethod
+    async def get_by_uid(cls, uid: str) -> AnyInstrument:
+        await cls.load()
+        return cls._by_uid.get(uid) or await cls.get(id=uid, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+
+    @classmethod
+    async def get_by_figi(cls, figi: str) -> AnyInstrument:
+        await cls.load()
+        return cls._by_figi.get(figi) or await cls.get(id=figi, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI)
+
+    @classmethod
+    async def get_by_ticker(cls, ticker: str, class_code: str = '') -> AnyInstrument:
+        await cls.load()
+        return cls._by_ticker.get((ticker, class_code)) or await cls.get(
+            id=ticker, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_TICKER, class_code=class_code)
+
+    @classmethod
+    async def get_board(cls, class_code: str) -> list[AnyInstrument]:
+        await cls.load()
+        return list(cls._by_board[class_code])
+
+    @classmethod
+    async def get_all(cls, kind: type[AnyInstrument]) -> list[AnyInstrument]:
+        await cls.load()
+        return [i for i in cls._by_uid.values() if isinstance(i, kind)]
+
+    @classmethod
+    async def find(
+            cls,
+            query: str,
+            instrument_kind: InstrumentType | None = None,
+            api_trade_available_flag: bool | None = None,
+    ) -> list[InstrumentShort]:
+        """ `find_instrument` results, requested once per query until the next refresh """
+        from my_tinkoff.api_calls.instruments import fetch_find_instrument
+
+        await cls.load()
+        key = (query, instrument_kind, api_trade_available_flag)
+        if key not in cls._found:
+            cls._found[key] = await fetch_find_instrument(query=query, instrument_kind=instrument_kind,
+                                                          api_trade_available_flag=api_trade_available_flag)
+        return cls._found[key]
+
+    @classmethod
+    async def load(cls, force_refresh: bool = False) -> None:
+        async with cls._get_lock():
+            if not force_refresh and cls._is_fresh():
+                return
+
+            if not force_refresh and cls.FILEPATH.exists():
+                with open(cls.FILEPATH, 'rb') as f:
+                    updated, instruments, fetched = pickle.load(f)
+                cls._index(instruments, updated=updated, fetched=fetched)
+                if cls._is_fresh():
+                    return
+
+            await cls._refresh()
+
+    @classmethod
+    async def _refresh(cls) -> None:
+        from my_tinkoff.api_calls.instruments import fetch_shares, fetch_futures
+
+        shares, futures = await asyncio.gather(fetch_shares(), fetch_futures())
+        cls._index(list(shares) + list(futures), updated=DateTimeFactory.now())
+        cls._save()
+        logging.debug(f'Instruments cache refreshed | count={len(cls._by_uid)} | '
+                      f'updated={dt_form_sys.datetime_strf(cls._updated)}')
+
+    @classmethod
+    def _index(
+            cls,
+            instruments: list[AnyInstrument],
+            updated: datetime | None,
+            fetched: dict[tuple[InstrumentIdType, str, str], Instrument] | None = None,
+    ) -> None:
+        cls._by_uid, cls._by_figi, cls._by_ticker, cls._by_board = {}, {}, {}, defaultdict(list)
+        cls._found = {}
+        cls._instruments = dict(fetched or {})
+        for instrument in instruments:
+            cls._add(instrument)
+        cls._updated = updated
+
+    @classmethod
+    def _add(cls, instrument: AnyInstrument) -> None:
+        old = cls._by_uid.get(instrument.uid)
+        if old is not None:
+            cls._by_board[old.class_code].remove(old)
+
+        cls._by_uid[instrument.uid] = instrument
+        cls._by_figi[instrument.figi] = instrument
+        cls._by_ticker[(instrument.ticker, instrument.class_code)] = instrument
+        cls._by_board[instrument.class_code].append(instrument)
+
+    @classmethod
+    def _add_instrument(cls, instrument: Instrument, key: tuple[InstrumentIdType, str, str]) -> None:
+        """ Found by any of its ids later, not only by the requested one """
+        for key in (
+                key,
+                (InstrumentIdType.INSTRUMENT_ID_TYPE_UID, instrument.uid, ''),
+                (InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI, instrument.figi, ''),
+                (InstrumentIdType.INSTRUMENT_ID_TYPE_TICKER, instrument.ticker, instrument.class_code),
+        ):
+            cls._instruments[key] = instrument
+
+    @classmethod
+    def _save(cls) -> None:
+        cls.FILEPATH.parent.mkdir(parents=True, exist_ok=True)
+        filepath_temp = cls.FILEPATH.with_suffix('.tmp')
+        with open(filepath_temp, 'wb') as f:
+            pickle.dump((cls._updated, list(cls._by_uid.values()), cls._instruments), f)
+        os.replace(filepath_temp, cls.FILEPATH)
+
+    @classmethod
+    def _get_lock(cls) -> asyncio.Lock:
+        """ Lock of the running loop, created lazily so the cache works across `asyncio.run` calls """
+        loop = asyncio.get_running_loop()
+        if cls._lock is None or cls._lock_loop is not loop:
+            cls._lock, cls._lock_loop = asyncio.Lock(), loop
+        return cls._lock
+
+    @classmethod
+    def _is_fresh(cls) -> bool:
+        return cls._updated is not None and DateTimeFactory.now() - cls._updated < cls.TTL
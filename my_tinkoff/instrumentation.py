@@ -0,0 +1,135 @@
+import json
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+
+Labels = tuple[tuple[str, str], ...]
+Hook = Callable[[str, float, dict[str, str]], None]
+
+LATENCY_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+SIZE_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+NULL_SPAN = nullcontext()
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...]
+    counts: list[int] = field(default_factory=list)
+    count: int = 0
+    sum: float = 0.
+
+    def __post_init__(self):
+        self.counts = self.counts or [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Instrumentation:
+    """ Process-wide counters and histograms of API calls and storage phases. Disabled by default, every recording
+    call site checks `ENABLED` first, so the cost when disabled is one attribute lookup. Functions in `HOOKS` get
+    every recorded value and labels, e.g. to forward them to another metrics library.
+    """
+    ENABLED = False
+    PREFIX = 'my_tinkoff'
+    HOOKS: list[Hook] = []
+
+    _counters: dict[tuple[str, Labels], float] = {}
+    _histograms: dict[tuple[str, Labels], Histogram] = {}
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels: str) -> None:
+        if not cls.ENABLED:
+            return
+        key = (name, cls._labels(labels))
+        cls._counters[key] = cls._counters.get(key, 0) + value
+        cls._call_hooks(name, value, labels)
+
+    @classmethod
+    def observe(cls, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> None:
+        if not cls.ENABLED:
+            return
+        key = (name, cls._labels(labels))
+        if key not in cls._histograms:
+            cls._histograms[key] = Histogram(buckets)
+        cls._histograms[key].observe(value)
+        cls._call_hooks(name, value, labels)
+
+    @classmethod
+    def span(cls, name: str, **labels: str):
+        """ Context manager which observes its duration to `<name>_seconds` histogram """
+        if not cls.ENABLED:
+            return NULL_SPAN
+        return cls._span(name, labels)
+
+    @classmethod
+    @contextmanager
+    def _span(cls, name: str, labels: dict[str, str]) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.observe(f'{name}_seconds', time.perf_counter() - start, **labels)
+
+    @classmethod
+    def reset(cls) -> None:
+        cls._counters.clear()
+        cls._histograms.clear()
+
+    @classmethod
+    def to_dict(cls) -> dict:
+        return {
+            'counters': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(cls._counters.items())],
+            'histograms': [
+                {'name': n, 'labels': dict(l), 'count': h.count, 'sum': h.sum,
+                 'buckets': dict(zip([*map(str, h.buckets), '+Inf'], h.counts))}
+                for (n, l), h in sorted(cls._histograms.items(), key=lambda x: x[0])
+            ],
+        }
+
+    @classmethod
+    def to_json(cls) -> str:
+        return json.dumps(cls.to_dict())
+
+    @classmethod
+    def to_prometheus(cls) -> str:
+        """ Prometheus text exposition format """
+        lines = []
+        for name in sorted({n for n, _ in cls._counters}):
+            lines.append(f'# TYPE {cls.PREFIX}_{name}_total counter')
+            for (n, labels), value in sorted(cls._counters.items()):
+                if n == name:
+                    lines.append(f'{cls.PREFIX}_{name}_total{cls._format_labels(labels)} {value}')
+
+        for name in sorted({n for n, _ in cls._histograms}):
+            lines.append(f'# TYPE {cls.PREFIX}_{name} histogram')
+            for (n, labels), h in sorted(cls._histograms.items(), key=lambda x: x[0]):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, count in zip([*map(str, h.buckets), '+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f'{cls.PREFIX}_{name}_bucket{cls._format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{cls.PREFIX}_{name}_sum{cls._format_labels(labels)} {h.sum}')
+                lines.append(f'{cls.PREFIX}_{name}_count{cls._format_labels(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def _call_hooks(cls, name: str, value: float, labels: dict[str, str]) -> None:
+        for hook in cls.HOOKS:
+            hook(name, value, labels)
+
+    @staticmethod
+    def _labels(labels: dict[str, str]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _format_labels(labels: Labels) -> str:
+        if not labels:
+            return ''
+        escaped = ((k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
@@ -0,0 +1,194 @@
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from tinkoff.invest import CandleInterval, Instrument
+
+from my_tinkoff.columnar import ColumnarCandles, dt2ns, ns2dt
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import DateTimeFactory
+from my_tinkoff.helpers import get_candle_duration
+from my_tinkoff.schemas import Candles
+from my_tinkoff.trading_calendar import TradingCalendar
+
+# Moscow time has no DST since 2014
+MSK_OFFSET_NS = 3 * 3600 * 10 ** 9
+DAY_NS = 86400 * 10 ** 9
+PERIODS = (
+    CandleInterval.CANDLE_INTERVAL_DAY,
+    CandleInterval.CANDLE_INTERVAL_WEEK,
+    CandleInterval.CANDLE_INTERVAL_MONTH,
+)
+
+
+def get_period_starts(ts: np.ndarray, interval: CandleInterval) -> np.ndarray:
+    """ Intraday periods are aligned to UTC like API candles. Day, week and month follow Moscow calendar and are
+    labeled by 00:00 UTC of their first day
+    """
+    if interval not in PERIODS:
+        step = get_candle_duration(interval) // timedelta(microseconds=1) * 1000
+        return ts - ts % step
+
+    days = (ts + MSK_OFFSET_NS) // DAY_NS
+    match interval:
+        case CandleInterval.CANDLE_INTERVAL_DAY:
+            return days * DAY_NS
+        case CandleInterval.CANDLE_INTERVAL_WEEK:
+            # 1970-01-01 is Thursday
+            return (days - (days + 3) % 7) * DAY_NS
+        case CandleInterval.CANDLE_INTERVAL_MONTH:
+            return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[ns]').view(np.int64)
+
+
+def get_period_ends(starts: np.ndarray, interval: CandleInterval) -> np.ndarray:
+    """ Instants when periods end """
+    match interval:
+        case CandleInterval.CANDLE_INTERVAL_DAY:
+            return starts + DAY_NS - MSK_OFFSET_NS
+        case CandleInterval.CANDLE_INTERVAL_WEEK:
+            return starts + 7 * DAY_NS - MSK_OFFSET_NS
+        case CandleInterval.CANDLE_INTERVAL_MONTH:
+            months = starts.view('datetime64[ns]').astype('datetime64[M]') + np.timedelta64(1, 'M')
+            return months.astype('datetime64[ns]').view(np.int64) - MSK_OFFSET_NS
+        case _:
+            return starts + get_candle_duration(interval) // timedelta(microseconds=1) * 1000
+
+
+def resample(
+        candles: ColumnarCandles,
+        interval: CandleInterval,
+        exchange: str | None = None,
+        now: datetime | None = None,
+) -> ColumnarCandles:
+    """ Aggregate sorted candles of a shorter interval. Candles of days which are not trading days of `exchange` in
+    `TradingCalendar` are skipped. Result candle is complete if every source candle is complete and its period has
+    ended by `now`
+    """
+    if not len(candles):
+        return ColumnarCandles.empty()
+
+    days, inverse = np.unique((candles.ts + MSK_OFFSET_NS) // DAY_NS, return_inverse=True)
+    is_trading = TradingCalendar.trading_days(exchange, days.astype('datetime64[D]'))
+    if not is_trading.all():
+        candles = candles[is_trading[inverse]]
+        if not len(candles):
+            return ColumnarCandles.empty()
+
+    starts = get_period_starts(candles.ts, interval)
+    firsts = np.flatnonzero(np.diff(starts, prepend=starts[0] - 1))
+    lasts = np.append(firsts[1:], len(starts)) - 1
+    period_starts = starts[firsts]
+    is_ended = get_period_ends(period_starts, interval) <= dt2ns(now or DateTimeFactory.now())
+
+    return ColumnarCandles(
+        open=candles.open[firsts],
+        high=np.maximum.reduceat(candles.high, firsts),
+        low=np.minimum.reduceat(candles.low, firsts),
+        close=candles.close[lasts],
+        volume=np.add.reduceat(candles.volume, firsts),
+        ts=period_starts,
+        is_complete=np.logical_and.reduceat(candles.is_complete, firsts) & is_ended,
+    )
+
+
+class ResampledCSVCandles(CSVCandles):
+    """ Resampled series are kept apart from downloaded candles of the same interval """
+    SUFFIX = '.resampled.csv'
+
+    @property
+    def filepath(self) -> Path:
+        return super().filepath.with_suffix(self.SUFFIX)
+
+
+class Resampler:
+    """ Candles of any interval built from stored 1-min (intraday) or 1-day (week, month) candles. Complete candles
+    are saved to `STORAGE` files, so only periods after the last saved one are recomputed.
+    """
+    SOURCE = CSVCandles
+    STORAGE = ResampledCSVCandles
+
+    @classmethod
+    def get_source_interval(cls, interval: CandleInterval) -> CandleInterval:
+        if interval in PERIODS:
+            return CandleInterval.CANDLE_INTERVAL_DAY
+        return CandleInterval.CANDLE_INTERVAL_1_MIN
+
+    @classmethod
+    async def download_or_read(
+            cls,
+            instrument: Instrument,
+            from_: datetime,
+            to: datetime,
+            interval: CandleInterval,
+            columnar: bool = False,
+    ) -> Candles | ColumnarCandles:
+        if interval == CandleInterval.CANDLE_INTERVAL_DAY or interval == cls.get_source_interval(interval):
+            raise ValueError(f'{interval=} is downloaded, not resampled')
+
+        storage = cls.STORAGE.open(instrument_id=instrument.uid, interval=interval)
+        if not storage.filepath.exists() or storage._is_empty():
+            await storage._prepare_new()
+        first_candle, last_candle = await storage._first_candle(), await storage._last_candle()
+        from_ = ns2dt(get_period_starts(np.array([dt2ns(from_)]), interval)[0])
+
+        if first_candle is None:
+            parts = [await cls._resample(instrument, from_=from_, to=to, interval=interval)]
+            await cls._save(storage, parts[0], append=True)
+        else:
+            parts = []
+            if from_ < first_candle.dt:
+                head = await cls._resample(instrument, from_=from_, to=first_candle.dt, interval=interval)
+                head = head[head.ts < dt2ns(first_candle.dt)]
+                await cls._save(storage, head, append=False)
+                parts.append(head)
+
+            if max(from_, first_candle.dt) <= min(to, last_candle.dt):
+                parts.append(ColumnarCandles.from_candles(await storage._read(
+                    from_=max(from_, first_candle.dt), to=min(to, last_candle.dt), interval=interval
+                )))
+
+            next_start = get_period_ends(np.array([dt2ns(last_candle.dt)]), interval)[0]
+            if interval in PERIODS:
+                next_start += MSK_OFFSET_NS  # end of period in Moscow -> label of the next one
+            from_tail = ns2dt(next_start)
+            if from_tail <= to:
+                tail = await cls._resample(instrument, from_=from_tail, to=to, interval=interval)
+                tail = tail[tail.ts > dt2ns(last_candle.dt)]
+                await cls._save(storage, tail, append=True)
+                parts.append(tail)
+
+        candles = ColumnarCandles.concat(parts)
+        candles = candles[np.unique(candles.ts, return_index=True)[1]].slice_by_dt(from_, to)
+        logging.debug(f'Resampled | ticker={instrument.ticker} | {interval=} | count={len(candles)}')
+        return candles if columnar else candles.to_candles()
+
+    @classmethod
+    async def _resample(
+            cls,
+            instrument: Instrument,
+            from_: datetime,
+            to: datetime,
+            interval: CandleInterval
+    ) -> ColumnarCandles:
+        """ Day, week and month start at 00:00 in Moscow, which is earlier than their UTC labels """
+        if interval in PERIODS:
+            from_ -= timedelta(microseconds=MSK_OFFSET_NS // 1000)
+        source = await cls.SOURCE.download_or_read(
+            instrument=instrument, from_=from_, to=to, interval=cls.get_source_interval(interval), columnar=True
+        )
+        if len(source):
+            await TradingCalendar.update(instrument.exchange, from_=ns2dt(source.ts[0]).date(),
+                                         to=ns2dt(source.ts[-1]).date())
+        return resample(source, interval, exchange=instrument.exchange)
+
+    @staticmethod
+    async def _save(storage: CSVCandles, candles: ColumnarCandles, append: bool) -> None:
+        """ Only complete candles are saved, incomplete last period is recomputed on every call """
+        candles = candles[candles.is_complete]
+        if not len(candles):
+            return
+        if append:
+            await storage._append(candles.to_candles())
+        else:
+            await storage._insert(candles.to_candles())
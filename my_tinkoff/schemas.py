@@ -24,5 +24,5 @@ class Instruments(UserList[Instrument]):
 class Shares(Instruments[Share]):
     @classmethod
     async def from_board(cls, board: ClassCode) -> Self:
-        from my_tinkoff.api_calls.instruments import get_shares
-        return cls([s for s in await get_shares() if s.class_code == board.value])
+        from my_tinkoff.instrument_cache import InstrumentCache
+        return cls([s for s in await InstrumentCache.get_board(board.value) if isinstance(s, Share)])
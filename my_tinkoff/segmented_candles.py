@@ -0,0 +1,217 @@
+import json
+import logging
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import aiofiles
+import numpy as np
+from trading_helpers.csv_candles import Interval
+from trading_helpers.schemas import AnyCandle
+
+from my_tinkoff.archive import CandleArchive
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.columnar import ColumnarCandles, dt2ns
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.csv_index import dt2day, line2day
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.schemas import Candles
+
+
+@dataclass
+class Segment:
+    month: str
+    size: int
+    count: int
+    first_line: str
+    last_line: str
+    days: list[str]
+
+
+class SegmentedCSVCandles(CSVCandles):
+    """ Candles of one instrument and interval split into one csv file per month inside a directory, with manifest of
+    first and last rows and days of every segment. Appends and inserts rewrite only segments of their months. Manifest
+    is a cache: segment which size differs from manifest (or is missing from it) is scanned again. Candles older than
+    the first segment are kept in the archive, as for `CSVCandles`.
+    """
+    DIR_SUFFIX = '.segments'
+    SEGMENT_SUFFIX = '.seg'
+    MANIFEST = 'manifest.json'
+    SEGMENT_ON_INSERT = False
+
+    @property
+    def filepath(self) -> Path:
+        return super().filepath.with_suffix(self.DIR_SUFFIX)
+
+    def get_segment_filepath(self, month: str) -> Path:
+        return self.filepath / f'{month}{self.SEGMENT_SUFFIX}'
+
+    async def _prepare_new(self) -> None:
+        async with FileLock.write(self.filepath):
+            self.filepath.mkdir(parents=True, exist_ok=True)
+            await self._save_manifest([])
+
+    async def _read(self, from_: datetime, to: datetime, interval: Interval) -> Candles:
+        async with FileLock.read(self.filepath):
+            segments = await self._load_manifest()
+            if not segments:
+                return self.CANDLES()
+
+            months = self._months(from_, to)
+            lines = []
+            for segment in segments:
+                if months[0] <= segment.month <= months[-1]:
+                    lines += await self._read_lines(segment.month)
+
+            first_candle = self.line2candle(segments[0].first_line)
+            archive = CandleArchive(self.filepath)
+            if from_ < first_candle.dt and archive.exists():
+                archived = archive.read(from_=from_, to=min(to, first_candle.dt - timedelta(microseconds=1)))
+                first_candle = archive.first_candle()
+            else:
+                archived = None
+
+        candles = self.CANDLES([c for c in map(self.line2candle, lines) if from_ <= c.dt <= to])
+        if archived is not None:
+            candles = self.CANDLES([*archived.to_candles(), *candles])
+        self._check_range(from_=from_, to=to, first_candle=first_candle,
+                          last_candle=self.line2candle(segments[-1].last_line), candles=candles)
+        return candles
+
+    async def _append(self, candles: Candles) -> None:
+        await self._write(candles, prepend=False)
+
+    async def _insert(self, candles: Candles) -> None:
+        await self._write(candles, prepend=True)
+
+    async def _merge(self, candles: Candles) -> None:
+        """ Put candles between existing rows. Only segments of their months are rewritten """
+        await self._write(candles, prepend=False, merge=True)
+
+    async def _days(self) -> np.ndarray:
+        """ Sorted UTC days which have candles as `datetime64[D]` from manifest, archive included """
+        async with FileLock.read(self.filepath):
+            days = np.unique(np.array([d for s in await self._load_manifest() for d in s.days], dtype='datetime64[D]'))
+            if (archive := CandleArchive(self.filepath)).exists():
+                days = np.union1d(archive.days(), days)
+        return days
+
+    async def _first_candle(self) -> AnyCandle | None:
+        async with FileLock.read(self.filepath):
+            if (archive := CandleArchive(self.filepath)).exists():
+                return archive.first_candle()
+            segments = await self._load_manifest()
+        return self.line2candle(segments[0].first_line) if segments else None
+
+    async def _last_candle(self) -> AnyCandle | None:
+        async with FileLock.read(self.filepath):
+            segments = await self._load_manifest()
+        return self.line2candle(segments[-1].last_line) if segments else None
+
+    def _repair_tail(self) -> None:
+        """ Cut a partial last row of the last segment left by interrupted append """
+        paths = sorted(self.filepath.glob(f'*{self.SEGMENT_SUFFIX}'))
+        if paths:
+            self._cut_partial_row(paths[-1])
+
+    def _is_empty(self) -> bool:
+        return not any(self.filepath.glob(f'*{self.SEGMENT_SUFFIX}'))
+
+    async def _write(self, candles: Candles, prepend: bool, merge: bool = False) -> None:
+        if not candles:
+            return
+
+        async with FileLock.write(self.filepath):
+            self._repair_tail()
+            segments = {s.month: s for s in await self._load_manifest()}
+            if (prepend or merge) and (archive := CandleArchive(self.filepath)).exists():
+                # candles older than the first row go to the archive, as in `CSVCandles._insert`
+                first_dt = self.line2candle(next(iter(segments.values())).first_line).dt if segments else None
+                await archive.merge(ColumnarCandles.from_candles(
+                    [c for c in candles if first_dt is None or c.dt < first_dt]
+                ))
+                candles = [c for c in candles if first_dt is not None and c.dt >= first_dt]
+                CandleRangeCache.invalidate(self.instrument_id, self.interval)
+                if not candles:
+                    return
+
+            lines = [self.candle2line(c) for c in candles]
+            months = np.array([dt2ns(c.dt) for c in candles]).view('datetime64[ns]').astype('datetime64[M]').astype(str)
+            for month in dict.fromkeys(months.tolist()):
+                part = ''.join(line for line, m in zip(lines, months.tolist()) if m == month)
+                segments[month] = await self._write_segment(month, part, prepend=prepend, merge=merge)
+
+            await self._save_manifest(sorted(segments.values(), key=lambda s: s.month))
+            CandleRangeCache.invalidate(self.instrument_id, self.interval)
+
+    async def _write_segment(self, month: str, data: str, prepend: bool, merge: bool = False) -> Segment:
+        filepath = self.get_segment_filepath(month)
+        if not filepath.exists():
+            await self._write_atomic(filepath, (self._header() + data).encode())
+        elif merge:
+            async with aiofiles.open(filepath) as f:
+                header = await f.readline()
+                rows = await f.readlines()
+            lines = self._merge_lines(rows, data.splitlines(keepends=True))
+            await self._write_atomic(filepath, (header + ''.join(lines)).encode())
+        elif prepend:
+            async with aiofiles.open(filepath) as f:
+                header = await f.readline()
+                rows = await f.read()
+            await self._write_atomic(filepath, (header + data + rows).encode())
+        else:
+            async with aiofiles.open(filepath, 'a') as f:
+                await f.write(data)
+        return await self._scan_segment(month)
+
+    async def _read_lines(self, month: str) -> list[str]:
+        async with aiofiles.open(self.get_segment_filepath(month)) as f:
+            data = await f.read()
+        return [line for line in data.splitlines(keepends=True)[1:] if line.endswith('\n')]
+
+    async def _scan_segment(self, month: str) -> Segment:
+        lines = await self._read_lines(month)
+        return Segment(month=month, size=self.get_segment_filepath(month).stat().st_size, count=len(lines),
+                       first_line=lines[0] if lines else '', last_line=lines[-1] if lines else '',
+                       days=list(dict.fromkeys(map(line2day, lines))))
+
+    async def _load_manifest(self) -> list[Segment]:
+        filepath = self.filepath / self.MANIFEST
+        cached = {}
+        if filepath.exists():
+            async with aiofiles.open(filepath) as f:
+                # segments of manifest written before days were kept are scanned again
+                cached = {s['month']: Segment(**s) for s in json.loads(await f.read())['segments'] if 'days' in s}
+
+        segments = []
+        for path in sorted(self.filepath.glob(f'*{self.SEGMENT_SUFFIX}')):
+            month = path.stem
+            segment = cached.get(month)
+            if segment is None or segment.size != path.stat().st_size:
+                segment = await self._scan_segment(month)
+            if segment.count:
+                segments.append(segment)
+        return segments
+
+    async def _save_manifest(self, segments: list[Segment]) -> None:
+        data = json.dumps({'segments': [asdict(s) for s in segments]})
+        await self._write_atomic(self.filepath / self.MANIFEST, data.encode())
+
+    @staticmethod
+    def _months(from_: datetime, to: datetime) -> list[str]:
+        return [dt2day(from_)[:7], dt2day(to)[:7]]
+
+    async def from_csv(self, filepath_csv: Path, merge_archive: bool = True) -> None:
+        """ Split `CSVCandles` file into segments of this instrument and interval. With `merge_archive=False` its
+        archive is not merged into segments, but stays shared by both layouts
+        """
+        async with FileLock.read(filepath_csv):
+            async with aiofiles.open(filepath_csv) as f:
+                candles = [self.line2candle(line) for line in (await f.readlines())[1:] if line.endswith('\n')]
+            if merge_archive and (archive := CandleArchive(filepath_csv)).exists():
+                archived = ColumnarCandles.concat([archive.read_month(m) for m in archive.months()]).to_candles()
+                candles = [c for c in archived if not candles or c.dt < candles[0].dt] + candles
+
+        await self._prepare_new()
+        await self._append(self.CANDLES(candles))
+        logging.debug(f'Split {len(candles)} candles | {filepath_csv} -> {self.filepath}')
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Hashable
+
+import numpy as np
+
+from my_tinkoff.columnar import ColumnarCandles, dt2ns, ns2dt
+
+FetchCandles = Callable[..., Awaitable[ColumnarCandles]]
+
+
+@dataclass
+class SingleFlightStats:
+    calls: int
+    saved: int
+    narrowed: int
+    in_flight: int
+
+
+@dataclass
+class _Window:
+    from_: int
+    to: int
+    task: asyncio.Task[ColumnarCandles]
+
+
+class SingleFlight:
+    """ Identical concurrent calls share one running call. Candle windows of one instrument and interval which
+    overlap running ones fetch only parts not covered by them. `saved` counts calls which made no request at all,
+    `narrowed` counts candle windows which were fetched partially.
+
+    `ENABLED` coalesces calls of `coalesced` functions (`get_instrument_by`, `get_trading_status`,
+    `get_trading_schedules`, `get_future_by`), it is on by default. Candle windows are opt-in with
+    `CANDLE_WINDOWS = True`, as `get_candles` then fetches ranges window by window even with `max_in_flight` 1.
+    """
+    ENABLED = True
+    CANDLE_WINDOWS = False
+
+    _calls: dict[Hashable, asyncio.Task] = {}
+    _windows: dict[tuple[str, object], list[_Window]] = {}
+    _count = 0
+    _saved = 0
+    _narrowed = 0
+
+    @classmethod
+    async def do(cls, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        if not cls.ENABLED:
+            return await func()
+
+        cls._count += 1
+        if key in cls._calls:
+            cls._saved += 1
+            logging.debug(f'Coalesced | {key=}')
+        else:
+            cls._calls[key] = asyncio.ensure_future(func())
+            cls._calls[key].add_done_callback(lambda _: cls._calls.pop(key, None))
+        return await asyncio.shield(cls._calls[key])
+
+    @classmethod
+    async def get_candles(
+            cls,
+            instrument_id: str,
+            from_: datetime,
+            to: datetime,
+            interval: object,
+            fetch: FetchCandles,
+    ) -> ColumnarCandles:
+        """ Candles of `from_ <= dt <= to`, awaiting running windows which overlap the range and fetching the rest """
+        if not cls.CANDLE_WINDOWS:
+            return await fetch(instrument_id=instrument_id, from_=from_, to=to, interval=interval)
+
+        cls._count += 1
+        ts_from, ts_to = dt2ns(from_), dt2ns(to)
+        key = (instrument_id, interval)
+        windows = cls._windows.setdefault(key, [])
+        overlapping = sorted((w for w in windows if w.from_ < ts_to and w.to > ts_from), key=lambda w: w.from_)
+
+        tasks, cursor = [w.task for w in overlapping], ts_from
+        for w in overlapping + [None]:
+            gap_to = ts_to if w is None else w.from_
+            if cursor < gap_to:
+                tasks.append(cls._fetch_window(key, windows, instrument_id, cursor, gap_to, interval, fetch))
+            cursor = max(cursor, w.to) if w else cursor
+
+        if overlapping:
+            if len(tasks) == len(overlapping):
+                cls._saved += 1
+            else:
+                cls._narrowed += 1
+
+        parts = await asyncio.gather(*[asyncio.shield(t) for t in tasks])
+        candles = ColumnarCandles.concat(parts)
+        return candles[np.unique(candles.ts, return_index=True)[1]].slice_by_dt(from_, to)
+
+    @classmethod
+    def stats(cls) -> SingleFlightStats:
+        return SingleFlightStats(calls=cls._count, saved=cls._saved, narrowed=cls._narrowed,
+                                 in_flight=len(cls._calls) + sum(len(w) for w in cls._windows.values()))
+
+    @classmethod
+    def _fetch_window(
+            cls,
+            key: tuple[str, object],
+            windows: list[_Window],
+            instrument_id: str,
+            ts_from: int,
+            ts_to: int,
+            interval: object,
+            fetch: FetchCandles,
+    ) -> asyncio.Task[ColumnarCandles]:
+        task = asyncio.ensure_future(fetch(instrument_id=instrument_id, from_=ns2dt(ts_from), to=ns2dt(ts_to),
+                                           interval=interval))
+        window = _Window(from_=ts_from, to=ts_to, task=task)
+        windows.append(window)
+        task.add_done_callback(lambda _: cls._remove_window(key, windows, window))
+        return task
+
+    @classmethod
+    def _remove_window(cls, key: tuple[str, object], windows: list[_Window], window: _Window) -> None:
+        windows.remove(window)
+        if not windows and cls._windows.get(key) is windows:
+            del cls._windows[key]
+
+
+def coalesced(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """ Concurrent calls of `func` with equal arguments share one call while `SingleFlight.ENABLED` """
+    async def wrapper(*args, **kwargs):
+        key = (func, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return await func(*args, **kwargs)
+        return await SingleFlight.do(key, lambda: func(*args, **kwargs))
+
+    return wrapper
+
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Iterable
+
+from tinkoff.invest import CandleInterval, Instrument
+
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import DateTimeFactory, dt_form_sys
+from my_tinkoff.helpers import configure_datetime_from, get_delta_by_interval, split_datetime_range
+from my_tinkoff.token_manager import TokenManager
+
+REQUESTS_IN_FLIGHT_PER_TOKEN = 4
+
+
+@dataclass
+class SyncProgress:
+    instrument: Instrument
+    windows: list[tuple[datetime, datetime]]
+    windows_done: int = 0
+    candles: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: float | None = None
+    error: BaseException | None = None
+
+    @property
+    def windows_total(self) -> int:
+        return len(self.windows)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        """ Candles per second """
+        return self.candles / self.elapsed if self.elapsed else 0.
+
+    def __str__(self) -> str:
+        return (f'ticker={self.instrument.ticker} | {self.windows_done}/{self.windows_total} | '
+                f'candles={self.candles} | {self.throughput:.0f} candles/s')
+
+
+async def sync_candles(
+        instruments: Iterable[Instrument],
+        from_: datetime,
+        to: datetime,
+        interval: CandleInterval,
+        window: timedelta | None = None,
+        max_in_flight: int | None = None,
+        storage: type[CSVCandles] = CSVCandles,
+        on_progress: Callable[[SyncProgress], None] | None = None,
+) -> dict[str, SyncProgress]:
+    """ Download or read candles of many instruments concurrently.
+
+    Every instrument walks its range window by window, so its file is written as soon as each window is fetched.
+    Windows of all instruments share one limit of requests in flight, scaled by count of tokens in `TokenManager`.
+    """
+    window = window or get_delta_by_interval(interval)
+    max_in_flight = max_in_flight or len(TokenManager.list_all()) * REQUESTS_IN_FLIGHT_PER_TOKEN
+    semaphore = asyncio.Semaphore(max_in_flight)
+    to = min(to, DateTimeFactory.now())
+
+    progresses = {}
+    for instrument in instruments:
+        windows = split_datetime_range(
+            from_=configure_datetime_from(from_=from_, instrument=instrument, interval=interval), to=to, delta=window
+        )
+        progresses[instrument.uid] = SyncProgress(instrument=instrument, windows=windows)
+
+    started = time.monotonic()
+    await asyncio.gather(*[
+        _sync_instrument(progress=p, interval=interval, storage=storage, semaphore=semaphore, on_progress=on_progress)
+        for p in progresses.values()
+    ])
+
+    elapsed = time.monotonic() - started
+    candles = sum(p.candles for p in progresses.values())
+    failed = [p.instrument.ticker for p in progresses.values() if p.error]
+    logging.info(f'Synced {len(progresses)} instruments | from_={dt_form_sys.datetime_strf(from_)} | '
+                 f'to={dt_form_sys.datetime_strf(to)} | {candles=} | {elapsed=:.1f}s | '
+                 f'{candles / elapsed if elapsed else 0:.0f} candles/s | {failed=}')
+    return progresses
+
+
+async def _sync_instrument(
+        progress: SyncProgress,
+        interval: CandleInterval,
+        storage: type[CSVCandles],
+        semaphore: asyncio.Semaphore,
+        on_progress: Callable[[SyncProgress], None] | None,
+) -> None:
+    dt_last = None
+    try:
+        for from_, to in progress.windows:
+            async with semaphore:
+                candles = await storage.download_or_read(
+                    instrument=progress.instrument, from_=from_, to=to, interval=interval
+                )
+
+            progress.windows_done += 1
+            # neighbour windows share the boundary candle
+            progress.candles += sum(1 for c in candles if dt_last is None or c.dt > dt_last)
+            dt_last = candles[-1].dt if candles else dt_last
+            logging.debug(str(progress))
+            if on_progress:
+                on_progress(progress)
+    except Exception as ex:
+        logging.error(f'{progress} | {ex}', exc_info=True)
+        progress.error = ex
+    finally:
+        progress.finished = time.monotonic()
@@ -1,82 +1,194 @@
 import asyncio
 import logging
 import time
-from datetime import datetime
+from collections import defaultdict
 from typing import Callable
 
-from tinkoff.invest import AsyncClient
+from grpc import StatusCode
+from tinkoff.invest.async_services import AsyncServices
+from tinkoff.invest.exceptions import AioRequestError
 
-from my_tinkoff.exceptions import ResourceExhausted
-from my_tinkoff.date_utils import DateTimeFactory, is_minute_passed
+from my_tinkoff.client_pool import ClientPool
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.enums import Service
+from my_tinkoff.exceptions import ResourceExhausted, Unavailable
+from my_tinkoff.instrumentation import Instrumentation
 from my_tinkoff.schemas import Candles
 from config import TOKENS_FULL_ACCESS, TOKENS_READ_ONLY  # noqa
 
+# Unary requests per minute per token https://russianinvestments.github.io/investAPI/limits/
+LIMITS_PER_MINUTE = {
+    Service.INSTRUMENTS: 200,
+    Service.MARKET_DATA: 600,
+    Service.MARKET_DATA_STREAM: 100,
+    Service.OPERATIONS: 200,
+    Service.ORDERS: 100,
+    Service.STOP_ORDERS: 50,
+    Service.USERS: 100,
+    Service.SANDBOX: 200,
+}
+UNAVAILABLE_RETRIES = 5
+UNAVAILABLE_BACKOFF = 0.5  # seconds before the first retry, doubled for every next one
+UNAVAILABLE_BACKOFF_MAX = 30.
+
+
+class TokenBucket:
+    def __init__(self, limit_per_minute: int):
+        self.capacity = limit_per_minute
+        self.rate = limit_per_minute / 60
+        self.tokens = float(limit_per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.
+
+    @property
+    def available(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens if now >= self.blocked_until else 0.
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def time_until_available(self) -> float:
+        available = self.available
+        return max(self.blocked_until - time.monotonic(), (1 - available) / self.rate, 0.)
+
+    def exhaust(self, reset: float | None = None) -> None:
+        """ Server rejected request. Nothing to spend until `reset` seconds or the next wall-clock minute """
+        self.tokens = 0.
+        self.blocked_until = time.monotonic() + (reset if reset is not None else 60 - time.time() % 60)
+
 
 class TokenManager:
-    _tokens = {t: True for t in TOKENS_FULL_ACCESS + TOKENS_READ_ONLY}
-    _dt: datetime | None = None
+    _tokens = TOKENS_FULL_ACCESS + TOKENS_READ_ONLY
+    _buckets: dict[str, dict[Service, TokenBucket]] = defaultdict(dict)
 
     @classmethod
     def list_all(cls) -> list[str]:
-        return list(cls._tokens.keys())
+        return list(cls._tokens)
 
     @classmethod
-    async def get(cls):
-        assert len(cls.list_all()) > 0, f'{TOKENS_FULL_ACCESS=} | {TOKENS_READ_ONLY=}'
-        token = None
-
-        if cls._dt and is_minute_passed(cls._dt):
-            cls._refresh()
+    def get_bucket(cls, token: str, service: Service) -> TokenBucket:
+        if service not in cls._buckets[token]:
+            cls._buckets[token][service] = TokenBucket(LIMITS_PER_MINUTE[service])
+        return cls._buckets[token][service]
 
-        for t, is_free in cls._tokens.items():
-            if is_free:
-                token = t
-                break
-
-        cls._dt = DateTimeFactory.now()
+    @classmethod
+    async def get(cls, service: Service = Service.MARKET_DATA) -> str:
+        """ Least loaded token. Waits exactly until the first bucket refills if all tokens are spent """
+        assert len(cls.list_all()) > 0, f'{TOKENS_FULL_ACCESS=} | {TOKENS_READ_ONLY=}'
 
-        if token:
-            return token
-        else:
-            sleep_time = 60 - int(time.strftime('%S'))
-            logging.debug(f'{sleep_time} seconds sleep ZZZ... All tokens are busy')
+        while True:
+            buckets = {t: cls.get_bucket(t, service) for t in cls.list_all()}
+            token, bucket = max(buckets.items(), key=lambda x: x[1].available)
+            if bucket.available >= 1:
+                bucket.take()
+                return token
+
+            sleep_time = min(b.time_until_available() for b in buckets.values())
+            logging.debug(f'{sleep_time:.3f} seconds sleep ZZZ... All tokens are busy | {service=}')
+            if Instrumentation.ENABLED:
+                Instrumentation.inc('token_sleep_seconds', sleep_time, service=service)
             await asyncio.sleep(sleep_time)
-            return await cls.get()
-
-    @classmethod
-    def set_busy_flag(cls, token: str) -> None:
-        cls._tokens[token] = False
 
     @classmethod
-    def _refresh(cls):
-        for t in cls._tokens.keys():
-            cls._tokens[t] = True
+    def set_exhausted(cls, token: str, service: Service, reset: float | None = None) -> None:
+        cls.get_bucket(token, service).exhaust(reset)
 
 
-def token_controller(dummy=None, single_response: bool = False) -> Callable:
+def token_controller(
+        dummy=None,
+        single_response: bool = False,
+        service: Service = Service.MARKET_DATA,
+) -> Callable:
     def wrapper_1(func):
+        method = func.__name__
+
         async def wrapper_2(*args, **kwargs):
             out = []
+            unavailable = 0
+
+            def resume(data: Candles | ColumnarCandles | None) -> None:
+                """ Next request continues from the last candle received before the failure """
+                if isinstance(data, (Candles, ColumnarCandles)) and len(data):
+                    out.append(data)
+                    kwargs['from_'] = data[-1].dt
+                    logging.debug(f'{kwargs['from_']=} | {kwargs['to']=}')
+
             while True:
-                t = await TokenManager.get()
-                async with AsyncClient(t) as client:
-                    try:
+                if Instrumentation.ENABLED:
+                    Instrumentation.inc('requests', method=method)
+                    start = time.perf_counter()
+                    t = await TokenManager.get(service)
+                    Instrumentation.observe('token_wait_seconds', time.perf_counter() - start, service=service)
+                else:
+                    t = await TokenManager.get(service)
+                client = await ClientPool.get(t)
+                try:
+                    with Instrumentation.span('request', method=method):
                         if single_response:
                             return await func(client=client, *args, **kwargs)
                         else:
-                            return out + await func(client=client, *args, **kwargs)
-                    except ResourceExhausted as e:
-                        TokenManager.set_busy_flag(t)
-
-                        if isinstance(e.data, Candles) and e.data:
-                            out += e.data
-                            kwargs['from_'] = e.data[-1].dt
-                            logging.debug(f'{kwargs['from_']=} | {kwargs['to']=}')
-                    except Exception:
+                            return join_resumed(out, await func(client=client, *args, **kwargs))
+                except ResourceExhausted as e:
+                    TokenManager.set_exhausted(t, service, reset=e.reset)
+                    Instrumentation.inc('retries', method=method, reason='exhausted')
+                    resume(e.data)
+                except Unavailable as e:
+                    unavailable += 1
+                    await wait_unavailable(e, token=t, client=client, attempt=unavailable, method=method)
+                    resume(e.data)
+                except AioRequestError as e:
+                    if e.code == StatusCode.RESOURCE_EXHAUSTED:
+                        TokenManager.set_exhausted(t, service, reset=get_ratelimit_reset(e))
+                        Instrumentation.inc('retries', method=method, reason='exhausted')
+                    elif e.code == StatusCode.UNAVAILABLE:
+                        unavailable += 1
+                        await wait_unavailable(e, token=t, client=client, attempt=unavailable, method=method)
+                    elif e.code == StatusCode.CANCELLED and not ClientPool.is_current(t, client):
+                        logging.debug(f'{e.code} | channel was replaced while request was running | {method=}')
+                        Instrumentation.inc('retries', method=method, reason='cancelled')
+                    else:
                         raise
+                except Exception:
+                    raise
+
         return wrapper_2
 
     if callable(dummy):
-        wrapper_1(dummy)
+        return wrapper_1(dummy)
     else:
         return wrapper_1
+
+
+async def wait_unavailable(ex: Exception, token: str, client: AsyncServices, attempt: int, method: str) -> None:
+    """ The only place which retries UNAVAILABLE: exponential backoff, channel is replaced only if it is broken """
+    if attempt > UNAVAILABLE_RETRIES:
+        raise ex
+
+    delay = min(UNAVAILABLE_BACKOFF * 2 ** (attempt - 1), UNAVAILABLE_BACKOFF_MAX)
+    logging.warning(f'Unavailable | {method=} | {attempt=} | {delay=:.2f}s | {ex!r}')
+    Instrumentation.inc('retries', method=method, reason='unavailable')
+    await ClientPool.reconnect(token, client)
+    await asyncio.sleep(delay)
+
+
+def join_resumed(
+        parts: list[Candles | ColumnarCandles],
+        data: Candles | ColumnarCandles,
+) -> Candles | ColumnarCandles:
+    """ Candles received before retries followed by the rest. Boundary candle which is returned again by the request
+    resumed from it is kept once
+    """
+    if not parts:
+        return data
+    if isinstance(data, ColumnarCandles):
+        return ColumnarCandles.concat([*parts, data[data.ts > parts[-1].ts[-1]]])
+
+    dt_last = parts[-1][-1].dt
+    return Candles([c for part in parts for c in part] + [c for c in data if c.dt > dt_last])
+
+
+def get_ratelimit_reset(ex: AioRequestError) -> int | None:
+    return getattr(ex.metadata, 'ratelimit_reset', None)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import pickle
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from tinkoff.invest import TradingDay
+
+from config import DIR_CANDLES  # noqa
+from my_tinkoff.date_utils import DateTimeFactory, TZ_UTC
+from my_tinkoff.schemas import Candles
+
+
+@dataclass(frozen=True)
+class Session:
+    date: date
+    is_trading_day: bool
+    start: datetime | None = None
+    end: datetime | None = None
+    expires: datetime | None = None  # session which may still change is requested again later and not saved
+
+
+class TradingCalendar:
+    """ Trading days per exchange built from `get_trading_schedules`. Days which API didn't describe are trading
+    if they are weekdays and not in `Candles.HOLIDAYS`. All lookups are in memory, `update` fetches only missing days.
+    Sessions of past days are saved to `FILEPATH`, today and future ones or the defaults are kept in memory for `TTL`.
+    """
+    FILEPATH = DIR_CANDLES / 'tinkoff' / 'trading_calendar.pickle'
+    MAX_SCHEDULES_DAYS = 14
+    MAX_SEARCH_DAYS = 366
+    TTL = timedelta(hours=1)
+
+    _calendars: dict[str, dict[date, Session]] | None = None
+    _lock: asyncio.Lock | None = None
+    _lock_loop: asyncio.AbstractEventLoop | None = None
+
+    @classmethod
+    async def update(cls, exchange: str, from_: date, to: date) -> None:
+        from my_tinkoff.api_calls.instruments import get_trading_schedules
+
+        async with cls._get_lock():
+            sessions = cls._load().setdefault(exchange, {})
+            now = DateTimeFactory.now()
+            missing = [d for d in cls._days(from_, to) if not cls._is_known(sessions.get(d), now)]
+            if not missing:
+                return
+
+            from_temp = missing[0]
+            while from_temp <= missing[-1]:
+                to_temp = min(from_temp + timedelta(days=cls.MAX_SCHEDULES_DAYS - 1), missing[-1])
+                try:
+                    schedules = await get_trading_schedules(
+                        exchange=exchange,
+                        from_=datetime.combine(from_temp, datetime.min.time(), tzinfo=TZ_UTC),
+                        to=datetime.combine(to_temp, datetime.max.time(), tzinfo=TZ_UTC),
+                    )
+                except Exception as ex:
+                    logging.warning(f'Trading schedules are not available | {exchange=} | {from_temp=} | {to_temp=} '
+                                    f'| {ex!r}')
+                    break
+
+                days = {d.date.date(): d for s in schedules if s.exchange == exchange for d in s.days}
+                for day in cls._days(from_temp, to_temp):
+                    session = cls._convert_day(days[day]) if day in days else cls._default_session(day)
+                    if day not in days or day >= now.date():
+                        session = replace(session, expires=now + cls.TTL)
+                    sessions[day] = session
+                from_temp = to_temp + timedelta(days=1)
+
+            cls._save()
+
+    @classmethod
+    def is_loaded(cls, exchange: str, from_: date, to: date) -> bool:
+        """ Whether sessions of every day of the range are known, so `update` would request nothing """
+        sessions, now = cls._load().get(exchange, {}), DateTimeFactory.now()
+        return all(cls._is_known(sessions.get(d), now) for d in cls._days(from_, to))
+
+    @classmethod
+    def get_session(cls, exchange: str, day: date) -> Session:
+        return cls._load().get(exchange, {}).get(day) or cls._default_session(day)
+
+    @classmethod
+    def is_trading_day(cls, exchange: str, day: date) -> bool:
+        return cls.get_session(exchange, day).is_trading_day
+
+    @classmethod
+    def trading_days(cls, exchange: str, days: np.ndarray) -> np.ndarray:
+        """ `is_trading_day` mask of `datetime64[D]` days in one vectorized pass """
+        mask = np.is_busday(days, holidays=np.array(sorted(Candles.HOLIDAYS), dtype='datetime64[D]'))
+        sessions = cls._load().get(exchange, {})
+        if sessions:
+            known = np.array(list(sessions), dtype='datetime64[D]')
+            order = np.argsort(known)
+            known = known[order]
+            is_trading = np.array([s.is_trading_day for s in sessions.values()])[order]
+            i = np.minimum(np.searchsorted(known, days), len(known) - 1)
+            found = known[i] == days
+            mask[found] = is_trading[i[found]]
+        return mask
+
+    @classmethod
+    def previous_trading_day(cls, exchange: str, day: date) -> date | None:
+        for i in range(1, cls.MAX_SEARCH_DAYS):
+            if cls.is_trading_day(exchange, day - timedelta(days=i)):
+                return day - timedelta(days=i)
+
+    @classmethod
+    def next_trading_day(cls, exchange: str, day: date) -> date | None:
+        for i in range(1, cls.MAX_SEARCH_DAYS):
+            if cls.is_trading_day(exchange, day + timedelta(days=i)):
+                return day + timedelta(days=i)
+
+    @classmethod
+    def has_trading_time(cls, exchange: str, from_: datetime, to: datetime) -> bool:
+        """ Whether any session intersects [from_, to). Day without known session time counts as whole trading day """
+        for day in cls._days(from_.date(), to.date()):
+            session = cls.get_session(exchange, day)
+            if not session.is_trading_day:
+                continue
+            if session.start and session.end and (to <= session.start or from_ >= session.end):
+                continue
+            return True
+        return False
+
+    @classmethod
+    def _get_lock(cls) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if cls._lock is None or cls._lock_loop is not loop:
+            cls._lock, cls._lock_loop = asyncio.Lock(), loop
+        return cls._lock
+
+    @classmethod
+    def _load(cls) -> dict[str, dict[date, Session]]:
+        if cls._calendars is None:
+            cls._calendars = {}
+            if cls.FILEPATH.exists():
+                with open(cls.FILEPATH, 'rb') as f:
+                    cls._calendars = pickle.load(f)
+        return cls._calendars
+
+    @classmethod
+    def _save(cls) -> None:
+        cls.FILEPATH.parent.mkdir(parents=True, exist_ok=True)
+        filepath_temp = cls.FILEPATH.with_suffix('.tmp')
+        with open(filepath_temp, 'wb') as f:
+            pickle.dump({
+                exchange: {day: s for day, s in sessions.items() if s.expires is None}
+                for exchange, sessions in cls._calendars.items()
+            }, f)
+        os.replace(filepath_temp, cls.FILEPATH)
+
+    @staticmethod
+    def _is_known(session: Session | None, now: datetime) -> bool:
+        return session is not None and (session.expires is None or session.expires > now)
+
+    @staticmethod
+    def _days(from_: date, to: date) -> list[date]:
+        return [from_ + timedelta(days=i) for i in range((to - from_).days + 1)]
+
+    @staticmethod
+    def _default_session(day: date) -> Session:
+        return Session(date=day, is_trading_day=day.weekday() < 5 and day not in Candles.HOLIDAYS)
+
+    @staticmethod
+    def _convert_day(day: TradingDay) -> Session:
+        start, end = day.start_time, day.end_time
+        if day.evening_end_time and day.evening_end_time.year > 2000:
+            end = max(end, day.evening_end_time)
+        if not start or not end or start.year < 2000:
+            start = end = None
+        return Session(date=day.date.date(), is_trading_day=day.is_trading_day, start=start, end=end)
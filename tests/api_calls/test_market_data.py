@@ -1,10 +1,13 @@
 import pytest
 
+from datetime import timedelta
+
 from tinkoff.invest import GetTradingStatusResponse
 
 from my_tinkoff.api_calls.market_data import (
     get_candles,
-    get_trading_status
+    get_trading_status,
+    iter_candles,
 )
 from my_tinkoff.schemas import Candles, Candle
 from tests.dataset import SBER, dataset_candles
@@ -20,6 +23,26 @@ async def test_get_candles(instrument, case) -> None:
     assert r[-1].dt == case.dt_last_candle
 
 
+@pytest.mark.parametrize("instrument,case", dataset_candles)
+async def test_get_candles_concurrently(instrument, case) -> None:
+    r = await get_candles(instrument_id=instrument.uid, from_=case.dt_from, to=case.dt_to, interval=case.interval,
+                          max_in_flight=4)
+    expected = await get_candles(instrument_id=instrument.uid, from_=case.dt_from, to=case.dt_to,
+                                 interval=case.interval)
+    assert r == expected
+
+
+@pytest.mark.parametrize("instrument,case", dataset_candles)
+async def test_iter_candles(instrument, case) -> None:
+    candles = Candles()
+    async for chunk in iter_candles(instrument_id=instrument.uid, from_=case.dt_from, to=case.dt_to,
+                                    interval=case.interval, delta=timedelta(hours=6)):
+        candles += chunk
+    expected = await get_candles(instrument_id=instrument.uid, from_=case.dt_from, to=case.dt_to,
+                                 interval=case.interval)
+    assert candles == expected
+
+
 async def test_get_trading_status() -> None:
     r = await get_trading_status(instrument_id=SBER.uid)
     assert isinstance(r, GetTradingStatusResponse)
@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import grpc
+from tinkoff.invest import SubscriptionAction, SubscriptionInterval
+
+from my_tinkoff.api_calls import market_data_stream
+from my_tinkoff.api_calls.market_data_stream import (
+    MarketDataStreamManager,
+    StreamCandle,
+    StreamConsumer,
+    StreamLastPrice,
+    Subscription,
+    build_requests,
+)
+from my_tinkoff.client_pool import ClientPool, _PooledClient
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.enums import Overflow, StreamKind
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.token_manager import TokenManager
+from tests.dataset import SBER, CNTL
+
+
+INTERVAL = SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE
+
+
+def _candle(minute: int) -> Candle:
+    return Candle(open=1, high=1, low=1, close=1, volume=1, is_complete=False,
+                  dt=datetime(2024, 2, 19, 10, minute, tzinfo=TZ_UTC))
+
+
+def _event(price: float) -> StreamLastPrice:
+    return StreamLastPrice(instrument_uid=SBER.uid, price=price, dt=datetime(2024, 2, 19, tzinfo=TZ_UTC))
+
+
+async def test_consumer_drop_oldest():
+    consumer = StreamConsumer(maxsize=2, overflow=Overflow.DROP_OLDEST)
+    for price in (1, 2, 3):
+        await consumer.put(_event(price))
+
+    assert consumer.dropped == 1
+    assert [(await consumer.get()).price for _ in range(2)] == [2, 3]
+
+
+async def test_consumer_drop_newest():
+    consumer = StreamConsumer(maxsize=2, overflow=Overflow.DROP_NEWEST)
+    for price in (1, 2, 3):
+        await consumer.put(_event(price))
+
+    assert consumer.dropped == 1
+    assert [(await consumer.get()).price for _ in range(2)] == [1, 2]
+
+
+def test_consumer_filter():
+    consumer = StreamConsumer(maxsize=1, overflow=Overflow.BLOCK, kinds={StreamKind.LAST_PRICE},
+                              instrument_uids={CNTL.uid})
+    assert not consumer.accepts(StreamKind.LAST_PRICE, _event(1))
+    assert not consumer.accepts(StreamKind.TRADE, _event(1))
+
+
+def test_build_requests():
+    requests = build_requests(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, [
+        Subscription(StreamKind.LAST_PRICE, SBER.uid),
+        Subscription(StreamKind.LAST_PRICE, CNTL.uid),
+        Subscription(StreamKind.ORDER_BOOK, SBER.uid, depth=20),
+    ])
+    assert len(requests) == 2
+    assert len(requests[0].subscribe_order_book_request.instruments) == 1
+    assert len(requests[1].subscribe_last_price_request.instruments) == 2
+
+
+async def test_dispatch_candle_drops_older():
+    manager = MarketDataStreamManager()
+    consumer = manager.consumer()
+    interval = SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE
+    for minute in (1, 2, 1, 2, 3):
+        candle = Candle(open=1, high=1, low=1, close=1, volume=1, is_complete=False,
+                        dt=datetime(2024, 2, 19, 10, minute, tzinfo=TZ_UTC))
+        await manager.dispatch_candle(StreamCandle(instrument_uid=SBER.uid, interval=interval, candle=candle))
+
+    assert [(await consumer.get()).candle.dt.minute for _ in range(consumer.queue.qsize())] == [1, 2, 2, 3]
+    assert manager.last_candle_dt[(SBER.uid, interval)].minute == 3
+
+
+async def test_reconnect_over_healthy_channel_and_backfill_in_background(monkeypatch):
+    backfill_started, backfill_release = asyncio.Event(), asyncio.Event()
+    opened = []
+
+    async def _market_data_stream(requests):
+        opened.append(len(opened))
+        if len(opened) == 1:
+            yield StreamCandle(instrument_uid=SBER.uid, interval=INTERVAL, candle=_candle(1))
+            raise ConnectionResetError('stream reset')
+        yield StreamCandle(instrument_uid=SBER.uid, interval=INTERVAL, candle=_candle(4))
+        await backfill_started.wait()
+        yield StreamCandle(instrument_uid=SBER.uid, interval=INTERVAL, candle=_candle(5))
+        backfill_release.set()
+        await asyncio.Event().wait()
+
+    async def _get_candles(instrument_id, from_, to, interval) -> Candles:
+        backfill_started.set()
+        await backfill_release.wait()
+        return Candles([_candle(m) for m in (1, 2, 3)])
+
+    channel = SimpleNamespace(get_state=lambda try_to_connect=False: grpc.ChannelConnectivity.IDLE)
+    services = SimpleNamespace(market_data_stream=SimpleNamespace(market_data_stream=_market_data_stream))
+    monkeypatch.setattr(ClientPool, '_clients', {'token': _PooledClient(channel=channel, services=services)})
+    monkeypatch.setattr(TokenManager, '_tokens', ['token'])
+    monkeypatch.setattr(market_data_stream, 'get_candles', _get_candles)
+    monkeypatch.setattr(market_data_stream, 'RECONNECT_BACKOFF_BASE', 0.001)
+
+    manager = MarketDataStreamManager()
+    manager.dispatch = manager.dispatch_candle
+    consumer = manager.consumer()
+    manager.subscribe_candles([SBER.uid], interval=INTERVAL)
+
+    minutes = [(await asyncio.wait_for(consumer.get(), 1)).candle.dt.minute for _ in range(6)]
+    await manager.close()
+
+    assert minutes == [1, 4, 5, 1, 2, 3]
+    assert len(opened) == 2 and ClientPool._clients['token'].services is services
+    assert manager.metrics.reconnects == 1 and manager.metrics.backfilled_candles == 3
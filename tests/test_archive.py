@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.archive import CandleArchive, compact, decode_block, encode_block
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from tests.dataset import SBER
+
+
+def _candles(from_: datetime, count: int) -> Candles:
+    rng = np.random.default_rng(0)
+    closes = np.round(270 + rng.normal(0, 0.5, count).cumsum(), 2)
+    return Candles([
+        Candle(open=c, high=round(c + 0.13, 2), low=round(c - 0.07, 2), close=c, volume=int(i * 7 % 1000),
+               dt=from_ + timedelta(hours=i), is_complete=True)
+        for i, c in enumerate(closes.tolist())
+    ])
+
+
+def test_block_roundtrip():
+    candles = ColumnarCandles.from_candles(_candles(datetime(2024, 1, 1, tzinfo=TZ_UTC), 500))
+    decoded = decode_block(encode_block(candles))
+    for field in ColumnarCandles.__slots__:
+        assert np.array_equal(getattr(decoded, field), getattr(candles, field))
+
+
+async def test_compact_and_read(tmp_path):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv', 'SEGMENT_ON_INSERT': False})
+    csv = storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_HOUR)
+    candles = _candles(datetime(2024, 1, 1, tzinfo=TZ_UTC), 24 * 75)
+    await csv._prepare_new()
+    await csv._append(candles)
+
+    assert await compact(csv.filepath) == 24 * 60
+    assert CandleArchive(csv.filepath).months() == ['2024-01', '2024-02']
+
+    from_, to = candles[100].dt, candles[-1].dt
+    assert await csv._read(from_=from_, to=to, interval=csv.interval) == candles[100:]
+
+    older = _candles(datetime(2023, 12, 31, tzinfo=TZ_UTC), 24)
+    rows = csv.filepath.read_bytes()
+    await csv._insert(older)
+    assert CandleArchive(csv.filepath).months() == ['2023-12', '2024-01', '2024-02']
+    assert csv.filepath.read_bytes() == rows
+    assert await csv._read(from_=older[0].dt, to=to, interval=csv.interval) == Candles([*older, *candles])
+
+
+async def test_insert_splits_by_first_row(tmp_path):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    csv = storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_HOUR)
+    candles = _candles(datetime(2024, 1, 1, tzinfo=TZ_UTC), 24 * 75)
+    await csv._prepare_new()
+    await csv._append(Candles(candles[24 * 60 - 3:]))
+    await compact(csv.filepath)
+
+    # Feb 29 21:00 is archived, file starts at Mar 1 00:00
+    await csv._insert(Candles(candles[24 * 60 - 5:24 * 60 - 3]))
+    assert CandleArchive(csv.filepath).months() == ['2024-02']
+    assert CandleArchive(csv.filepath).read_month('2024-02').to_candles() == candles[24 * 60 - 5:24 * 60]
+    from_ = candles[24 * 60 - 5].dt
+    assert await csv._read(from_=from_, to=candles[-1].dt, interval=csv.interval) == candles[24 * 60 - 5:]
@@ -0,0 +1,46 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from my_tinkoff.binary_candles import BinaryCandles
+from my_tinkoff.csv_candles import CSVCandles
+from tests.dataset import CASE_SBER_FULL_RANGE_EXISTS, CASE_CNTL_FULL_RANGE_EXISTS, SBER, CNTL
+
+
+def _storage(base: type[CSVCandles], filepath: Path) -> type[CSVCandles]:
+    return type('Storage', (base,), {'filepath': filepath})
+
+
+@pytest.mark.parametrize("instrument,case", [
+    (SBER, CASE_SBER_FULL_RANGE_EXISTS),
+    (CNTL, CASE_CNTL_FULL_RANGE_EXISTS),
+])
+async def test_from_csv(instrument, case, tmp_path):
+    filepath_csv = tmp_path / case.filepath.name
+    shutil.copy(case.filepath, filepath_csv)
+    storage = _storage(BinaryCandles, await BinaryCandles.from_csv(filepath_csv))
+
+    binary = storage(instrument_id=instrument.uid, interval=case.interval)
+    candles = binary.read_columnar(from_=case.dt_from, to=case.dt_to)
+    assert len(candles) == case.count_candles
+    assert candles[0].dt == case.dt_first_candle
+    assert candles[-1].dt == case.dt_last_candle
+
+    expected = await _storage(CSVCandles, filepath_csv)(instrument_id=instrument.uid, interval=case.interval)._read(
+        from_=case.dt_from, to=case.dt_to, interval=case.interval)
+    assert await binary._read(from_=case.dt_from, to=case.dt_to, interval=case.interval) == expected
+
+
+async def test_append_insert(tmp_path):
+    case = CASE_CNTL_FULL_RANGE_EXISTS
+    candles = await _storage(CSVCandles, case.filepath)(instrument_id=CNTL.uid, interval=case.interval)._read(
+        from_=case.dt_from, to=case.dt_to, interval=case.interval)
+
+    binary = _storage(BinaryCandles, tmp_path / 'CNTL.bin')(instrument_id=CNTL.uid, interval=case.interval)
+    await binary._prepare_new()
+    assert binary._is_empty()
+    assert await binary._read(from_=case.dt_from, to=case.dt_to, interval=case.interval) == []
+    await binary._append(candles[100:])
+    await binary._insert(candles[:100])
+    assert binary.read_columnar(from_=case.dt_from, to=case.dt_to).to_candles() == candles
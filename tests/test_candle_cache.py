@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from tests.dataset import SBER
+
+DT = datetime(2024, 2, 19, 10, tzinfo=TZ_UTC)
+
+
+def _candles(from_minute: int, to_minute: int) -> Candles:
+    return Candles([Candle(open=m, high=m, low=m, close=m, volume=m, is_complete=True, dt=DT + timedelta(minutes=m))
+                    for m in range(from_minute, to_minute + 1)])
+
+
+async def test_cache_merges_and_invalidates(tmp_path):
+    CandleRangeCache.clear()
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    csv = storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_1_MIN)
+    await csv._prepare_new()
+    await csv._append(_candles(0, 59))
+
+    def minutes(from_minute: int, to_minute: int) -> tuple[datetime, datetime]:
+        return DT + timedelta(minutes=from_minute), DT + timedelta(minutes=to_minute)
+
+    CandleRangeCache.put(csv, *minutes(0, 20), candles=_candles(0, 20))
+    CandleRangeCache.put(csv, *minutes(10, 30), candles=_candles(10, 30))
+    assert CandleRangeCache.stats().ranges == 1
+
+    candles = CandleRangeCache.get(csv, *minutes(5, 25))
+    assert [c.close for c in candles] == list(range(5, 26))
+    assert CandleRangeCache.get(csv, *minutes(25, 35)) is None
+    assert (CandleRangeCache.stats().hits, CandleRangeCache.stats().misses) == (1, 1)
+
+    await csv._append(_candles(60, 60))
+    assert CandleRangeCache.get(csv, *minutes(5, 25)) is None
+    assert CandleRangeCache.stats().nbytes == 0
+
+
+async def test_cache_eviction(tmp_path, monkeypatch):
+    CandleRangeCache.clear()
+    monkeypatch.setattr(CandleRangeCache, 'MAX_BYTES', 100 * 57)
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    for uid in ('a', 'b'):
+        csv = storage(instrument_id=uid, interval=CandleInterval.CANDLE_INTERVAL_1_MIN)
+        CandleRangeCache.put(csv, DT, DT + timedelta(minutes=59), candles=_candles(0, 59))
+
+    stats = CandleRangeCache.stats()
+    assert (stats.entries, stats.evictions) == (1, 1)
+    assert stats.nbytes <= stats.max_bytes
@@ -0,0 +1,184 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from tinkoff.invest import CandleInterval, SubscriptionInterval
+
+from my_tinkoff.api_calls.market_data_stream import StreamCandle
+from my_tinkoff.candle_service import CandleService, CandleServiceClient, CandleServiceError, _Connection
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from tests.dataset import SBER
+
+DT = datetime(2024, 2, 19, 10, tzinfo=TZ_UTC)
+INTERVAL = CandleInterval.CANDLE_INTERVAL_1_MIN
+
+
+class _Storage:
+    calls = 0
+
+    @classmethod
+    async def download_or_read(cls, instrument, from_, to, interval, columnar=False):
+        cls.calls += 1
+        await asyncio.sleep(0.05)
+        minutes = int((to - from_) / timedelta(minutes=1))
+        return ColumnarCandles.from_candles(Candles([
+            Candle(open=1, high=2, low=0.5, close=1.5, volume=i, dt=from_ + timedelta(minutes=i), is_complete=True)
+            for i in range(minutes + 1)
+        ]))
+
+
+class _Service(CandleService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unsubscribed = []
+
+    async def get_instrument(self, instrument_uid):
+        return SBER
+
+    def subscribe_candles(self, instrument_uids, interval):
+        pass
+
+    def unsubscribe_candles(self, instrument_uids, interval):
+        self.unsubscribed += instrument_uids
+
+
+def _event(minute: int) -> StreamCandle:
+    return StreamCandle(
+        instrument_uid=SBER.uid,
+        interval=SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE,
+        candle=Candle(open=1, high=2, low=0.5, close=1.5, volume=3, dt=DT + timedelta(minutes=minute),
+                      is_complete=False),
+    )
+
+
+async def test_deduplicates_in_flight_requests(tmp_path):
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    await service.start()
+    try:
+        async with CandleServiceClient(path=service.path) as a, CandleServiceClient(path=service.path) as b:
+            to = DT + timedelta(minutes=9)
+            x, y = await asyncio.gather(a.get_candles(SBER.uid, DT, to, INTERVAL),
+                                        b.get_candles(SBER.uid, DT, to, INTERVAL))
+            assert _Storage.calls == 1
+            assert service.stats.deduplicated == 1
+            assert len(x) == 10 and x == y
+            assert x[0].dt == DT and x[-1].volume == 9
+
+            await a.get_candles(SBER.uid, DT, to, INTERVAL, columnar=True)
+            assert _Storage.calls == 2
+    finally:
+        await service.close()
+
+
+async def test_live_candles(tmp_path):
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    await service.start()
+    try:
+        async with CandleServiceClient(path=service.path) as client:
+            events = client.subscribe_candles([SBER.uid])
+            received = asyncio.create_task(anext(events))
+            await asyncio.sleep(0.05)
+            await service.stream_manager.dispatch_candle(_event(0))
+
+            received = await asyncio.wait_for(received, timeout=1)
+            assert received.instrument_uid == SBER.uid
+            assert received.candle.close == 1.5 and received.candle.dt == DT
+    finally:
+        await service.close()
+
+
+async def test_disconnected_client(tmp_path):
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    await service.start()
+    try:
+        async with CandleServiceClient(path=service.path) as client:
+            request = asyncio.create_task(client.get_candles(SBER.uid, DT, DT + timedelta(minutes=9), INTERVAL))
+            await asyncio.sleep(0.01)
+            assert service.stats.clients == 1 and service._in_flight
+        with pytest.raises(CandleServiceError):  # response never comes to closed client
+            await asyncio.wait_for(request, timeout=1)
+        await asyncio.sleep(0.1)
+
+        assert service.stats.clients == 0
+    finally:
+        await service.close()
+
+
+class _GoneConnection:
+    subscriptions = set()
+
+    async def send(self, kind, request_id, payload):
+        raise BrokenPipeError()
+
+
+async def test_response_to_gone_client(tmp_path):
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    request = {'method': 'get_candles', 'instrument_uid': SBER.uid, 'from': 0, 'to': 60 * 10 ** 9,
+               'interval': int(INTERVAL)}
+    await service._respond(_GoneConnection(), 1, request)
+    await service._respond(_GoneConnection(), 2, {'method': 'unknown'})
+    assert service.stats.requests == 2 and service.stats.candles_sent == 0
+
+
+async def test_close_cancels_in_flight(tmp_path):
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    await service.start()
+    read = asyncio.create_task(service.get_candles(SBER.uid, DT, DT + timedelta(minutes=9), INTERVAL))
+    await asyncio.sleep(0.01)
+    task = next(iter(service._in_flight.values()))
+
+    await service.close()
+    await asyncio.gather(read, return_exceptions=True)
+    assert task.cancelled()
+
+
+class _FakeConnection(_Connection):
+    def __init__(self, blocked: bool = False):
+        super().__init__(reader=None, writer=None)
+        self.subscriptions = {(SBER.uid, SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE)}
+        self.blocked = blocked
+        self.sent = []
+
+    async def send(self, kind, request_id, payload):
+        if self.blocked:
+            await asyncio.Event().wait()  # client stopped reading
+        self.sent.append(payload)
+
+
+async def test_slow_client_doesnt_block_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(_Connection, 'EVENTS_MAXSIZE', 2)
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    await service.start()
+    slow, fast = _FakeConnection(blocked=True), _FakeConnection()
+    service._connections |= {slow, fast}
+    tasks = [asyncio.create_task(service._send_events(c)) for c in (slow, fast)]
+    try:
+        for minute in range(5):
+            await service.stream_manager.dispatch_candle(_event(minute))
+            await asyncio.sleep(0.01)
+        assert len(fast.sent) == 5 and slow.sent == []
+        assert slow.events.qsize() == 2 and service.stats.events_dropped == 2
+    finally:
+        for task in tasks:
+            task.cancel()
+        service._connections -= {slow, fast}
+        await service.close()
+
+
+async def test_subscriptions_released_by_last_client(tmp_path):
+    service = _Service(path=tmp_path / 'candles.sock', storage=_Storage)
+    await service.start()
+    try:
+        async with CandleServiceClient(path=service.path) as a:
+            async with CandleServiceClient(path=service.path) as b:
+                for client in (a, b):
+                    await client._request({'method': 'subscribe_candles', 'instrument_uids': [SBER.uid],
+                                           'interval': int(SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE)})
+            await asyncio.sleep(0.05)
+            assert service.unsubscribed == []
+        await asyncio.sleep(0.05)
+        assert service.unsubscribed == [SBER.uid] and service._subscribers == {}
+    finally:
+        await service.close()
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from tinkoff.invest import SubscriptionInterval
+
+from my_tinkoff import candle_writer
+from my_tinkoff.api_calls.market_data_stream import StreamCandle
+from my_tinkoff.candle_writer import StreamCandleWriter
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.schemas import Candle, Candles
+from tests.dataset import SBER
+
+DT = datetime(2024, 2, 19, 10, tzinfo=TZ_UTC)
+
+
+def _event(minute: int, close: float) -> StreamCandle:
+    candle = Candle(open=1, high=close, low=1, close=close, volume=1, is_complete=False,
+                    dt=DT + timedelta(minutes=minute))
+    return StreamCandle(instrument_uid=SBER.uid, interval=SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE,
+                        candle=candle)
+
+
+async def test_writer_appends_completed_candles(tmp_path):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    writer = StreamCandleWriter(storage=storage)
+
+    for minute, close in ((0, 1), (0, 2), (1, 3), (0, 4), (2, 5)):
+        writer.add(_event(minute, close))
+    await writer.flush()
+
+    csv = storage(instrument_id=SBER.uid, interval=writer.interval)
+    candles = await csv._read(from_=DT, to=DT + timedelta(minutes=1), interval=csv.interval)
+    assert [c.close for c in candles] == [2, 3]
+
+    with open(csv.filepath, 'a') as f:
+        f.write('1.0;1.0;1')
+    size = csv.filepath.stat().st_size
+    candles = await csv._read(from_=DT, to=DT + timedelta(minutes=1), interval=csv.interval)
+    assert [c.close for c in candles] == [2, 3]
+    assert (await csv._last_candle()).close == 3
+    assert csv.filepath.stat().st_size == size  # readers skip partial row, only writers cut it
+
+    writer.complete_expired()
+    await writer.flush()
+
+    candles = await csv._read(from_=DT, to=DT + timedelta(minutes=2), interval=csv.interval)
+    assert [c.close for c in candles] == [2, 3, 5]
+    assert writer.written == 3
+
+
+async def test_missed_candles_fetched_without_lock(tmp_path, monkeypatch):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    writer = StreamCandleWriter(storage=storage)
+    csv = storage(instrument_id=SBER.uid, interval=writer.interval)
+    await csv._prepare_new()
+    await csv._append(Candles([Candle(open=1, high=1, low=1, close=1, volume=1, is_complete=True, dt=DT)]))
+
+    async def _read():
+        async with FileLock.read(csv.filepath):
+            pass
+
+    async def _get_candles(instrument_id, from_, to, interval):
+        await asyncio.wait_for(_read(), 1)  # readers of other tasks are not blocked by the fetch
+        return Candles([Candle(open=1, high=1, low=1, close=m, volume=1, is_complete=True, dt=DT + timedelta(minutes=m))
+                        for m in range(0, 4)])
+
+    monkeypatch.setattr(candle_writer, 'get_candles', _get_candles)
+    for minute, close in ((3, 3), (4, 4)):
+        writer.add(_event(minute, close))
+    writer.complete_expired()
+    await writer.flush()
+
+    candles = await csv._read(from_=DT, to=DT + timedelta(minutes=4), interval=csv.interval)
+    assert [c.close for c in candles] == [1, 1, 2, 3, 4]
@@ -0,0 +1,52 @@
+import operator
+
+import numpy as np
+import pytest
+
+from my_tinkoff.candles_math import align, combine, combine_candles, ratio, weighted_sum
+from my_tinkoff.columnar import ColumnarCandles
+from tests.dataset import candles_math
+
+OPS = {
+    '__add__': np.add,
+    '__sub__': np.subtract,
+    '__mul__': np.multiply,
+    '__truediv__': np.divide,
+}
+
+
+@pytest.mark.parametrize("candles_1,candles_2,results", candles_math)
+def test_combine_candles(candles_1, candles_2, results):
+    for method, expected in results:
+        candles = combine_candles([candles_1, candles_2], op=OPS[method.__name__])
+
+        assert len(candles) == len(expected)
+        for c_v, c_e in zip(candles, expected):
+            assert [round(getattr(c_v, f), 2) for f in ('open', 'high', 'low', 'close')] == \
+                   [round(getattr(c_e, f), 2) for f in ('open', 'high', 'low', 'close')]
+            assert c_v.volume == c_e.volume
+            assert c_v.dt == c_e.dt
+
+
+def test_candle_operators():
+    c1, c2 = candles_math[0][0][1], candles_math[0][1][1]
+    series = [ColumnarCandles.from_candles([c1]), ColumnarCandles.from_candles([c2])]
+    for op, ufunc in ((operator.add, np.add), (operator.sub, np.subtract), (operator.mul, np.multiply),
+                      (operator.truediv, np.divide)):
+        c = combine(series, op=ufunc)[0]
+        e = op(c1, c2)
+        assert (c.open, c.high, c.low, c.close, c.volume) == (e.open, e.high, e.low, e.close, e.volume)
+
+
+def test_align_inner_and_weights():
+    candles_1, candles_2, _ = candles_math[1]
+    series = [ColumnarCandles.from_candles(candles_1), ColumnarCandles.from_candles(candles_2)]
+
+    ts, positions = align(series, how='inner')
+    assert len(ts) == 2
+    assert [p.tolist() for p in positions] == [[0, 1], [0, 4]]
+
+    weighted = weighted_sum(series, weights=[2, -1], how='inner')
+    assert weighted.close.tolist() == [2 * 131.12 - 131.3, 2 * 136.24 - 135.4]
+    assert weighted.volume.tolist() == [396287000 + 32401000, 159464000 + 18069000]
+    assert ratio(series[0], series[1]).close[1] == 131.12 / 131.3
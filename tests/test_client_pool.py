@@ -0,0 +1,169 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import grpc
+import pytest
+from grpc import StatusCode
+from tinkoff.invest import CandleInterval, HistoricCandle, Quotation
+from tinkoff.invest.exceptions import AioRequestError
+
+from my_tinkoff import token_manager
+from my_tinkoff.api_calls.market_data import get_candles, get_trading_status
+from my_tinkoff.client_pool import ClientPool, _PooledClient
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.exceptions import Unavailable
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.token_manager import TokenManager, token_controller
+
+DT = datetime(2024, 2, 19, 7, tzinfo=TZ_UTC)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.state = grpc.ChannelConnectivity.READY
+        self.closed = 0
+
+    def get_state(self, try_to_connect: bool = False) -> grpc.ChannelConnectivity:
+        return self.state
+
+    async def close(self) -> None:
+        self.closed += 1
+        self.state = grpc.ChannelConnectivity.SHUTDOWN
+
+
+class FakeMarketData:
+    trading_status_calls = 0
+
+    async def get_trading_status(self, instrument_id: str) -> SimpleNamespace:
+        FakeMarketData.trading_status_calls += 1
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(instrument_uid=instrument_id)
+
+    async def get_candles(self, instrument_id: str, interval, from_: datetime, to: datetime) -> SimpleNamespace:
+        """ Both window boundaries are included, as neighbour windows share a candle """
+        minutes = range(int((from_ - DT) / timedelta(minutes=1)), int((to - DT) / timedelta(minutes=1)) + 1)
+        return SimpleNamespace(candles=[
+            HistoricCandle(open=Quotation(units=1, nano=0), high=Quotation(units=1, nano=0),
+                           low=Quotation(units=1, nano=0), close=Quotation(units=1, nano=0), volume=i,
+                           time=DT + timedelta(minutes=i), is_complete=True)
+            for i in minutes
+        ])
+
+
+class FakeServices:
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+        self.market_data = FakeMarketData()
+
+    async def cancel_all_stream(self) -> None:
+        pass
+
+
+def _connect(cls, token: str) -> _PooledClient:
+    channel = FakeChannel()
+    return _PooledClient(channel=channel, services=FakeServices(channel))
+
+
+@pytest.fixture(autouse=True)
+def pool(monkeypatch):
+    monkeypatch.setattr(ClientPool, '_clients', {})
+    monkeypatch.setattr(ClientPool, '_connect', classmethod(_connect))
+    monkeypatch.setattr(TokenManager, '_tokens', ['token'])
+    monkeypatch.setattr(TokenManager, '_buckets', defaultdict(dict))
+    monkeypatch.setattr(token_manager, 'UNAVAILABLE_BACKOFF', 0.001)
+
+
+def _candles(first: int, count: int) -> Candles:
+    return Candles([
+        Candle(open=1, high=1, low=1, close=1, volume=i, dt=DT + timedelta(minutes=i), is_complete=True)
+        for i in range(first, first + count)
+    ])
+
+
+async def test_channel_reused():
+    stats = ClientPool.stats()
+
+    assert await ClientPool.get('token') is await ClientPool.get('token')
+    assert ClientPool.stats().reused > stats.reused
+
+    await ClientPool.close()
+    assert ClientPool.stats().size == 0
+
+
+async def test_reconnect_broken_channel_once():
+    services = await ClientPool.get('token')
+    assert not await ClientPool.reconnect('token', services)
+    assert await ClientPool.get('token') is services
+
+    services.channel.state = grpc.ChannelConnectivity.TRANSIENT_FAILURE
+    reconnected = await asyncio.gather(*[ClientPool.reconnect('token', services) for _ in range(3)])
+    assert reconnected.count(True) == 1
+    assert services.channel.closed == 1
+    assert not ClientPool.is_current('token', services)
+    assert await ClientPool.get('token') is not services
+
+
+async def test_unavailable_retried_on_healthy_channel():
+    calls = []
+
+    @token_controller(single_response=True)
+    async def _call(client=None) -> str:
+        calls.append(client)
+        if len(calls) < 3:
+            raise AioRequestError(StatusCode.UNAVAILABLE, 'unavailable', None)
+        return 'ok'
+
+    assert await _call() == 'ok'
+    assert len(calls) == 3 and calls[0] is calls[1] is calls[2]
+    assert calls[0].channel.closed == 0
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+async def test_unavailable_replaces_broken_channel_and_resumes(columnar):
+    calls = []
+
+    @token_controller()
+    async def _get(from_: datetime, to: datetime, client=None) -> Candles | ColumnarCandles:
+        calls.append((client, from_))
+        if len(calls) == 1:
+            client.channel.state = grpc.ChannelConnectivity.TRANSIENT_FAILURE
+            candles = _candles(0, 5)
+            raise Unavailable(ColumnarCandles.from_candles(candles) if columnar else candles)
+        candles = _candles(int((from_ - DT) / timedelta(minutes=1)), 6)
+        return ColumnarCandles.from_candles(candles) if columnar else candles
+
+    candles = await _get(from_=DT, to=DT + timedelta(minutes=10))
+    assert isinstance(candles, ColumnarCandles if columnar else Candles)
+    assert [c.volume for c in candles] == list(range(10))
+    assert calls[1][1] == DT + timedelta(minutes=4)
+    assert calls[0][0].channel.closed == 1 and calls[1][0] is not calls[0][0]
+
+
+async def test_unavailable_gives_up():
+    @token_controller(single_response=True)
+    async def _call(client=None) -> str:
+        raise AioRequestError(StatusCode.UNAVAILABLE, 'unavailable', None)
+
+    with pytest.raises(AioRequestError):
+        await _call()
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 3])
+@pytest.mark.parametrize('columnar', [False, True])
+async def test_get_candles_boundaries_once(max_in_flight, columnar):
+    candles = await get_candles(instrument_id='uid', from_=DT, to=DT + timedelta(minutes=10),
+                                interval=CandleInterval.CANDLE_INTERVAL_1_MIN, delta=timedelta(minutes=3),
+                                max_in_flight=max_in_flight, columnar=columnar)
+    assert isinstance(candles, ColumnarCandles if columnar else Candles)
+    assert [c.volume for c in candles] == list(range(11))
+
+
+async def test_identical_calls_coalesced_by_default():
+    calls = FakeMarketData.trading_status_calls
+    statuses = await asyncio.gather(*[get_trading_status(instrument_id='uid') for _ in range(3)],
+                                    get_trading_status(instrument_id='other'))
+    assert [s.instrument_uid for s in statuses] == ['uid', 'uid', 'uid', 'other']
+    assert FakeMarketData.trading_status_calls - calls == 2
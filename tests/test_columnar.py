@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import numpy as np
+
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.columnar import ColumnarCandles
+
+
+candles = Candles([
+    Candle(open=17.24, high=17.3, low=17.24, close=17.3, volume=38,
+           dt=datetime(2024, 2, 19, 7, 0, tzinfo=TZ_UTC), is_complete=True),
+    Candle(open=17.22, high=17.22, low=17.22, close=17.22, volume=20,
+           dt=datetime(2024, 2, 19, 7, 1, tzinfo=TZ_UTC), is_complete=True),
+    Candle(open=17.22, high=17.22, low=17.12, close=17.18, volume=72,
+           dt=datetime(2024, 2, 19, 7, 3, tzinfo=TZ_UTC), is_complete=True),
+    Candle(open=17.18, high=17.18, low=17.18, close=17.18, volume=3,
+           dt=datetime(2024, 2, 19, 7, 4, tzinfo=TZ_UTC), is_complete=False),
+])
+
+
+def test_round_trip():
+    columnar = ColumnarCandles.from_candles(candles)
+    assert len(columnar) == len(candles)
+    assert columnar.to_candles() == candles
+    assert columnar[-1] == candles[-1]
+
+
+def test_slice_is_view():
+    columnar = ColumnarCandles.from_candles(candles)
+    part = columnar.slice_by_dt(from_=datetime(2024, 2, 19, 7, 1, tzinfo=TZ_UTC),
+                                to=datetime(2024, 2, 19, 7, 3, tzinfo=TZ_UTC))
+    assert part.to_candles() == candles[1:3]
+    for field in ColumnarCandles.__slots__:
+        assert np.shares_memory(getattr(part, field), getattr(columnar, field))
+
+
+def test_concat():
+    columnar = ColumnarCandles.from_candles(candles)
+    assert ColumnarCandles.concat([columnar[:2], columnar[2:]]).to_candles() == candles
+    assert len(ColumnarCandles.concat([])) == 0
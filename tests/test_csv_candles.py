@@ -1,34 +1,91 @@
-import aiofiles
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
 import pytest
-from tinkoff.invest import InstrumentIdType
+from tinkoff.invest import CandleInterval, InstrumentIdType
 
-from my_tinkoff.csv_candles import CSVCandles
+from benchmarks.fake_server import FAKE_UID, fake_api
+from my_tinkoff import csv_candles
 from my_tinkoff.api_calls.instruments import get_instrument_by
+from my_tinkoff.api_calls.market_data import get_candles
+from my_tinkoff.candle_cache import CandleRangeCache
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+
+INTERVAL = CandleInterval.CANDLE_INTERVAL_1_MIN
+FROM = datetime(2024, 2, 19, 7, tzinfo=TZ_UTC)
+TO = datetime(2024, 2, 22, 7, tzinfo=TZ_UTC)
+MIDDLE = datetime(2024, 2, 20, 12, tzinfo=TZ_UTC)
+
+# range which is already stored before the test reads FROM-TO, None is a new file
+CASES = {
+    'full_range_exists': (FROM, TO),
+    'gap_in_the_beginning': (MIDDLE, TO),
+    'gap_in_the_end': (FROM, MIDDLE),
+    'new_file': None,
+}
+
+
+@pytest.fixture
+async def api():
+    CandleRangeCache.clear()
+    async with fake_api() as api:
+        yield api
+
+
+@pytest.fixture(params=list(CASES.values()), ids=list(CASES))
+async def storage(request, api, tmp_path) -> type[CSVCandles]:
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'FAKE.csv'})
+    if request.param is not None:
+        instrument = await get_instrument_by(id=FAKE_UID, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+        from_, to = request.param
+        await storage.download_or_read(instrument=instrument, from_=from_, to=to, interval=INTERVAL)
+    return storage
+
+
+async def test_download_or_read(storage):
+    instrument = await get_instrument_by(id=FAKE_UID, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+    expected = await get_candles(instrument_id=FAKE_UID, from_=FROM, to=TO, interval=INTERVAL)
+
+    candles = await storage.download_or_read(instrument=instrument, from_=FROM, to=TO, interval=INTERVAL)
+    assert [c.dt for c in candles] == [c.dt for c in expected if c.dt < TO]
+    assert candles[0].dt == FROM
+    assert candles[-1].dt == datetime(2024, 2, 21, 15, 39, tzinfo=TZ_UTC)
+
 
-from tests.dataset import dataset_candles
+async def test_iter_candles(storage):
+    instrument = await get_instrument_by(id=FAKE_UID, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+    expected = await storage.download_or_read(instrument=instrument, from_=FROM, to=TO, interval=INTERVAL)
 
+    chunks = [chunk async for chunk in storage.iter_candles(
+        instrument=instrument, from_=FROM, to=TO, interval=INTERVAL, window=timedelta(hours=6), columnar=True)]
+    assert sum(len(c) for c in chunks) == len(expected)
+    assert chunks[0][0].dt == expected[0].dt
+    assert chunks[-1][-1].dt == expected[-1].dt
 
-def mock_get_filepath(filepath) -> callable:
-    def _wrap(instrument, interval):
-        return filepath
-    return _wrap
 
+@pytest.mark.parametrize('stored', [(1000, 1010), (0, 10)], ids=['file_after_range', 'file_before_range'])
+async def test_iter_candles_fetches_by_windows(tmp_path, monkeypatch, stored):
+    window, requests = timedelta(minutes=100), []
 
-# noinspection PyPropertyAccess
-@pytest.mark.parametrize("instrument,case", dataset_candles)
-async def test_download_or_read(instrument, case):
-    CSVCandles.filepath = case.filepath
-    instrument = await get_instrument_by(id=instrument.uid, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+    async def _get_candles(instrument_id, from_, to, interval):
+        requests.append(to - from_)
+        minutes = range(int((from_ - FROM) / timedelta(minutes=1)), int((to - FROM) / timedelta(minutes=1)) + 1)
+        return Candles([Candle(open=1, high=1, low=1, close=1, volume=m, dt=FROM + timedelta(minutes=m),
+                               is_complete=True) for m in minutes])
 
-    async with aiofiles.open(case.filepath) as f:
-        raw_candles = await f.read()
+    monkeypatch.setattr(csv_candles, 'get_candles', _get_candles)
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'FAKE.csv'})
+    instrument = SimpleNamespace(uid=FAKE_UID, ticker='FAKE', exchange=None, first_1min_candle_date=FROM)
+    csv = storage(instrument_id=FAKE_UID, interval=INTERVAL)
+    await csv._prepare_new()
+    await csv._append(await _get_candles(FAKE_UID, FROM + timedelta(minutes=stored[0]),
+                                         FROM + timedelta(minutes=stored[1]), INTERVAL))
+    requests.clear()
 
-    try:
-        candles = await CSVCandles.download_or_read(
-            instrument=instrument, from_=case.dt_from, to=case.dt_to, interval=case.interval)
-        assert len(candles) == case.count_candles
-        assert candles[0].dt == case.dt_first_candle
-        assert candles[-1].dt == case.dt_last_candle
-    finally:
-        async with aiofiles.open(case.filepath, 'w') as f:
-            await f.write(raw_candles)
+    to = FROM + timedelta(minutes=1010 if stored[0] else 1000)
+    chunks = [chunk async for chunk in storage.iter_candles(instrument=instrument, from_=FROM, to=to,
+                                                           interval=INTERVAL, window=window)]
+    assert [c.volume for chunk in chunks for c in chunk] == list(range(int((to - FROM) / timedelta(minutes=1)) + 1))
+    assert max(requests) <= window
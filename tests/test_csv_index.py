@@ -0,0 +1,64 @@
+import asyncio
+import shutil
+from datetime import datetime
+from dataclasses import asdict
+from pathlib import Path
+
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.csv_index import CSVIndex
+from my_tinkoff.date_utils import TZ_UTC
+from tests.dataset import CASE_SBER_FULL_RANGE_EXISTS, SBER
+
+
+def _storage(filepath: Path) -> type[CSVCandles]:
+    return type('Storage', (CSVCandles,), {'filepath': filepath, 'SEGMENT_ON_INSERT': False})
+
+
+async def test_read_range(tmp_path):
+    case = CASE_SBER_FULL_RANGE_EXISTS
+    shutil.copy(case.filepath, tmp_path / case.filepath.name)
+    csv = _storage(tmp_path / case.filepath.name)(instrument_id=SBER.uid, interval=case.interval)
+
+    from_ = datetime(2024, 2, 20, 10, tzinfo=TZ_UTC)
+    to = datetime(2024, 2, 20, 11, tzinfo=TZ_UTC)
+    candles = await csv._read(from_=from_, to=to, interval=csv.interval)
+    assert candles[0].dt == from_
+    assert candles[-1].dt == to
+    assert len(candles) == 61
+
+    index = await CSVIndex.load(csv.filepath)
+    assert index.days == ['2024-02-19', '2024-02-20', '2024-02-21', '2024-02-22']
+    assert csv.line2candle(index.first_line).dt == case.dt_first_candle
+    assert csv.line2candle(index.last_line).dt == case.dt_last_candle
+
+
+async def test_index_follows_writes(tmp_path):
+    case = CASE_SBER_FULL_RANGE_EXISTS
+    candles = await _storage(case.filepath)(instrument_id=SBER.uid, interval=case.interval)._read(
+        from_=case.dt_from, to=case.dt_to, interval=case.interval)
+
+    csv = _storage(tmp_path / case.filepath.name)(instrument_id=SBER.uid, interval=case.interval)
+    await csv._prepare_new()
+    await csv._append(candles[1000:2000])
+    await csv._append(candles[2000:])
+    await csv._insert(candles[:1000])
+
+    index = await CSVIndex.load(csv.filepath)
+    assert asdict(index) == asdict(await CSVIndex.build(csv.filepath))
+    assert await csv._read(from_=case.dt_from, to=case.dt_to, interval=csv.interval) == candles
+
+
+async def test_concurrent_reads_of_stale_index(tmp_path):
+    case = CASE_SBER_FULL_RANGE_EXISTS
+    shutil.copy(case.filepath, tmp_path / case.filepath.name)
+    csv = _storage(tmp_path / case.filepath.name)(instrument_id=SBER.uid, interval=case.interval)
+    await CSVIndex.load(csv.filepath)
+
+    for _ in range(5):
+        csv.filepath.touch()  # csv changed not through index
+        CSVIndex._cache.clear()
+        results = await asyncio.gather(*[
+            csv._read(from_=case.dt_from, to=case.dt_to, interval=csv.interval) for _ in range(20)
+        ])
+        assert all(len(r) == case.count_candles for r in results)
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == '.tmp'] == []
@@ -0,0 +1,109 @@
+import asyncio
+import multiprocessing
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.file_lock import FileLock
+from my_tinkoff.schemas import Candle, Candles
+from tests.dataset import SBER
+
+DT = datetime(2024, 2, 19, 7, tzinfo=TZ_UTC)
+
+
+def _candles(first: int, count: int) -> Candles:
+    return Candles([
+        Candle(open=1, high=2, low=0.5, close=1.5, volume=i, dt=DT + timedelta(minutes=i), is_complete=True)
+        for i in range(first, first + count)
+    ])
+
+
+def _hold_lock(filepath, seconds: float, locked) -> None:
+    async def _hold():
+        async with FileLock.write(filepath):
+            locked.set()
+            await asyncio.sleep(seconds)
+    asyncio.run(_hold())
+
+
+async def test_writer_waits_for_readers(tmp_path):
+    filepath, events = tmp_path / 'SBER.csv', []
+
+    async def _read(name: str):
+        async with FileLock.read(filepath):
+            events.append(f'{name} start')
+            await asyncio.sleep(0.02)
+            events.append(f'{name} end')
+
+    async def _write():
+        await asyncio.sleep(0.005)
+        async with FileLock.write(filepath):
+            async with FileLock.write(filepath), FileLock.read(filepath):  # reentrant for the writer task
+                events.append('write')
+
+    await asyncio.gather(_read('a'), _read('b'), _write())
+    assert events == ['a start', 'b start', 'a end', 'b end', 'write']
+
+
+async def test_concurrent_inserts_and_appends(tmp_path):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    csv = storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_1_MIN)
+    await csv._prepare_new()
+    await csv._append(_candles(100, 10))
+
+    await asyncio.gather(
+        *[csv._insert(_candles(100 - 10 * i, 10)) for i in range(1, 6)],
+        *[csv._append(_candles(100 + 10 * i, 10)) for i in range(1, 6)],
+    )
+    candles = await csv._read(from_=DT + timedelta(minutes=50), to=DT + timedelta(minutes=159), interval=csv.interval)
+    assert [c.volume for c in candles] == list(range(50, 160))
+
+
+async def test_lock_across_processes(tmp_path):
+    filepath = tmp_path / 'SBER.csv'
+    locked = multiprocessing.Event()
+    process = multiprocessing.Process(target=_hold_lock, args=(filepath, 0.3, locked))
+    process.start()
+    try:
+        assert locked.wait(5)
+        start = time.monotonic()
+        async with FileLock.read(filepath):
+            assert time.monotonic() - start > 0.1
+        async with FileLock.read(tmp_path / 'other.csv'):
+            pass
+    finally:
+        process.join()
+
+
+async def test_states_dropped_when_idle(tmp_path):
+    filepath = tmp_path / 'SBER.csv'
+    async with FileLock.write(filepath):
+        async with FileLock.read(filepath):
+            assert filepath in FileLock._states
+    assert filepath not in FileLock._states
+
+
+async def test_cancelled_while_blocked_across_processes(tmp_path):
+    filepath = tmp_path / 'SBER.csv'
+    locked = multiprocessing.Event()
+    process = multiprocessing.Process(target=_hold_lock, args=(filepath, 0.3, locked))
+    process.start()
+    try:
+        assert locked.wait(5)
+        task = asyncio.create_task(FileLock.read(filepath).__aenter__())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert filepath not in FileLock._states
+    finally:
+        process.join()
+
+    # descriptor of cancelled reader is closed once its thread gets the lock, so it doesn't block writers
+    async with asyncio.timeout(1):
+        async with FileLock.write(filepath):
+            pass
@@ -0,0 +1,117 @@
+import shutil
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff import gaps
+from my_tinkoff.binary_candles import BinaryCandles
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.gaps import find_gaps, repair_gaps, scan_gaps
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.segmented_candles import SegmentedCSVCandles
+from my_tinkoff.trading_calendar import TradingCalendar
+from tests.conftest import TEST_DIR_CANDLES
+from tests.dataset import POSI
+
+DT = datetime(2024, 2, 19, tzinfo=TZ_UTC)
+
+
+def _candles(days: list[int]) -> Candles:
+    return Candles([
+        Candle(open=1, high=2, low=0.5, close=1.5, volume=i, dt=DT + timedelta(days=i), is_complete=True) for i in days
+    ])
+
+
+@pytest.fixture(autouse=True)
+def calendar(monkeypatch):
+    async def _update(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(TradingCalendar, '_calendars', {})
+    monkeypatch.setattr(TradingCalendar, 'update', _update)
+    monkeypatch.setattr(Candles, 'HOLIDAYS', {date(2024, 2, 23)})
+
+
+def test_find_gaps():
+    days = np.array(['2024-02-19', '2024-02-20', '2024-02-22', '2024-02-27', '2024-03-01'], dtype='datetime64[D]')
+    found, expected = find_gaps(days, exchange=POSI.exchange)
+
+    assert expected == 9  # Feb 23 is a holiday, weekends are not trading days
+    assert [(g.from_.date(), g.to.date(), g.days) for g in found] == [
+        (date(2024, 2, 21), date(2024, 2, 22), 1),
+        (date(2024, 2, 26), date(2024, 2, 27), 1),
+        (date(2024, 2, 28), date(2024, 3, 1), 2),
+    ]
+    assert find_gaps(days[:2], exchange=POSI.exchange) == ([], 2)
+
+
+@pytest.mark.parametrize('base, suffix', [(CSVCandles, '.csv'), (BinaryCandles, '.bin'),
+                                          (SegmentedCSVCandles, '.segments')])
+async def test_merge(tmp_path, base, suffix):
+    storage = type('Storage', (base,), {'filepath': tmp_path / f'POSI{suffix}'})
+    csv = storage(instrument_id=POSI.uid, interval=CandleInterval.CANDLE_INTERVAL_DAY)
+    await csv._prepare_new()
+    await csv._append(_candles([0, 1, 10, 11]))
+    await csv._merge(_candles([1, 2, 3, 4]))
+
+    candles = await csv._read(from_=DT, to=DT + timedelta(days=11), interval=csv.interval)
+    assert [c.volume for c in candles] == [0, 1, 2, 3, 4, 10, 11]
+    assert (await csv._days()).tolist()[2] == date(2024, 2, 21)
+
+
+async def test_repair_gaps(tmp_path, monkeypatch):
+    filepath = tmp_path / 'POSI.csv'
+    shutil.copy(TEST_DIR_CANDLES / 'POSI_gaps_everywhere.csv', filepath)
+    storage = type('Storage', (CSVCandles,), {'filepath': filepath})
+    requested = []
+
+    async def _get_candles(instrument_id, from_, to, interval):
+        requested.append((from_, to))
+        days = np.arange(np.datetime64(from_.date()), np.datetime64(to.date()))
+        return Candles([
+            Candle(open=1, high=1, low=1, close=1, volume=1, dt=gaps.day2dt(d), is_complete=True)
+            for d in days[TradingCalendar.trading_days(POSI.exchange, days)]
+        ])
+
+    monkeypatch.setattr(gaps, 'get_candles', _get_candles)
+    before = await scan_gaps(POSI, interval=CandleInterval.CANDLE_INTERVAL_DAY, storage=storage)
+    assert before.gaps and before.coverage < 1
+
+    reports = await repair_gaps([POSI], interval=CandleInterval.CANDLE_INTERVAL_DAY, storage=storage,
+                                max_in_flight=2)
+    assert len(requested) == len(before.gaps)
+    assert reports[POSI.uid].repaired == before.days_missing
+
+    after = await scan_gaps(POSI, interval=CandleInterval.CANDLE_INTERVAL_DAY, storage=storage)
+    assert after.gaps == [] and after.coverage == 1
+    assert after.days_expected == before.days_expected
+
+
+async def test_repair_gaps_partly_failed(tmp_path, monkeypatch):
+    filepath = tmp_path / 'POSI.csv'
+    shutil.copy(TEST_DIR_CANDLES / 'POSI_gaps_everywhere.csv', filepath)
+    storage = type('Storage', (CSVCandles,), {'filepath': filepath})
+    before = await scan_gaps(POSI, interval=CandleInterval.CANDLE_INTERVAL_DAY, storage=storage)
+    broken = before.gaps[0].from_
+
+    async def _get_candles(instrument_id, from_, to, interval):
+        if from_ == broken:
+            raise ConnectionError('broken gap')
+        return Candles([Candle(open=1, high=1, low=1, close=1, volume=1, dt=from_, is_complete=True)])
+
+    async def _update(*args, **kwargs):
+        raise ConnectionError('no schedules')
+
+    monkeypatch.setattr(gaps, 'get_candles', _get_candles)
+    monkeypatch.setattr(TradingCalendar, 'update', _update)
+    report = (await repair_gaps([POSI], interval=CandleInterval.CANDLE_INTERVAL_DAY, storage=storage))[POSI.uid]
+    assert report.error is None and report.calendar_defaults
+    assert [g.from_ for g in report.failed] == [broken]
+    assert report.repaired == len(before.gaps) - 1
+
+    after = await scan_gaps(POSI, interval=CandleInterval.CANDLE_INTERVAL_DAY, storage=storage)
+    assert after.gaps[0].from_ == broken
+    assert len(after.gaps) < len(before.gaps)
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+from tinkoff.invest import HistoricCandle, Quotation
+
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.helpers import convert_candle, convert_candles, quotation2decimal, split_datetime_range
+
+
+historic_candles = [
+    HistoricCandle(
+        open=Quotation(units=289, nano=580000000),
+        high=Quotation(units=289, nano=600000000),
+        low=Quotation(units=289, nano=550000000),
+        close=Quotation(units=289, nano=550000000),
+        volume=399,
+        time=datetime(2024, 2, 19, 13, tzinfo=TZ_UTC),
+        is_complete=True
+    ),
+    HistoricCandle(
+        open=Quotation(units=0, nano=-1),
+        high=Quotation(units=-17, nano=-300000000),
+        low=Quotation(units=17, nano=300000000),
+        close=Quotation(units=0, nano=123456789),
+        volume=0,
+        time=datetime(2024, 2, 19, 13, 1, tzinfo=TZ_UTC),
+        is_complete=False
+    ),
+]
+
+
+def test_quotation2decimal():
+    assert quotation2decimal(Quotation(units=17, nano=300000000)) == 17.3
+    assert quotation2decimal(Quotation(units=-17, nano=-300000000)) == -17.3
+
+
+def test_convert_candles():
+    columnar = convert_candles(historic_candles)
+    assert columnar.to_candles() == [convert_candle(c) for c in historic_candles]
+    assert len(convert_candles([])) == 0
+
+
+def test_split_datetime_range():
+    from_ = datetime(2024, 2, 19, tzinfo=TZ_UTC)
+    windows = split_datetime_range(from_=from_, to=from_ + timedelta(days=2, hours=12), delta=timedelta(days=1))
+    assert windows == [
+        (from_, from_ + timedelta(days=1)),
+        (from_ + timedelta(days=1), from_ + timedelta(days=2)),
+        (from_ + timedelta(days=2), from_ + timedelta(days=2, hours=12)),
+    ]
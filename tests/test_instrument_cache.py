@@ -0,0 +1,93 @@
+from collections import defaultdict
+from datetime import timedelta
+
+import pytest
+from tinkoff.invest import Future, Instrument, InstrumentIdType, Share
+
+from my_tinkoff.api_calls import instruments
+from my_tinkoff.api_calls.instruments import find_instrument, get_futures, get_instrument_by, get_shares
+from my_tinkoff.enums import ClassCode
+from my_tinkoff.instrument_cache import InstrumentCache
+from my_tinkoff.schemas import Shares
+from tests.dataset import CNTL, POSI, SBER
+
+FUTURE = Future(uid='future-uid', figi='FUTSI0624000', ticker='SiM4', class_code='SPBFUT', exchange='FORTS')
+
+
+def _share(info) -> Share:
+    return Share(uid=info.uid, figi=f'FIGI_{info.ticker}', ticker=info.ticker, class_code=info.class_code,
+                 exchange=info.exchange)
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch, tmp_path):
+    requests = defaultdict(int)
+
+    async def _fetch_instrument_by(id: str, id_type: InstrumentIdType, class_code: str = '') -> Instrument:
+        requests['instrument_by'] += 1
+        return Instrument(uid='new-uid', figi='FIGI_NEW', ticker='NEW', class_code='TQBR', exchange='MOEX')
+
+    async def _fetch_find_instrument(**kwargs) -> list:
+        requests['find'] += 1
+        return [kwargs['query']]
+
+    async def _fetch_shares() -> Shares:
+        requests['shares'] += 1
+        return Shares([_share(i) for i in (SBER, CNTL, POSI)])
+
+    async def _fetch_futures() -> list[Future]:
+        requests['futures'] += 1
+        return [FUTURE]
+
+    monkeypatch.setattr(instruments, 'fetch_instrument_by', _fetch_instrument_by)
+    monkeypatch.setattr(instruments, 'fetch_find_instrument', _fetch_find_instrument)
+    monkeypatch.setattr(instruments, 'fetch_shares', _fetch_shares)
+    monkeypatch.setattr(instruments, 'fetch_futures', _fetch_futures)
+    monkeypatch.setattr(InstrumentCache, 'FILEPATH', tmp_path / 'instruments.pickle')
+    InstrumentCache._index([], updated=None)
+    yield requests
+    InstrumentCache._index([], updated=None)
+
+
+async def test_lookups(cache):
+    share = await InstrumentCache.get_by_uid(SBER.uid)
+    assert share.ticker == SBER.ticker
+    assert await InstrumentCache.get_by_figi(share.figi) is share
+    assert await InstrumentCache.get_by_ticker(SBER.ticker, SBER.class_code) is share
+    assert share in await Shares.from_board(ClassCode.TQBR)
+    assert len(await get_shares()) == 3
+    assert await get_futures() == [FUTURE]
+    assert dict(cache) == {'shares': 1, 'futures': 1}
+
+
+async def test_fetch_missing_once(cache):
+    for _ in range(3):
+        instrument = await get_instrument_by(id='new-uid', id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+        assert isinstance(instrument, Instrument) and instrument.ticker == 'NEW'
+        assert await get_instrument_by(id='FIGI_NEW', id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI) is instrument
+        assert await find_instrument(query='POSI') == ['POSI']
+    assert cache['instrument_by'] == 1
+    assert cache['find'] == 1
+
+    # without class_code ticker is requested once more and cached under the requested key
+    by_ticker = await InstrumentCache.get_by_ticker('NEW')
+    assert by_ticker.uid == instrument.uid
+    assert await InstrumentCache.get_by_ticker('NEW') is by_ticker
+    assert cache['instrument_by'] == 2
+
+
+async def test_load_from_disk(cache):
+    await InstrumentCache.get_by_uid('new-uid')
+    assert InstrumentCache.FILEPATH.exists()
+
+    InstrumentCache._index([], updated=None)
+    assert (await InstrumentCache.get_by_uid('new-uid')).ticker == 'NEW'
+    assert len(await InstrumentCache.get_board(SBER.class_code)) == 3
+    assert dict(cache) == {'shares': 1, 'futures': 1, 'instrument_by': 1}
+
+
+async def test_stale_cache_refreshed(cache, monkeypatch):
+    await InstrumentCache.load()
+    monkeypatch.setattr(InstrumentCache, 'TTL', timedelta(0))
+    await InstrumentCache.load()
+    assert cache['shares'] == 2
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from my_tinkoff.instrumentation import Instrumentation
+
+
+@pytest.fixture
+def instrumentation():
+    Instrumentation.ENABLED = True
+    Instrumentation.reset()
+    yield Instrumentation
+    Instrumentation.ENABLED = False
+    Instrumentation.reset()
+    Instrumentation.HOOKS.clear()
+
+
+def test_disabled():
+    Instrumentation.reset()
+    Instrumentation.inc('requests', method='get_candles')
+    Instrumentation.observe('request_seconds', 0.1, method='get_candles')
+    with Instrumentation.span('download_or_read', phase='read'):
+        pass
+    assert Instrumentation.to_dict() == {'counters': [], 'histograms': []}
+
+
+def test_counters_and_histograms(instrumentation):
+    recorded = []
+    instrumentation.HOOKS.append(lambda name, value, labels: recorded.append((name, value, labels)))
+
+    instrumentation.inc('retries', method='get_candles', reason='exhausted')
+    instrumentation.inc('retries', method='get_candles', reason='exhausted')
+    instrumentation.observe('request_seconds', 0.02, method='get_candles')
+    instrumentation.observe('request_seconds', 3, method='get_candles')
+    with instrumentation.span('download_or_read', phase='read'):
+        pass
+
+    data = json.loads(instrumentation.to_json())
+    assert data['counters'] == [
+        {'name': 'retries', 'labels': {'method': 'get_candles', 'reason': 'exhausted'}, 'value': 2}
+    ]
+    histograms = {h['name']: h for h in data['histograms']}
+    assert histograms['request_seconds']['count'] == 2
+    assert histograms['request_seconds']['buckets']['0.025'] == 1
+    assert histograms['request_seconds']['buckets']['5.0'] == 1
+    assert histograms['download_or_read_seconds']['labels'] == {'phase': 'read'}
+    assert len(recorded) == 5
+
+
+def test_to_prometheus(instrumentation):
+    instrumentation.inc('requests', method='get_candles')
+    instrumentation.observe('request_seconds', 0.02, method='get_candles')
+    text = instrumentation.to_prometheus()
+
+    assert '# TYPE my_tinkoff_requests_total counter' in text
+    assert 'my_tinkoff_requests_total{method="get_candles"} 1' in text
+    assert 'my_tinkoff_request_seconds_bucket{method="get_candles",le="0.01"} 0' in text
+    assert 'my_tinkoff_request_seconds_bucket{method="get_candles",le="0.025"} 1' in text
+    assert 'my_tinkoff_request_seconds_bucket{method="get_candles",le="+Inf"} 1' in text
+    assert 'my_tinkoff_request_seconds_count{method="get_candles"} 1' in text
@@ -0,0 +1,69 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.resample import ResampledCSVCandles, resample
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.trading_calendar import TradingCalendar
+from tests.dataset import SBER
+
+
+@pytest.fixture(autouse=True)
+def calendar(monkeypatch):
+    monkeypatch.setattr(TradingCalendar, '_calendars', {})
+    monkeypatch.setattr(Candles, 'HOLIDAYS', {date(2024, 2, 23)})
+
+
+def _minutes(from_: datetime, count: int) -> ColumnarCandles:
+    return ColumnarCandles.from_candles(
+        Candle(open=i, high=i + 0.5, low=i - 0.5, close=i + 0.25, volume=1, dt=from_ + timedelta(minutes=i),
+               is_complete=True)
+        for i in range(count)
+    )
+
+
+def test_resample_intraday():
+    candles = _minutes(datetime(2024, 2, 19, 7, 3, tzinfo=TZ_UTC), 120)
+    hours = resample(candles, CandleInterval.CANDLE_INTERVAL_HOUR, now=datetime(2024, 2, 19, 9, tzinfo=TZ_UTC))
+
+    assert hours.dt == [datetime(2024, 2, 19, h, tzinfo=TZ_UTC) for h in (7, 8, 9)]
+    assert hours.open.tolist() == [0, 57, 117]
+    assert hours.close.tolist() == [56.25, 116.25, 119.25]
+    assert hours.high.tolist() == [56.5, 116.5, 119.5]
+    assert hours.low.tolist() == [-0.5, 56.5, 116.5]
+    assert hours.volume.tolist() == [57, 60, 3]
+    assert hours.is_complete.tolist() == [True, True, False]
+
+    five = resample(candles, CandleInterval.CANDLE_INTERVAL_5_MIN)
+    assert np.all(np.diff(five.ts) == 5 * 60 * 10 ** 9)
+    assert five.volume.sum() == len(candles)
+
+
+def test_resample_periods():
+    dt = datetime(2024, 1, 31, 21, tzinfo=TZ_UTC)
+    days = ColumnarCandles.from_candles(
+        Candle(open=1, high=d, low=1, close=d, volume=d, dt=dt + timedelta(days=d), is_complete=True)
+        for d in range(35)
+    )
+
+    weeks = resample(days, CandleInterval.CANDLE_INTERVAL_WEEK)
+    assert weeks.dt[0] == datetime(2024, 1, 29, tzinfo=TZ_UTC)
+    assert all(dt.weekday() == 0 for dt in weeks.dt)
+
+    months = resample(days, CandleInterval.CANDLE_INTERVAL_MONTH, exchange=SBER.exchange)
+    assert months.dt == [datetime(2024, 2, 1, tzinfo=TZ_UTC), datetime(2024, 3, 1, tzinfo=TZ_UTC)]
+    # weekends and Feb 23 are not trading days
+    trading = [d for d in range(35) if (date(2024, 2, 1) + timedelta(days=d)).weekday() < 5 and d != 22]
+    assert months.volume.tolist() == [sum(d for d in trading if d < 29), sum(d for d in trading if d >= 29)]
+
+
+def test_resampled_files_apart():
+    interval = CandleInterval.CANDLE_INTERVAL_HOUR
+    resampled = ResampledCSVCandles(instrument_id=SBER.uid, interval=interval).filepath
+    assert resampled != CSVCandles(instrument_id=SBER.uid, interval=interval).filepath
+    assert resampled.name.endswith('.resampled.csv')
@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.archive import CandleArchive, compact
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.csv_index import dt2day
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.segmented_candles import SegmentedCSVCandles
+from tests.dataset import SBER
+
+DT = datetime(2024, 1, 31, 7, tzinfo=TZ_UTC)
+
+
+def _candles(first: int, count: int, step: timedelta = timedelta(hours=12)) -> Candles:
+    return Candles([
+        Candle(open=1, high=2, low=0.5, close=1.5, volume=i, dt=DT + step * i, is_complete=True)
+        for i in range(first, first + count)
+    ])
+
+
+def _storage(tmp_path) -> SegmentedCSVCandles:
+    storage = type('Storage', (SegmentedCSVCandles,), {'filepath': tmp_path / 'SBER.segments'})
+    return storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_HOUR)
+
+
+async def test_append_read_across_months(tmp_path):
+    storage = _storage(tmp_path)
+    await storage._prepare_new()
+    await storage._append(_candles(10, 10))
+    await storage._append(_candles(20, 100))
+
+    assert sorted(p.name for p in storage.filepath.glob('*.seg')) == ['2024-02.seg', '2024-03.seg']
+    candles = await storage._read(from_=DT + timedelta(hours=12 * 15), to=DT + timedelta(hours=12 * 80),
+                                  interval=storage.interval)
+    assert [c.volume for c in candles] == list(range(15, 81))
+    assert (await storage._first_candle()).volume == 10
+    assert (await storage._last_candle()).volume == 119
+
+
+async def test_insert_rewrites_only_its_months(tmp_path):
+    storage = _storage(tmp_path)
+    await storage._prepare_new()
+    await storage._append(_candles(10, 110))
+    mtimes = {p.name: p.stat().st_mtime_ns for p in storage.filepath.glob('*.seg')}
+
+    await storage._insert(_candles(0, 10))
+    changed = {p.name for p in storage.filepath.glob('*.seg') if p.stat().st_mtime_ns != mtimes.get(p.name)}
+    assert changed == {'2024-01.seg', '2024-02.seg'}
+    candles = await storage._read(from_=DT, to=DT + timedelta(hours=12 * 119), interval=storage.interval)
+    assert [c.volume for c in candles] == list(range(120))
+
+
+async def test_partial_row_and_stale_manifest(tmp_path):
+    storage = _storage(tmp_path)
+    await storage._prepare_new()
+    await storage._append(_candles(0, 10))
+    with open(storage.get_segment_filepath('2024-02'), 'a') as f:
+        f.write('1,2,0.5')
+
+    storage._repair_tail()
+    assert (await storage._last_candle()).volume == 9
+    await storage._append(_candles(10, 2))
+    assert (await storage._last_candle()).volume == 11
+
+
+async def test_from_csv(tmp_path):
+    csv = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})(
+        instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_HOUR)
+    await csv._prepare_new()
+    await csv._append(_candles(0, 50))
+
+    storage = _storage(tmp_path)
+    await storage.from_csv(csv.filepath)
+    candles = await storage._read(from_=DT, to=DT + timedelta(hours=12 * 49), interval=storage.interval)
+    assert [c.volume for c in candles] == list(range(50))
+
+
+async def test_read_empty(tmp_path):
+    storage = _storage(tmp_path)
+    await storage._prepare_new()
+    assert await storage._read(from_=DT, to=DT + timedelta(days=1), interval=storage.interval) == []
+
+
+async def test_csv_segmented_on_first_insert(tmp_path):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    csv = storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_HOUR)
+    await csv._prepare_new()
+    await csv._append(_candles(10, 110))
+    await csv._insert(_candles(0, 10))
+
+    segmented = storage.open(instrument_id=SBER.uid, interval=csv.interval)
+    assert isinstance(segmented, SegmentedCSVCandles) and segmented.filepath == tmp_path / 'SBER.segments'
+    assert not csv.filepath.exists()
+    mtimes = {p.name: p.stat().st_mtime_ns for p in segmented.filepath.glob('*.seg')}
+
+    await csv._insert(_candles(-5, 5))  # instance opened before the split follows segments
+    changed = {p.name for p in segmented.filepath.glob('*.seg') if p.stat().st_mtime_ns != mtimes.get(p.name)}
+    assert changed == {'2024-01.seg'}
+    for storage in csv, segmented:
+        candles = await storage._read(from_=DT - timedelta(hours=60), to=DT + timedelta(hours=12 * 119),
+                                      interval=storage.interval)
+        assert [c.volume for c in candles] == list(range(-5, 120))
+
+
+async def test_archive_tier_and_days_from_manifest(tmp_path, monkeypatch):
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / 'SBER.csv'})
+    csv = storage(instrument_id=SBER.uid, interval=CandleInterval.CANDLE_INTERVAL_HOUR)
+    await csv._prepare_new()
+    await csv._append(_candles(0, 120))
+    await compact(csv.filepath)
+    assert CandleArchive(csv.filepath).months() == ['2024-01', '2024-02']
+
+    await csv._insert(_candles(-5, 5))
+    segmented = storage.open(instrument_id=SBER.uid, interval=csv.interval)
+    assert CandleArchive(segmented.filepath).months() == ['2024-01', '2024-02']
+    assert [p.name for p in segmented.filepath.glob('*.seg')] == ['2024-03.seg']
+    assert (await segmented._first_candle()).volume == -5
+
+    candles = await segmented._read(from_=DT - timedelta(hours=60), to=DT + timedelta(hours=12 * 119),
+                                    interval=segmented.interval)
+    assert [c.volume for c in candles] == list(range(-5, 120))
+
+    async def _read_lines(*_):
+        raise AssertionError('segment is read')
+
+    monkeypatch.setattr(SegmentedCSVCandles, '_read_lines', _read_lines)
+    days = await segmented._days()
+    assert days[0] == np.datetime64('2024-01-28') and days[-1] == np.datetime64('2024-03-30')
+    assert len(days) == len(np.unique([dt2day(c.dt) for c in candles]))
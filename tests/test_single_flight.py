@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from my_tinkoff.columnar import ColumnarCandles
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.single_flight import SingleFlight, coalesced
+
+DT = datetime(2024, 2, 19, 10, tzinfo=TZ_UTC)
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(SingleFlight, 'CANDLE_WINDOWS', True)
+
+
+def _minutes(a: int, b: int) -> tuple[datetime, datetime]:
+    return DT + timedelta(minutes=a), DT + timedelta(minutes=b)
+
+
+async def test_do():
+    calls = []
+
+    async def _call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    stats = SingleFlight.stats()
+    results = await asyncio.gather(*[SingleFlight.do(('key', 1), _call) for _ in range(5)])
+    assert results == [1] * 5
+    assert SingleFlight.stats().saved - stats.saved == 4
+
+    assert await SingleFlight.do(('key', 1), _call) == 2
+
+
+async def test_get_candles_fetches_only_gaps():
+    fetched = []
+
+    async def _fetch(instrument_id, from_, to, interval):
+        fetched.append((from_, to))
+        await asyncio.sleep(0.01)
+        minutes = int((to - from_) / timedelta(minutes=1))
+        return ColumnarCandles.from_candles(Candles([
+            Candle(open=1, high=1, low=1, close=1, volume=1, dt=from_ + timedelta(minutes=i), is_complete=True)
+            for i in range(minutes)
+        ]))
+
+    stats = SingleFlight.stats()
+    first = asyncio.create_task(SingleFlight.get_candles('uid', *_minutes(0, 10), interval=1, fetch=_fetch))
+    await asyncio.sleep(0)
+    inner = asyncio.create_task(SingleFlight.get_candles('uid', *_minutes(2, 5), interval=1, fetch=_fetch))
+    overlapping = asyncio.create_task(SingleFlight.get_candles('uid', *_minutes(5, 15), interval=1, fetch=_fetch))
+    other = asyncio.create_task(SingleFlight.get_candles('uid', *_minutes(5, 15), interval=5, fetch=_fetch))
+    first, inner, overlapping, other = await asyncio.gather(first, inner, overlapping, other)
+
+    assert fetched == [_minutes(0, 10), _minutes(10, 15), _minutes(5, 15)]
+    assert [c.dt for c in inner] == [DT + timedelta(minutes=i) for i in range(2, 6)]
+    assert [c.dt for c in overlapping] == [DT + timedelta(minutes=i) for i in range(5, 15)]
+    assert len(other) == 10
+
+    stats_after = SingleFlight.stats()
+    assert stats_after.saved - stats.saved == 1
+    assert stats_after.narrowed - stats.narrowed == 1
+    assert stats_after.in_flight == 0
+    assert SingleFlight._windows == {}
+
+
+async def test_coalesced(monkeypatch):
+    calls = []
+
+    @coalesced
+    async def _call(x: int) -> int:
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x
+
+    assert await asyncio.gather(_call(1), _call(x=1), _call(x=1), _call(2)) == [1, 1, 1, 2]
+    assert calls == [1, 1, 2]
+
+    monkeypatch.setattr(SingleFlight, 'ENABLED', False)
+    assert await asyncio.gather(_call(x=3), _call(x=3)) == [3, 3]
+    assert calls[-2:] == [3, 3]
@@ -0,0 +1,54 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from tinkoff.invest import CandleInterval
+
+from my_tinkoff.date_utils import TZ_UTC
+from my_tinkoff.schemas import Candle, Candles
+from my_tinkoff.sync import sync_candles
+
+DT = datetime(2024, 2, 19, tzinfo=TZ_UTC)
+
+
+class Storage:
+    in_flight = 0
+    max_in_flight = 0
+    calls: list[tuple[str, datetime, datetime]] = []
+
+    @classmethod
+    async def download_or_read(cls, instrument, from_: datetime, to: datetime, interval) -> Candles:
+        cls.calls.append((instrument.ticker, from_, to))
+        cls.in_flight += 1
+        cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        await asyncio.sleep(0.01)
+        cls.in_flight -= 1
+
+        # both ends are included, as in `CSVCandles.download_or_read`
+        hours = int((to - from_) / timedelta(hours=1))
+        return Candles([
+            Candle(open=1, high=1, low=1, close=1, volume=1, dt=from_ + timedelta(hours=i), is_complete=True)
+            for i in range(hours + 1)
+        ])
+
+
+async def test_sync_candles():
+    instruments = [
+        SimpleNamespace(ticker=ticker, uid=ticker, first_1min_candle_date=datetime(2000, 1, 1, tzinfo=TZ_UTC))
+        for ticker in ['SBER', 'CNTL', 'POSI']
+    ]
+    reported = []
+    progresses = await sync_candles(
+        instruments, from_=DT, to=DT + timedelta(days=2), interval=CandleInterval.CANDLE_INTERVAL_HOUR,
+        window=timedelta(hours=12), max_in_flight=2, storage=Storage, on_progress=reported.append,
+    )
+
+    assert len(Storage.calls) == 3 * 4
+    assert {ticker for ticker, _, _ in Storage.calls} == {'SBER', 'CNTL', 'POSI'}
+    assert Storage.max_in_flight == 2
+    assert len(reported) == 3 * 4
+    for progress in progresses.values():
+        assert progress.error is None
+        assert progress.windows_done == progress.windows_total == 4
+        assert progress.candles == 2 * 24 + 1
+        assert progress.throughput == progress.candles / progress.elapsed
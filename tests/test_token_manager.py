@@ -0,0 +1,28 @@
+import time
+
+from my_tinkoff.enums import Service
+from my_tinkoff.token_manager import TokenBucket, TokenManager
+
+
+def test_token_bucket():
+    bucket = TokenBucket(limit_per_minute=60)
+    for _ in range(60):
+        assert bucket.available >= 1
+        bucket.take()
+
+    assert bucket.available < 1
+    assert 0 < bucket.time_until_available() <= 1
+
+    bucket.exhaust(reset=5)
+    assert bucket.available == 0
+    assert 4 < bucket.time_until_available() <= 5
+
+
+async def test_get_least_loaded_token():
+    tokens = TokenManager.list_all()
+    if len(tokens) < 2:
+        return
+
+    busy = TokenManager.get_bucket(tokens[0], Service.INSTRUMENTS)
+    busy.tokens, busy.updated = 0., time.monotonic()
+    assert await TokenManager.get(Service.INSTRUMENTS) != tokens[0]
@@ -0,0 +1,100 @@
+import shutil
+from datetime import date, datetime, time, timedelta
+from types import SimpleNamespace
+
+import pytest
+from tinkoff.invest import TradingDay, TradingSchedule
+
+from my_tinkoff import csv_candles
+from my_tinkoff.api_calls import instruments
+from my_tinkoff.csv_candles import CSVCandles
+from my_tinkoff.date_utils import DateTimeFactory, TZ_UTC
+from my_tinkoff.trading_calendar import TradingCalendar
+from tests.dataset import CASE_CNTL_FULL_RANGE_EXISTS, CASE_CNTL_GAP_IN_THE_END, CNTL
+
+HOLIDAY = date(2024, 2, 23)  # Defender of the Fatherland Day
+
+
+def _trading_day(day: date) -> TradingDay:
+    midnight = datetime.combine(day, time(), tzinfo=TZ_UTC)
+    if day.weekday() >= 5 or day == HOLIDAY:
+        return TradingDay(date=midnight, is_trading_day=False, start_time=None, end_time=None, evening_end_time=None)
+    return TradingDay(date=midnight, is_trading_day=True, start_time=midnight + timedelta(hours=7),
+                      end_time=midnight + timedelta(hours=15, minutes=40), evening_end_time=None)
+
+
+@pytest.fixture(autouse=True)
+def schedules(monkeypatch, tmp_path):
+    requests = []
+
+    async def _get_trading_schedules(exchange: str, from_: datetime, to: datetime) -> list[TradingSchedule]:
+        requests.append((from_.date(), to.date()))
+        days = [from_.date() + timedelta(days=i) for i in range((to.date() - from_.date()).days + 1)]
+        return [TradingSchedule(exchange=exchange, days=[_trading_day(d) for d in days])]
+
+    monkeypatch.setattr(instruments, 'get_trading_schedules', _get_trading_schedules)
+    monkeypatch.setattr(TradingCalendar, 'FILEPATH', tmp_path / 'trading_calendar.pickle')
+    monkeypatch.setattr(TradingCalendar, '_calendars', None)
+    return requests
+
+
+async def test_calendar(schedules):
+    await TradingCalendar.update(CNTL.exchange, from_=date(2024, 2, 16), to=date(2024, 2, 26))
+    await TradingCalendar.update(CNTL.exchange, from_=date(2024, 2, 19), to=date(2024, 2, 22))
+    assert schedules == [(date(2024, 2, 16), date(2024, 2, 26))]
+
+    assert TradingCalendar.is_trading_day(CNTL.exchange, date(2024, 2, 19))
+    assert not TradingCalendar.is_trading_day(CNTL.exchange, date(2024, 2, 24))
+    assert not TradingCalendar.is_trading_day(CNTL.exchange, HOLIDAY)
+    assert TradingCalendar.next_trading_day(CNTL.exchange, date(2024, 2, 22)) == date(2024, 2, 26)
+    assert TradingCalendar.previous_trading_day(CNTL.exchange, date(2024, 2, 26)) == date(2024, 2, 22)
+    assert not TradingCalendar.has_trading_time(CNTL.exchange, from_=datetime(2024, 2, 24, tzinfo=TZ_UTC),
+                                                to=datetime(2024, 2, 25, 12, tzinfo=TZ_UTC))
+
+    TradingCalendar._calendars = None
+    assert TradingCalendar.is_loaded(CNTL.exchange, from_=date(2024, 2, 16), to=date(2024, 2, 26))
+    assert TradingCalendar.is_trading_day(CNTL.exchange, date(2024, 2, 19))
+
+
+async def test_changing_sessions_not_saved(schedules, monkeypatch):
+    today = DateTimeFactory.now().date()
+    from_, to = today - timedelta(days=8), today + timedelta(days=5)
+    _get_trading_schedules = instruments.get_trading_schedules
+
+    async def _without_first_day(exchange: str, from_: datetime, to: datetime) -> list[TradingSchedule]:
+        schedules = await _get_trading_schedules(exchange=exchange, from_=from_, to=to)
+        return [TradingSchedule(exchange=s.exchange, days=s.days[1:]) for s in schedules]
+
+    monkeypatch.setattr(instruments, 'get_trading_schedules', _without_first_day)
+    await TradingCalendar.update(CNTL.exchange, from_=from_, to=to)
+    await TradingCalendar.update(CNTL.exchange, from_=from_, to=to)
+    assert len(schedules) == 1 and TradingCalendar.is_loaded(CNTL.exchange, from_=from_, to=to)
+
+    TradingCalendar._calendars = None  # sessions of the first day (default) and from today are requested again
+    assert TradingCalendar.is_loaded(CNTL.exchange, from_=from_ + timedelta(days=1), to=today - timedelta(days=1))
+    assert not TradingCalendar.is_loaded(CNTL.exchange, from_=from_, to=from_)
+    assert not TradingCalendar.is_loaded(CNTL.exchange, from_=today, to=today)
+
+    monkeypatch.setattr(TradingCalendar, 'TTL', timedelta(0))
+    await TradingCalendar.update(CNTL.exchange, from_=from_ + timedelta(days=1), to=today - timedelta(days=1))
+    assert len(schedules) == 1
+    await TradingCalendar.update(CNTL.exchange, from_=today, to=today)
+    assert len(schedules) == 2
+
+
+@pytest.mark.parametrize('case,requests', [(CASE_CNTL_FULL_RANGE_EXISTS, 0), (CASE_CNTL_GAP_IN_THE_END, 1)])
+async def test_download_or_read_loads_sessions_when_needed(schedules, monkeypatch, tmp_path, case, requests):
+    async def _get_candles(**kwargs):
+        raise AssertionError(f'Unexpected request | {kwargs}')
+
+    monkeypatch.setattr(csv_candles, 'get_candles', _get_candles)
+    shutil.copy(case.filepath, tmp_path / case.filepath.name)
+    storage = type('Storage', (CSVCandles,), {'filepath': tmp_path / case.filepath.name})
+    instrument = SimpleNamespace(uid=CNTL.uid, ticker=CNTL.ticker, exchange=CNTL.exchange,
+                                 first_1min_candle_date=datetime(2018, 3, 7, tzinfo=TZ_UTC))
+
+    for _ in range(2):
+        candles = await storage.download_or_read(instrument=instrument, from_=case.dt_from, to=case.dt_to,
+                                                 interval=case.interval)
+        assert len(candles) == case.count_candles
+    assert len(schedules) == requests